@@ -1,38 +1,90 @@
 #!/usr/local/lcls/package/python/current/bin/python
 # Written by Zimmer, edited by Ahmed, refactored by Lisa
 
+from time import strftime, time
+
+# When we got going, for --startup-times. It's up here so that the imports
+# count
+STARTED = time()
+
+from argparse import ArgumentParser
+from functools import partial
 from os import path
 from sys import argv, exit
-from time import time, sleep
-
-from epics import PV
 
 # TODO import these with the namespace
-from numpy import (polyfit, poly1d, polyval, corrcoef, std, mean, concatenate,
-                   empty, nan, zeros, isnan, linalg, abs,
-                   fft, argsort, interp, arange, nanmin, nanmax)
+from numpy import arange, empty, nan
 
-from PyQt4.QtCore import QTimer, QObject, SIGNAL, Qt
+from PyQt4.QtCore import QTimer, QObject, SIGNAL, Qt, pyqtSignal, QRectF
 from PyQt4.QtGui import (QMainWindow, QLabel, QGridLayout, QPalette,
-                         QApplication, QAction, QFileDialog, QIcon, QMessageBox)
-from pyqtgraph import PlotWidget, PlotCurveItem, ScatterPlotItem, TextItem
-
-from scipy.stats import nanmean, nanstd
-from subprocess import CalledProcessError, check_output
+                         QApplication, QAction, QActionGroup, QFileDialog,
+                         QIcon, QMessageBox, QComboBox, QSlider,
+                         QStringListModel)
+from pyqtgraph import (PlotWidget, PlotCurveItem, ScatterPlotItem, TextItem,
+                       ImageItem, ColorMap, FillBetweenItem, InfiniteLine,
+                       ViewBox, mkPen)
 
 from getpass import getuser
 
 from rtbsa_UI import Ui_RTBSA
+from rtbsaCatalog import EXTRA_PVS, loadCatalog, refreshCatalog
+from rtbsaCore import BSACore, runHeadless
+from rtbsaFrames import FrameSettings
+from rtbsaHistory import MAX_HISTORY_POINTS
+from rtbsaMetrics import MetricsExporter, StartupTimes, describe
+from rtbsaSearch import SEARCH_DELAY_MS, PVIndex
+from rtbsaSource import ReplaySource, SimulatedSource
+from rtbsaStats import BufferStats
+from rtbsaWorker import AnalysisWorker
 import rtbsaUtils
 
 
+############################################################################
+# Lets the PV callbacks (which run on a pyepics thread) tell the Qt thread that
+# there's new data, and the analysis worker tell it that there's a frame to
+# draw. Emitting a signal across threads queues it on the Qt event loop, and
+# while one notification is still waiting to be handled, any more just get
+# folded into it, so a burst of callbacks only costs one event.
+############################################################################
+class DataReadyNotifier(QObject):
+    dataReady = pyqtSignal()
+
+    def __init__(self, parent=None):
+        QObject.__init__(self, parent)
+        self.pending = False
+
+    def notify(self):
+        if not self.pending:
+            self.pending = True
+            self.dataReady.emit()
+
+    # Called by the Qt thread right before it goes to get whatever's new, so
+    # anything that arrives while it's busy with that asks for another go
+    def acknowledge(self):
+        self.pending = False
+
+
+# Same idea for the beam rate, which changes rarely enough that every change
+# gets its own event
+class RateChangedNotifier(QObject):
+    rateChanged = pyqtSignal(float)
+
+
+# And for the PV catalog, once it's been refreshed in the background
+class CatalogNotifier(QObject):
+    catalogReady = pyqtSignal(object)
+
+
 # noinspection PyArgumentList,PyCompatibility
 class RTBSA(QMainWindow):
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, maxFrameRate=rtbsaUtils.MAX_FRAME_RATE,
+                 user=None, source=None, showMetrics=False,
+                 metricsExporter=None, startupTimes=None):
         QMainWindow.__init__(self, parent)
         self.help_menu = self.menuBar().addMenu("&Help")
         self.file_menu = self.menuBar().addMenu("&File")
+        self.view_menu = self.menuBar().addMenu("&View")
         self.status_text = QLabel()
         self.plot = PlotWidget(alpha=0.75)
         self.ui = Ui_RTBSA()
@@ -42,24 +94,78 @@ class RTBSA(QMainWindow):
         self.setUpGraph()
 
         # Gets the username of the account running the program (i.e. physics,
-        # fphysics, spear, etc.)
-        self.user = getuser()
-
-        self.bsapvs = []
-
-        if self.user == "physics":
-            self.populateBSAPVs()
+        # fphysics, spear, etc.) unless we're told to pretend to be someone else
+        self.user = user or getuser()
+
+        # Does all of the acquisition and number crunching; this class just
+        # drives it from the controls and draws what it comes up with. source
+        # is where the PVs come from (EPICS by default; see rtbsaSource)
+        self.core = BSACore(self.user, idle=QApplication.processEvents,
+                            source=source)
+
+        # Every PV the search boxes can find, and the lists of results they
+        # show (see search)
+        self.pvIndex = PVIndex()
+        self.searchResults = {"A": [], "B": []}
+        self.searchModels = {"A": QStringListModel(self),
+                             "B": QStringListModel(self)}
+        self.ui.bsaListA.setModel(self.searchModels["A"])
+        self.ui.bsaListB.setModel(self.searchModels["B"])
+
+        # Searches wait for a pause in the typing rather than running on every
+        # keystroke
+        self.searchTimers = {}
+        for device in ("A", "B"):
+            self.searchTimers[device] = QTimer(self)
+            self.searchTimers[device].setSingleShot(True)
+            self.searchTimers[device].setInterval(SEARCH_DELAY_MS)
+            self.searchTimers[device].timeout.connect(partial(self.search,
+                                                              device))
+
+        self.catalogNotifier = CatalogNotifier(self)
+        self.catalogNotifier.catalogReady.connect(self.swapCatalog)
+
+        # The PV list and the search lists wait until the window's up (see
+        # finishStartup). startupTimes gets how long that took, if it's given
+        self.startupTimes = startupTimes
+        QTimer.singleShot(0, self.finishStartup)
 
         self.connectGuiFunctions()
 
-        # Initial number of points
-        self.numPoints = 2800
-
         # Initial number of standard deviations
         self.stdDevstoKeep = 3.0
 
-        # 20ms polling time
-        self.updateTime = 50
+        # The plot only gets redrawn when new data comes in, and at most this
+        # many times a second
+        self.maxFrameRate = maxFrameRate
+
+        # The update method for the current plot type
+        self.renderMethod = None
+        self.lastFrameTime = 0
+        self.frameScheduled = False
+
+        self.dataNotifier = DataReadyNotifier(self)
+        self.dataNotifier.dataReady.connect(self.scheduleFrame)
+        self.core.dataListeners.append(self.dataNotifier.notify)
+
+        # The update methods have the frames worked out in the background,
+        # and this hears when one's ready to draw (see drawFrame)
+        self.frameNotifier = DataReadyNotifier(self)
+        self.frameNotifier.dataReady.connect(self.drawFrame)
+        self.analysisWorker = AnalysisWorker(self.frameNotifier.notify,
+                                             self.core.metrics)
+
+        # Once a second, the timing metrics go to the overlay on the plot (if
+        # it's showing) and to metricsExporter (if there is one)
+        self.metricsExporter = metricsExporter
+        self.metricsTimer = QTimer(self)
+        self.metricsTimer.timeout.connect(self.updateMetrics)
+
+        self.metricsLabel = QLabel(self.plot)
+        self.metricsLabel.setStyleSheet(
+            'QLabel{background-color:rgba(0,0,0,160);color:yellow;padding:2px}')
+        self.metricsLabel.move(60, 5)
+        self.metricsLabel.hide()
 
         # Set initial polynomial fit to 2
         self.fitOrder = 2
@@ -70,64 +176,72 @@ class RTBSA(QMainWindow):
         # Used to update plot
         self.timer = QTimer(self)
 
-        if self.user == "physics":
-            self.ratePV = PV('IOC:IN20:EV01:RG01_ACTRATE')
+        # Set while the beam rate is below 1Hz, during which the callbacks
+        # throw away whatever they get and nothing gets drawn
+        self.renderPaused = False
 
-        elif self.user == "spear":
-            self.ratePV = PV("LINAC:RateSetpt")
+        self.rateNotifier = RateChangedNotifier(self)
+        self.rateNotifier.rateChanged.connect(self.rateChanged)
 
-        self.menuBar().setStyleSheet('QWidget{background-color:grey;color:purple}')
-        self.create_menu()
-        self.create_status_bar()
+        if self.core.rateMonitor:
+            self.core.rateMonitor.listeners.append(
+                self.rateNotifier.rateChanged.emit)
 
-        # The PV names
-        self.devices = {"A": "", "B": ""}
+        # What FFT mode draws: "periodogram" (the spectrum of the whole window),
+        # "welch" (the averaged PSD) or "spectrogram" (see the View menu)
+        self.spectrumMode = "periodogram"
 
-        self.pvObjects = {"A": None, "B": None}
+        # Whether B vs A mode draws the coherence of B with A instead of the
+        # scatter plot (see the View menu)
+        self.coherenceMode = False
 
-        # The raw, unsynchronized, unfiltered buffers
-        self.rawBuffers = {"A": empty(rtbsaUtils.BUFF_LENGTH_LIMIT),
-                           "B": empty(rtbsaUtils.BUFF_LENGTH_LIMIT)}
-        self.rawBuffers["A"][:] = nan
-        self.rawBuffers["B"][:] = nan
+        self.menuBar().setStyleSheet('QWidget{background-color:grey;color:purple}')
+        self.create_menu(showMetrics)
+        self.create_status_bar()
+        self.updateMetricsTimer()
 
-        # The times when each buffer finished its last data acquisition
-        self.timeStamps = {"A": None, "B": None}
+        # The recording being played back, if that's where the data is coming
+        # from, and the controls for it
+        self.replay = None
+        self.replayTimer = QTimer(self)
+        self.replayTimer.timeout.connect(self.updateReplayControls)
+        self.create_replay_toolbar()
 
-        self.synchronizedBuffers = {"A": empty(rtbsaUtils.BUFF_LENGTH_LIMIT),
-                                    "B": empty(rtbsaUtils.BUFF_LENGTH_LIMIT)}
-        self.synchronizedBuffers["A"][:] = nan
-        self.synchronizedBuffers["B"][:] = nan
+        if isinstance(source, ReplaySource):
+            self.showReplay(source)
 
-        # Versions of data buffers A and B that are filtered by standard
-        # deviation. Didn't want to edit those buffers directly so that we could
-        # unfilter or refilter with a different number more efficiently
-        self.filteredBuffers = {"A": empty(rtbsaUtils.BUFF_LENGTH_LIMIT),
-                                "B": empty(rtbsaUtils.BUFF_LENGTH_LIMIT)}
+        # Whatever the core has to say goes in the status bar too
+        self.core.statusListeners.append(self.statusBar().showMessage)
 
-        self.filteredBuffers["A"][:] = nan
-        self.filteredBuffers["B"][:] = nan
+        # The PV names picked in the controls
+        self.devices = {"A": "", "B": ""}
 
         # Text objects that appear on the plot
         self.text = {"avg": None, "std": None, "slope": None, "corr": None}
 
         # All things plot related!
         self.plotAttributes = {"curve": None, "fit": None, "parab": None,
-                               "frequencies": None}
-
-        # Used for the kill swtich
-        self.counter = {"A": 0, "B": 0}
-
-        # Used to implement scrolling for time plots
-        self.currIdx = {"A": 0, "B": 0}
-
-        self.bothPVsBSA = True
-
-    def getRate(self):
-        if self.user == "physics":
-            return rtbsaUtils.rateDictLCLS[self.ratePV.value]
-        elif self.user == "spear":
-            return rtbsaUtils.rateDictSPEAR[self.ratePV.value]
+                               "matrix": None, "lower": None, "upper": None,
+                               "band": None, "levels": None,
+                               "threshold": None, "phase": None,
+                               "phaseView": None}
+
+        # How many pulses each point of the long A vs time plot stands for
+        self.historyFactor = None
+
+    # Connected to the rate monitor (via rateNotifier), so this runs on the Qt
+    # thread whenever the beam rate changes
+    def rateChanged(self, rate):
+        if rate < 1:
+            self.renderPaused = True
+            if not self.abort:
+                self.printStatus("Waiting for beam rate to be at least 1Hz...",
+                                 False)
+
+        elif self.renderPaused:
+            self.renderPaused = False
+            if not self.abort:
+                self.printStatus("Running", False)
 
     def disableInputs(self):
         self.ui.fitOrder.setDisabled(True)
@@ -139,29 +253,58 @@ class RTBSA(QMainWindow):
         self.statusBar().showMessage('Hi there!  I missed you!')
         self.ui.checkBoxPolyFit.setChecked(False)
 
+    # Runs as soon as the event loop starts, i.e. once the window is showing
+    def finishStartup(self):
+        if self.startupTimes:
+            self.startupTimes.mark("event loop")
+
+        if self.user == "physics":
+            self.populateBSAPVs()
+
+        if self.startupTimes:
+            self.startupTimes.mark("PV list")
+            self.printStatus(self.startupTimes.describe())
+
+    ############################################################################
+    # The PV list comes from the cache of the last one we got (or, if there
+    # isn't one, the list in rtbsaUtils) so that the window can open right
+    # away. The directory service's current one gets fetched in the background
+    # and swapped in whenever it shows up (see rtbsaCatalog)
+    ############################################################################
     def populateBSAPVs(self):
-        self.bsapvs += ['GDET:FEE1:241:ENRC', 'GDET:FEE1:242:ENRC',
-                        'GDET:FEE1:361:ENRC', 'GDET:FEE1:362:ENRC']
-        # Generate list of BSA PVS
-        try:
-            BSAPVs = check_output(['eget', '-ts', 'ds', '-a',
-                                   'tag=LCLS.BSA.rootnames']).splitlines()[1:-1]
-            self.bsapvs.extend(BSAPVs)
-
-        # Backup for eget error
-        except CalledProcessError:
-            print("Unable to pull most recent PV list")
-            # bsaPVs is pulled from the Constants file
-            self.bsapvs.extend(rtbsaUtils.bsaPVs)
-
-        # TODO un-hardcode machine and add common SPEAR PV's
-        except OSError:
-            print "Other machines coming soon to an RTBSA near you!"
-            pass
+        pvs, _ = loadCatalog()
+
+        self.pvIndex.add(EXTRA_PVS)
+        self.pvIndex.add(pvs or rtbsaUtils.bsaPVs)
+
+        self.search("A")
+        self.search("B")
+
+        refreshCatalog(self.catalogFetched)
+
+    # Runs on the refresh thread, so the new index gets built there and not on
+    # the Qt thread
+    def catalogFetched(self, pvs):
+        index = PVIndex(EXTRA_PVS)
+        index.add(pvs)
+        index.build()
+        self.catalogNotifier.catalogReady.emit(index)
 
-        for pv in self.bsapvs:
-            self.ui.bsaListA.addItem(pv)
-            self.ui.bsaListB.addItem(pv)
+    def swapCatalog(self, index):
+        # So that searching still finds them
+        if self.replay:
+            index.add(self.replay.recording.pvs)
+
+        # Searching again would lose whatever's selected for nothing
+        if set(index.names) == set(self.pvIndex.names):
+            return
+
+        self.pvIndex = index
+        self.search("A")
+        self.search("B")
+
+        self.statusBar().showMessage("Updated the PV list ({N} PVs)"
+                                     .format(N=len(index)), 5000)
 
     def connectGuiFunctions(self):
         # enter 1 is the text input box for device A, and 2 is for B
@@ -171,8 +314,8 @@ class RTBSA(QMainWindow):
                         self.searchB)
 
         # Changes the text in the input box to match the selection from the list
-        self.ui.bsaListA.itemClicked.connect(self.setEnterA)
-        self.ui.bsaListB.itemClicked.connect(self.setEnterB)
+        self.ui.bsaListA.clicked.connect(self.setEnterA)
+        self.ui.bsaListB.clicked.connect(self.setEnterB)
 
         if self.user == "physics":
             # Dropdown menu for device A (add common BSA PV's)
@@ -196,6 +339,7 @@ class RTBSA(QMainWindow):
         self.ui.checkBoxAvsT.clicked.connect(self.AvsTClick)
         self.ui.checkBoxBvsA.clicked.connect(self.AvsBClick)
         self.ui.checkBoxFFT.clicked.connect(self.AFFTClick)
+        self.ui.checkBoxCorrMatrix.clicked.connect(self.corrMatrixClick)
         self.ui.checkBoxShowAve.clicked.connect(self.avg_click)
         self.ui.checkBoxShowStdDev.clicked.connect(self.std_click)
         self.ui.checkBoxCorrCoeff.clicked.connect(self.corr_click)
@@ -258,24 +402,31 @@ class RTBSA(QMainWindow):
         self.statusBar().addWidget(self.status_text, 1)
         self.statusBar().setPalette(palette)
 
-    # Effectively an autocomplete
-    def search(self, enter, widget):
-        widget.clear()
-        query = str(enter.text())
-        for pv in self.bsapvs:
-            if query.lower() in pv.lower():
-                widget.addItem(pv)
+    # Effectively an autocomplete: fills device's list with the best matches
+    # for what's in its search box (see PVIndex)
+    def search(self, device):
+        enter = (self.ui.searchInputA if device == "A"
+                 else self.ui.searchInputB)
+        self.searchResults[device] = self.pvIndex.search(str(enter.text()))
+        self.searchModels[device].setStringList(self.searchResults[device])
 
     def searchA(self):
-        self.search(self.ui.searchInputA, self.ui.bsaListA)
+        self.searchTimers["A"].start()
 
     def searchB(self):
-        self.search(self.ui.searchInputB, self.ui.bsaListB)
+        self.searchTimers["B"].start()
+
+    # The PVs picked in device's list
+    def selectedPVs(self, device):
+        widget = self.ui.bsaListA if device == "A" else self.ui.bsaListB
+        return [self.searchResults[device][index.row()]
+                for index in widget.selectionModel().selectedRows()]
 
-    def setEnter(self, widget, enter, search, enter_rb):
-        selection = widget.currentItem()
+    def setEnter(self, device, enter, search, enter_rb):
+        widget = self.ui.bsaListA if device == "A" else self.ui.bsaListB
+        selection = self.searchResults[device][widget.currentIndex().row()]
         enter.textChanged.disconnect()
-        enter.setText(selection.text())
+        enter.setText(selection)
         QObject.connect(enter, SIGNAL("textChanged(const QString&)"), search)
 
         if not self.abort and enter_rb.isChecked():
@@ -283,11 +434,11 @@ class RTBSA(QMainWindow):
             self.timer.singleShot(250, self.initializePlot)
 
     def setEnterA(self):
-        self.setEnter(self.ui.bsaListA, self.ui.searchInputA, self.searchA,
+        self.setEnter("A", self.ui.searchInputA, self.searchA,
                       self.ui.searchButtonA)
 
     def setEnterB(self):
-        self.setEnter(self.ui.bsaListB, self.ui.searchInputB, self.searchB,
+        self.setEnter("B", self.ui.searchInputB, self.searchB,
                       self.ui.searchButtonB)
 
     def correctInput(self, errorMessage, acceptableTxt, textBox):
@@ -296,7 +447,8 @@ class RTBSA(QMainWindow):
 
     def correctNumpoints(self, errorMessage, acceptableValue):
         self.correctInput(errorMessage, str(acceptableValue), self.ui.numPoints)
-        self.numPoints = acceptableValue
+        self.analysisWorker.cancel()
+        self.core.setNumPoints(acceptableValue)
 
     def correctStdDevs(self, errorMessage, acceptableValue):
         self.correctInput(errorMessage, str(acceptableValue),
@@ -315,21 +467,32 @@ class RTBSA(QMainWindow):
             return
 
     def points_entered(self):
+        # A vs time can go back further than the ring buffers (see
+        # genLongTimePlotA)
+        if self.ui.checkBoxAvsT.isChecked():
+            limit = MAX_HISTORY_POINTS
+        else:
+            limit = rtbsaUtils.BUFF_LENGTH_LIMIT
+
         try:
-            self.numPoints = int(self.ui.numPoints.text())
+            numPoints = int(self.ui.numPoints.text())
 
-            if self.numPoints > rtbsaUtils.BUFF_LENGTH_LIMIT or self.numPoints < 1:
+            if numPoints > limit or numPoints < 1:
                 raise ValueError
 
         except ValueError:
-            self.correctNumpoints('Enter an integer, 1 to BUFF_LENGTH_LIMIT',
+            self.correctNumpoints('Enter an integer, 1 to {N}'.format(N=limit),
                                   rtbsaUtils.BUFF_LENGTH_LIMIT)
             return
 
-        # TODO figure out which of these is preferable
+        # The frames in the works are for the old window
+        self.analysisWorker.cancel()
+        self.core.setNumPoints(numPoints)
+
+        # Replotted from what's already been collected rather than stopping
+        # and starting over, which would throw it away along with any
+        # recording that's going
         self.reinitialize_plot()
-        # self.stop()
-        # self.timer.singleShot(250, self.initializePlot)
 
     ############################################################################
     # Where the magic happens (well, where it starts to happen). This
@@ -338,40 +501,48 @@ class RTBSA(QMainWindow):
     def initializePlot(self):
         plotTypeIsValid = (self.ui.checkBoxAvsT.isChecked()
                            or self.ui.checkBoxBvsA.isChecked()
-                           or self.ui.checkBoxFFT.isChecked())
+                           or self.ui.checkBoxFFT.isChecked()
+                           or self.ui.checkBoxCorrMatrix.isChecked())
 
         if not plotTypeIsValid:
-            self.statusBar().showMessage('Pick a Plot Type (PV vs. time '
-                                         'or B vs A)', 10000)
+            self.statusBar().showMessage('Pick a Plot Type (PV vs. time, '
+                                         'B vs A, FFT or correlation matrix)',
+                                         10000)
             return
 
         self.ui.startButton.setDisabled(True)
         self.abort = False
 
+        self.analysisWorker.cancel()
         self.cleanPlot()
-        self.pvObjects["A"], self.pvObjects["B"] = None, None
 
         # Plot history buffer for one PV
         if self.ui.checkBoxAvsT.isChecked():
             if self.populateDevices(self.ui.dropdownButtonA, self.ui.dropdownA,
                                     self.ui.searchButtonA, self.ui.searchInputA,
                                     "A"):
-                self.genPlotAndSetTimer(self.genTimePlotA,
-                                        self.updateTimePlotA)
+                self.genPlotAndStartUpdates(self.genTimePlotA,
+                                            self.updateTimePlotA)
 
         # Plot for 2 PVs
         elif self.ui.checkBoxBvsA.isChecked():
             if self.updateValsFromInput():
-                self.genPlotAndSetTimer(self.genPlotAB,
-                                        self.updatePlotAB)
+                self.genPlotAndStartUpdates(self.genPlotAB,
+                                            self.updatePlotAB)
+
+        # Plot the correlation matrix of a bunch of PVs
+        elif self.ui.checkBoxCorrMatrix.isChecked():
+            self.initializeMatrix()
+            self.genPlotAndStartUpdates(self.genPlotMatrix,
+                                        self.updatePlotMatrix)
 
         # Plot power spectrum
         else:
             if self.populateDevices(self.ui.dropdownButtonA, self.ui.dropdownA,
                                     self.ui.searchButtonA, self.ui.searchInputA,
                                     "A"):
-                self.genPlotAndSetTimer(self.InitializeFFTPlot,
-                                        self.updatePlotFFT)
+                self.genPlotAndStartUpdates(self.InitializeFFTPlot,
+                                            self.updatePlotFFT)
 
     def populateDevices(self, common_rb, common, enter_rb, enter, device):
 
@@ -409,470 +580,413 @@ class RTBSA(QMainWindow):
                                     "B"):
             return False
 
-        self.printStatus("Initializing/Synchronizing {A} and {B} buffers..."
-                         .format(A=self.devices["A"], B=self.devices["B"]))
-
-        self.initializeBuffers()
-
-        if self.user == "spear":
-            sleep(2)
-
+        self.core.startPair(self.devices["A"], self.devices["B"])
         return True
 
-    def initializeBuffers(self):
-        if self.user == "spear":
-            self.bothPVsBSA = False
-            self.clearAndUpdateCallbacks("", resetRawBuffer=True)
-
-        if self.user == "physics":
-            # Initial population of our buffers using the HSTBR PV's in our
-            # callback functions
-            self.bothPVsBSA = self.clearAndUpdateCallbacks("HSTBR",
-                                                           resetTime=True)
-
-            if self.bothPVsBSA:
-                while ((not self.timeStamps["A"] or not self.timeStamps["B"])
-                       and not self.abort):
-                    QApplication.processEvents()
-
-            self.adjustSynchronizedBuffers(True)
-
-            # Try to switch to the beam rate PVs (if available, else, just the
-            # base PV) to avoid pulling an entire history buffer
-            # on every update.
-            if not self.clearAndUpdateCallbacks("BR", resetRawBuffer=True):
-                self.clearAndUpdateCallbacks("", resetRawBuffer=True)
-
-    def clearAndUpdateCallbacks(self, suffix, resetTime=False,
-                                resetRawBuffer=False):
-        aIsBSA = self.clearAndUpdateCallback("A", suffix, self.callbackA,
-                                             self.devices["A"], resetTime,
-                                             resetRawBuffer)
-        bIsBSA = self.clearAndUpdateCallback("B", suffix, self.callbackB,
-                                             self.devices["B"], resetTime,
-                                             resetRawBuffer)
-        return aIsBSA and bIsBSA
+    def genPlotAndStartUpdates(self, genPlot, updateMethod):
+        if self.abort:
+            return
 
-    # noinspection PyTypeChecker
-    def clearAndUpdateCallback(self, device, suffix, callback, pvName,
-                               resetTime=False, resetRawBuffer=False):
-        self.clearPV(device)
+        try:
+            genPlot()
+        except UnboundLocalError:
+            self.printStatus('No Data, Aborting Plotting Algorithm')
+            return
 
-        # Without the time parameter, we wouldn't get the timestamp
-        self.pvObjects[device] = PV(pvName + suffix, form='time')
+        # From here on, updateMethod runs whenever the callbacks bring in new
+        # data (see scheduleFrame)
+        self.renderMethod = updateMethod
+        self.dataNotifier.acknowledge()
 
-        # For some reason, we need this before checking the connection
-        sleep(0.1)
+        self.printStatus('Running')
 
-        if not self.pvObjects[device].connect():
-            # self.stop()
-            self.printStatus('PV ' + pvName + suffix + ' invalid.', True)
-            return False
+    ############################################################################
+    # Connected to the data ready notification. Starts on a frame right away,
+    # unless that would go over maxFrameRate, in which case it starts on one as
+    # soon as it's allowed to. Either way there's at most one frame waiting,
+    # however many callbacks come in before it gets going.
+    ############################################################################
+    def scheduleFrame(self):
+        if self.frameScheduled:
+            return
 
-        if resetTime:
-            self.timeStamps[device] = None
+        wait = self.lastFrameTime + 1.0 / self.maxFrameRate - time()
 
-        # Make sure that the initial raw buffer is synchronized and pad with
-        # nans if it's less than rtbsaUtils.BUFF_LENGTH_LIMIT points long
-        if resetRawBuffer:
-            nanArray = empty(rtbsaUtils.BUFF_LENGTH_LIMIT
-                             - self.synchronizedBuffers[device].size)
-            nanArray[:] = nan
-            self.rawBuffers[device] = \
-                concatenate([self.synchronizedBuffers[device], nanArray])
+        if wait <= 0:
+            self.renderFrame()
+        else:
+            self.frameScheduled = True
+            QTimer.singleShot(int(wait * 1000), self.renderFrame)
 
-        self.pvObjects[device].add_callback(callback)
-        return True
+    def renderFrame(self):
+        self.frameScheduled = False
+        self.dataNotifier.acknowledge()
 
-    # Callback function for Device A
-    # noinspection PyUnusedLocal
-    def callbackA(self, pvname=None, value=None, timestamp=None, **kw):
-        self.updateTimeAndBuffer("A", pvname, timestamp, value)
+        if self.abort or not self.renderMethod:
+            return
 
-    # Callback function for Device B
-    # noinspection PyUnusedLocal
-    def callbackB(self, pvname=None, value=None, timestamp=None, **kw):
-        self.updateTimeAndBuffer("B", pvname, timestamp, value)
+        self.lastFrameTime = time()
+        self.renderMethod()
 
     ############################################################################
-    # This is where the data is actually acquired and saved to the buffers.
-    # Callbacks are effectively listeners that listen for change, so we
-    # basically put a callback on the PVs of interest (devices A and/or B) so
-    # that every time the value of that PV changes, we get that new value and
-    # append it to our raw data buffer for that device.
-    # Initialization of the buffer is slightly different in that the listener is
-    # put on the history buffer of that PV (denoted by the HSTBR suffix), so
-    # that we just immediately write the previous BUFF_LENGTH_LIMIT points to
-    # our raw buffer
+    # The update methods only decide what the frame should be. The analysis
+    # worker works it out with makeFrame (one of BSACore's frame methods) from
+    # the current settings, and once it's done, it gets drawn with draw (see
+    # drawFrame). If the worker's still busy with the last one, this one waits
+    # in its place.
     ############################################################################
-    def updateTimeAndBuffer(self, device, pvname, timestamp, value):
+    def requestFrame(self, makeFrame, draw):
+        self.analysisWorker.submit(partial(makeFrame, self.frameSettings()),
+                                   draw)
 
-        def padRawBufferWithNans(start, end):
-            rtbsaUtils.padWithNans(self.rawBuffers[device], start, end)
+    # The same, worked out and drawn right here, for while the plot's being
+    # set up (when the worker's been cancelled)
+    def drawNow(self, makeFrame, draw, *args):
+        frame = makeFrame(self.frameSettings(), *args)
 
-        if "HSTBR" in pvname:
-            self.timeStamps[device] = timestamp
+        if frame is not None:
+            draw(frame)
 
-            # value is the buffer because we're monitoring the HSTBR PV
-            self.rawBuffers[device][0:2800] = value
+    ############################################################################
+    # Connected to the frame ready notification. Only the newest frame the
+    # worker's finished gets drawn; any it finished before that which we didn't
+    # get to in time are already gone.
+    ############################################################################
+    def drawFrame(self):
+        self.frameNotifier.acknowledge()
+        result = self.analysisWorker.take()
 
-            # Reset the counter every time we reinitialize the plot
-            self.counter[device] = 0
+        if result is None or self.abort:
+            return
 
-        else:
+        draw, frame = result
 
-            rate = self.getRate()
-            if rate < 1:
-                return
+        start = time()
+        draw(frame)
+        self.core.metrics.record("frame", time() - start)
 
-            scalingFactor = 1.0 / rate
-            currIdx = int((timestamp / scalingFactor) % self.numPoints)
+    # What the frame methods need from the controls and the plot, which only
+    # the Qt thread can read (see FrameSettings)
+    def frameSettings(self):
+        if self.ui.checkBoxLinFit.isChecked():
+            fitOrder = 1
+        elif self.ui.checkBoxPolyFit.isChecked():
+            fitOrder = self.fitOrder
+        else:
+            fitOrder = None
 
-            if self.timeStamps[device]:
+        viewBox = self.plot.getViewBox()
 
-                elapsedPulses = round((timestamp - self.timeStamps[device])
-                                      / scalingFactor)
+        return FrameSettings(self.numStdDevs(), fitOrder,
+                             self.ui.checkBoxLinFit.isChecked(),
+                             tuple(viewBox.viewRange()[0]), viewBox.width(),
+                             self.ui.checkBoxAutoscale.isChecked(),
+                             self.plotAttributes["levels"])
 
-                if elapsedPulses <= 0:
-                    return
+    ############################################################################
+    # Switches to playing back the recording in the directory the user picks
+    # (see ReplaySource). Whatever's running gets stopped; hitting start plots
+    # the recording with the plot type and PVs picked as usual, which are set
+    # to the recorded PVs to begin with.
+    ############################################################################
+    def openRecording(self):
+        # noinspection PyCallByClass,PyTypeChecker
+        directory = unicode(QFileDialog.getExistingDirectory(
+            self, 'Open recording'))
 
-                # Pad the buffer with nans for missed pulses
-                elif elapsedPulses > 1:
+        if not directory:
+            return
 
-                    # noinspection PyTypeChecker
-                    lastIdx = int((self.timeStamps[device] / scalingFactor)
-                                  % self.numPoints)
+        try:
+            source = ReplaySource(directory)
+        except (IOError, ValueError, KeyError) as error:
+            self.statusBar().showMessage('Unable to open {D}: {E}'
+                                         .format(D=directory, E=error), 10000)
+            return
 
-                    # Take care of wrap around
-                    if currIdx < lastIdx:
-                        padRawBufferWithNans(lastIdx + 1, self.numPoints)
-                        padRawBufferWithNans(0, currIdx)
+        if not self.abort:
+            self.stop()
 
-                    else:
-                        padRawBufferWithNans(lastIdx + 1, currIdx)
+        if self.replay:
+            self.replay.stop()
 
-                self.counter[device] += elapsedPulses
+        oldRateMonitor = self.core.setSource(source)
 
-            else:
-                self.counter[device] += 1
+        if oldRateMonitor:
+            oldRateMonitor.listeners.remove(self.rateNotifier.rateChanged.emit)
 
-            # Directly index into the raw buffer using the timestamp
-            self.rawBuffers[device][currIdx] = value
+        self.core.rateMonitor.listeners.append(
+            self.rateNotifier.rateChanged.emit)
 
-            self.timeStamps[device] = timestamp
-            self.currIdx[device] = currIdx
+        self.showReplay(source)
 
-    def clearPV(self, device):
-        pv = self.pvObjects[device]
-        if pv:
-            pv.clear_callbacks()
-            pv.disconnect()
+    def showReplay(self, source):
+        self.replay = source
+        pvs = source.recording.pvs
 
-    def adjustSynchronizedBuffers(self, syncByTime=False):
-        numBadShots = self.populateSynchronizedBuffers(syncByTime)
-        blength = rtbsaUtils.BUFF_LENGTH_LIMIT - numBadShots
+        # So that searching finds them
+        self.pvIndex.add(pvs)
 
-        # Make sure the buffer size doesn't exceed the desired number of points
-        if self.numPoints < blength:
-            self.synchronizedBuffers["A"] = \
-                self.synchronizedBuffers["A"][:self.numPoints]
+        self.ui.searchInputA.setText(pvs[0])
+        if len(pvs) > 1:
+            self.ui.searchInputB.setText(pvs[1])
 
-            self.synchronizedBuffers["B"] = \
-                self.synchronizedBuffers["B"][:self.numPoints]
+        if not self.ui.searchButtonA.isChecked():
+            self.ui.searchButtonA.click()
 
-    # A spin loop that waits until the beam rate is at least 1Hz
-    def waitForRate(self):
+        duration = int(source.recording.duration())
+        self.replaySlider.setRange(0, duration)
+        self.replayToolbar.show()
+        self.replayTimer.start(250)
 
-        start_time = time()
-        gotStuckAndNeedToUpdateMessage = False
+        self.statusBar().showMessage('Replaying {D} ({N} PVs, {S}s)'
+                                     .format(D=source.recording.directory,
+                                             N=len(pvs), S=duration))
 
-        if self.user == "physics":
-            # self.rate is a PV, such that .value is shorthand for .getval
-            while self.ratePV.value < 2:
-                # noinspection PyArgumentList
-                QApplication.processEvents()
-
-                if time() - start_time > 0.5:
-                    gotStuckAndNeedToUpdateMessage = True
-                    self.printStatus("Waiting for beam rate to be at least"
-                                     " 1Hz...",
-                                     False)
-
-            if gotStuckAndNeedToUpdateMessage:
-                self.printStatus("Running", False)
+    def create_replay_toolbar(self):
+        self.replayToolbar = self.addToolBar("Replay")
 
-            return rtbsaUtils.rateDictLCLS[self.ratePV.value]
+        pause_action = self.create_action("Pause", slot=self.pauseReplay,
+                                          tip="Pause the replay",
+                                          checkable=True,
+                                          signal="toggled(bool)")
+        self.replayToolbar.addAction(pause_action)
 
-        elif self.user == "spear":
-            return rtbsaUtils.rateDictSPEAR[self.ratePV.value]
+        self.replaySpeed = QComboBox()
+        self.replaySpeed.addItems(["0.25x", "0.5x", "1x", "2x", "5x", "10x",
+                                   "60x"])
+        self.replaySpeed.setCurrentIndex(2)
+        self.replaySpeed.currentIndexChanged.connect(self.setReplaySpeed)
+        self.replayToolbar.addWidget(self.replaySpeed)
 
-    ############################################################################
-    # Time 1 is when Device A started acquiring data, and Time 2 is when Device
-    # B started acquiring data. Since they're not guaranteed to start
-    # acquisition at the same time, one data buffer might be ahead of the other,
-    # meaning that the intersection of the two buffers would not include the
-    # first n elements of one and the last n elements of the other. See the
-    # diagram below, where the dotted line represents the time axis (one buffer
-    # is contained  by square brackets [], the other by curly braces {}, and the
-    # times where each starts and ends is indicated right underneath).
-    #
-    #
-    #          [           {                            ]           }
-    # <----------------------------------------------------------------------> t
-    #       t1_start    t2_start                     t1_end      t2_end
-    #
-    #
-    # Note that both buffers are of the same size (BUFF_LENGTH_LIMIT) so that:
-    # (t1_end - t1_start) = (t2_end - t2_start)
-    #
-    # From the diagram, we see that only the time between t2_start and t1_end
-    # contains data from both buffers (t1_start to t2_start only contains data
-    # from buffer 1, and t1_end to t2_end only contains data from buffer 2).
-    # Using that, we can chop the beginning of buffer 1 and the end of buffer 2
-    # so that we're only left with the overlapping region.
-    #
-    # In order to figure out how many points we need to chop from each buffer
-    # (it's the same number for both since they're both the same size), we
-    # multiply the time delta by the beam rate (yay dimensional analysis!):
-    # seconds * (shots/second) = (number of shots)
-    #
-    # That whole rigmarole only applies to the initial population of the buffers
-    # (where we're pulling the entire history buffer at once using the HSTBR
-    # suffix). From then on, we're indexing into the raw buffers using the
-    # pulse ID modulo BUFF_LENGTH_LIMIT, so they're inherently synchronized
-    ############################################################################
-    def populateSynchronizedBuffers(self, syncByTime):
+        self.replaySlider = QSlider(Qt.Horizontal)
+        self.replaySlider.setMinimumWidth(300)
+        self.replaySlider.sliderReleased.connect(self.seekReplay)
+        self.replayToolbar.addWidget(self.replaySlider)
 
-        def padSyncBufferWithNans(device, startIdx, endIdx):
-            lag = endIdx - startIdx
+        self.replayTime = QLabel()
+        self.replayToolbar.addWidget(self.replayTime)
 
-            if self.user == "physics" and lag > 20:
-                print ("Reinitializing buffers due to " + str(lag)
-                       + " shot lag for device " + device)
-                self.initializeBuffers()
+        self.replayToolbar.hide()
 
-            else:
-                rtbsaUtils.padWithNans(self.synchronizedBuffers[device],
-                                       startIdx + 1, endIdx + 1)
+    def pauseReplay(self, pause):
+        if self.replay:
+            self.replay.paused = pause
 
-        def checkIndices(device, startIdx, endIdx):
-            # Check for index wraparound
-            if endIdx < startIdx:
-                padSyncBufferWithNans(device, startIdx, self.numPoints - 1)
-                padSyncBufferWithNans(device, 0, endIdx)
+    def setReplaySpeed(self):
+        if self.replay:
+            self.replay.speed = float(str(self.replaySpeed.currentText())
+                                      .rstrip("x"))
 
-            else:
-                padSyncBufferWithNans(device, startIdx, endIdx)
+    # Going back means the plot has to start over (the buffers only take
+    # pulses going forward), so it gets restarted either way
+    def seekReplay(self):
+        if not self.replay:
+            return
 
-        # if not self.bothPVsBSA:
-        #     self.synchronizedBuffers["A"] = self.rawBuffers["A"]
-        #     self.synchronizedBuffers["B"] = self.rawBuffers["B"]
-        #     return 0
+        self.replay.seek(self.replaySlider.value())
 
-        if syncByTime:
-            numBadShots = int(round((self.timeStamps["B"]
-                                     - self.timeStamps["A"])
-                                    * self.getRate()))
+        if not self.abort:
+            self.stop()
+            self.timer.singleShot(250, self.initializePlot)
 
-            startA, endA = rtbsaUtils.getIndices(numBadShots, 1)
-            startB, endB = rtbsaUtils.getIndices(numBadShots, -1)
+    def updateReplayControls(self):
+        if not self.replaySlider.isSliderDown():
+            self.replaySlider.setValue(int(self.replay.elapsed()))
+
+        self.replayTime.setText(" {E} / {D} ".format(
+            E=formatSeconds(self.replay.elapsed()),
+            D=formatSeconds(self.replay.recording.duration())))
+
+    def showMetrics(self, show):
+        self.metricsLabel.setVisible(show)
+        self.metricsLabel.setText("Waiting for metrics...")
+        self.metricsLabel.adjustSize()
+        self.updateMetricsTimer()
+
+    # The metrics only need rolling over if somebody's looking at them
+    def updateMetricsTimer(self):
+        if not self.metricsLabel.isHidden() or self.metricsExporter:
+            if not self.metricsTimer.isActive():
+                self.metricsTimer.start(1000)
+        else:
+            self.metricsTimer.stop()
 
-            self.synchronizedBuffers["A"] = self.rawBuffers["A"][startA:endA]
-            self.synchronizedBuffers["B"] = self.rawBuffers["B"][startB:endB]
+    def updateMetrics(self):
+        report = self.core.metrics.rollover(self.core.missedPulses())
 
-            return abs(numBadShots)
+        if not self.metricsLabel.isHidden():
+            self.metricsLabel.setText(describe(report).replace(" | ", "\n"))
+            self.metricsLabel.adjustSize()
 
-        else:
+        if self.metricsExporter:
+            self.metricsExporter.export(report)
 
-            self.synchronizedBuffers["A"] = self.rawBuffers["A"]
-            self.synchronizedBuffers["B"] = self.rawBuffers["B"]
+    # noinspection PyTypeChecker
+    def genTimePlotA(self):
+        data = self.core.startTimeSeries(self.devices["A"])
 
-            # The timestamps and indices get updated by the callbacks, so we
-            # store the values at the time of buffer-copying
-            timeStampA = self.timeStamps["A"]
-            timeStampB = self.timeStamps["B"]
+        if data is not None and self.core.longHistory():
+            self.genLongTimePlotA()
 
-            if not timeStampA or not timeStampB:
-                return 0
+        elif data is not None:
 
-            currIdxA = self.currIdx["A"]
-            currIdxB = self.currIdx["B"]
+            self.plotAttributes["curve"] = PlotCurveItem(data, pen=1)
+            self.plot.addItem(self.plotAttributes["curve"])
 
-            diff = timeStampA - timeStampB
+            self.plotFit(arange(self.core.numPoints), data, self.devices["A"])
 
-            if diff > 0:
-                checkIndices("A", currIdxB, currIdxA)
+        else:
+            self.stop()
+            self.printStatus("Device invalid - aborting", True)
 
-            elif diff < 0:
-                checkIndices("B", currIdxA, currIdxB)
+    ############################################################################
+    # A vs time for more pulses than the ring buffer holds. Rather than every
+    # pulse, each point is the mean of a bin of them (see TieredHistory), with
+    # the band around it showing the bin's min and max, and the bins get finer
+    # as you zoom in (with autoscale off) until they're single pulses again.
+    ############################################################################
+    def genLongTimePlotA(self):
+        self.historyFactor = None
 
-            return 0
+        self.plotAttributes["lower"] = PlotCurveItem(pen=(100, 100, 255, 100))
+        self.plotAttributes["upper"] = PlotCurveItem(pen=(100, 100, 255, 100))
+        self.plotAttributes["band"] = FillBetweenItem(
+            self.plotAttributes["lower"], self.plotAttributes["upper"],
+            brush=(100, 100, 255, 50))
 
-    def genPlotAndSetTimer(self, genPlot, updateMethod):
-        if self.abort:
-            return
+        for item in ("lower", "upper", "band"):
+            self.plot.addItem(self.plotAttributes[item])
 
-        try:
-            genPlot()
-        except UnboundLocalError:
-            self.printStatus('No Data, Aborting Plotting Algorithm')
-            return
+        self.plotAttributes["curve"] = PlotCurveItem(pen=1)
 
-        self.timer = QTimer(self)
+        window = self.core.historyWindow()
 
-        # Run updateMethod every updatetime milliseconds
-        self.timer.singleShot(self.updateTime, updateMethod)
+        if window is None:
+            xData = arange(2) * (self.core.historyPoints - 1)
+            yData = empty(2)
+            yData[:] = nan
+        else:
+            xData, yData = window.pulses, window.means
 
-        self.printStatus('Running')
+        self.plotFit(xData, yData, self.devices["A"])
 
     # noinspection PyTypeChecker
-    def genTimePlotA(self):
-        newData = self.initializeData()
+    def drawLongTimePlotA(self, frame):
+        drawStart = time()
+        self.plotAttributes["curve"].setData(frame.x, frame.y,
+                                             connect="finite")
+        self.plotAttributes["lower"].setData(*frame.lower, connect="finite")
+        self.plotAttributes["upper"].setData(*frame.upper, connect="finite")
+        self.core.metrics.record("draw", time() - drawStart)
+
+        if frame.factor != self.historyFactor:
+            self.historyFactor = frame.factor
+            self.plot.setTitle("{A} ({F} pulse bins)".format(
+                A=self.devices["A"], F=frame.factor))
+
+        labels = frame.labels
+        start, end = labels.minX, labels.maxX
 
-        if newData is not None:
-            data = newData[:self.numPoints]
+        if self.ui.checkBoxAutoscale.isChecked():
+            self.plot.setYRange(labels.minY, labels.maxY)
+            self.plot.setXRange(0, self.core.historyPoints)
 
-            self.plotAttributes["curve"] = PlotCurveItem(data, pen=1)
-            self.plot.addItem(self.plotAttributes["curve"])
+        if self.ui.checkBoxShowAve.isChecked():
+            rtbsaUtils.setPosAndText(self.text["avg"], labels.mean, start,
+                                     labels.minY, 'AVG: ')
 
-            self.plotFit(arange(self.numPoints), data, self.devices["A"])
+        if self.ui.checkBoxShowStdDev.isChecked():
+            rtbsaUtils.setPosAndText(self.text["std"], labels.std,
+                                     start + (end - start) / 4, labels.minY,
+                                     'STD: ')
 
-        else:
-            self.stop()
-            self.printStatus("Device invalid - aborting", True)
+        self.drawFit(frame.fit, start + (end - start) / 2, labels.minY)
 
     ############################################################################
     # This is the main plotting function for "Plot A vs Time" that gets called
-    # every self.updateTime seconds
-    # noinspection PyTypeChecker
+    # whenever new data comes in (see scheduleFrame)
     ############################################################################
     def updateTimePlotA(self):
 
         if not self.checkPlotStatus():
             return
 
-        xData, yData = self.filterTimePlotBuffer()
+        if self.core.longHistory():
+            self.requestFrame(self.core.historyFrame, self.drawLongTimePlotA)
+        else:
+            self.requestFrame(self.core.timeSeriesFrame, self.drawTimePlotA)
 
-        if yData.size:
-            self.plotAttributes["curve"].setData(yData)
-            if self.ui.checkBoxAutoscale.isChecked():
-                mx = max(yData)
-                mn = min(yData)
-                if mx - mn > .00001:
-                    self.plot.setYRange(mn, mx)
-                    self.plot.setXRange(0, len(yData))
+    # noinspection PyTypeChecker
+    def drawTimePlotA(self, frame):
+        start = time()
+        self.plotAttributes["curve"].setData(frame.x, frame.y)
+        self.core.metrics.record("draw", time() - start)
 
-            if self.ui.checkBoxShowAve.isChecked():
-                rtbsaUtils.setPosAndText(self.text["avg"], mean(yData), 0,
-                                         min(yData), 'AVG: ')
+        labels = frame.labels
+        numPoints = self.core.numPoints
 
-            if self.ui.checkBoxShowStdDev.isChecked():
-                rtbsaUtils.setPosAndText(self.text["std"], std(yData),
-                                         self.numPoints / 4, min(yData),
-                                         'STD: ')
+        if self.ui.checkBoxAutoscale.isChecked():
+            if labels.maxY - labels.minY > .00001:
+                self.plot.setYRange(labels.minY, labels.maxY)
+                self.plot.setXRange(0, numPoints)
 
-            if self.ui.checkBoxCorrCoeff.isChecked():
-                self.text["corr"].setText('')
+        if self.ui.checkBoxShowAve.isChecked():
+            rtbsaUtils.setPosAndText(self.text["avg"], labels.mean, 0,
+                                     labels.minY, 'AVG: ')
 
-            if self.ui.checkBoxLinFit.isChecked():
-                self.text["slope"].setPos(self.numPoints / 2, min(yData))
-                self.getLinearFit(xData, yData, True)
+        if self.ui.checkBoxShowStdDev.isChecked():
+            rtbsaUtils.setPosAndText(self.text["std"], labels.std,
+                                     numPoints / 4, labels.minY, 'STD: ')
 
-            elif self.ui.checkBoxPolyFit.isChecked():
-                self.text["slope"].setPos(self.numPoints / 2, min(yData))
-                self.getPolynomialFit(xData, yData, True)
+        if self.ui.checkBoxCorrCoeff.isChecked():
+            self.text["corr"].setText('')
 
-        self.timer.singleShot(self.updateTime, self.updateTimePlotA)
+        self.drawFit(frame.fit, numPoints / 2, labels.minY)
 
-    def checkPlotStatus(self):
-        QApplication.processEvents()
+    # How many standard deviations to cut at, or None if the filter's off
+    def numStdDevs(self):
+        if self.ui.checkBoxStdDev.isChecked():
+            return self.stdDevstoKeep
+        return None
 
-        if self.abort:
+    def checkPlotStatus(self):
+        if self.abort or self.renderPaused:
             return False
 
-        self.waitForRate()
-
-        # kill switch to stop backgrounded, forgetten GUIs. Somewhere in the
-        # ballpark of 20 minutes assuming 120Hz
-        if self.counter["A"] > 150000:
+        # kill switch to stop backgrounded, forgetten GUIs
+        if self.core.inactive():
             self.stop()
             self.printStatus("Stopping due to inactivity")
 
         return True
 
-    def filterTimePlotBuffer(self):
-        currIdx = self.currIdx["A"]
-        choppedBuffer = self.rawBuffers["A"][:self.numPoints]
-
-        # All this nonsense to make it scroll :P Thanks to Ben for the
-        # inspiration!
-        if currIdx > 0:
-            choppedBuffer = concatenate([choppedBuffer[currIdx:],
-                                         choppedBuffer[:currIdx]])
-
-        xData, yData = rtbsaUtils.filterBuffers(choppedBuffer,
-                                                lambda x: ~isnan(x),
-                                                arange(self.numPoints),
-                                                choppedBuffer)
-
-        if self.devices["A"] == "BLEN:LI24:886:BIMAX":
-            xData, yData = rtbsaUtils.filterBuffers(yData,
-                                                    lambda x:
-                                                    x < rtbsaUtils.IPK_LIMIT,
-                                                    xData, yData)
-
-        if self.ui.checkBoxStdDev.isChecked():
-            stdDevFilterFunc = self.StdDevFilterFunc(mean(yData), std(yData))
-            xData, yData = rtbsaUtils.filterBuffers(yData, stdDevFilterFunc,
-                                                    xData, yData)
-        return xData, yData
-
-    def getLinearFit(self, xData, yData, updateExistingPlot):
-        # noinspection PyTupleAssignmentBalance
-        m, b = polyfit(xData, yData, 1)
-        fitData = polyval([m, b], xData)
-
-        self.text["slope"].setText('Slope: ' + str("{:.3e}".format(m)))
-
-        if updateExistingPlot:
-            self.plotAttributes["fit"].setData(xData, fitData)
-        else:
-            # noinspection PyTypeChecker
-            self.plotAttributes["fit"] = PlotCurveItem(xData, fitData, 'g-',
-                                                       linewidth=1)
-
-    def getPolynomialFit(self, xData, yData, updateExistingPlot):
-        co = polyfit(xData, yData, self.fitOrder)
-        pol = poly1d(co)
-        xDataSorted = sorted(xData)
-        fit = pol(xDataSorted)
+    # Draws fit (see BSACore.fitFor) into whichever fit curve is showing, with
+    # the slope label at (x, y)
+    def drawFit(self, fit, x, y):
+        if fit is None:
+            return
 
-        if updateExistingPlot:
-            self.plotAttributes["parab"].setData(xDataSorted, fit)
+        start = time()
+        if self.ui.checkBoxLinFit.isChecked():
+            self.plotAttributes["fit"].setData(fit.x, fit.y)
         else:
-            # noinspection PyTypeChecker
-            self.plotAttributes["parab"] = PlotCurveItem(xDataSorted, fit,
-                                                         pen=3, size=2)
+            self.plotAttributes["parab"].setData(fit.x, fit.y)
+        self.core.metrics.record("draw", time() - start)
 
-        if self.fitOrder == 2:
-            self.text["slope"].setText('Peak: ' + str(-co[1] / (2 * co[0])))
+        self.text["slope"].setPos(x, y)
 
-        elif self.fitOrder == 3:
-            self.text["slope"].setText(str("{:.2e}".format(co[0])) + 'x^3'
-                                       + str("+{:.2e}".format(co[1]))
-                                       + 'x^2'
-                                       + str("+{:.2e}".format(co[2])) + 'x'
-                                       + str("+{:.2e}".format(co[3])))
+        if fit.text is not None:
+            self.text["slope"].setText(fit.text)
 
     def genPlotAB(self):
-        self.filterNans()
+        if self.coherenceMode:
+            self.genPlotCoherence()
+            return
 
-        if self.ui.checkBoxStdDev.isChecked():
-            self.plotCurveAndFit(self.filteredBuffers["A"],
-                                 self.filteredBuffers["B"])
-        else:
-            self.plotCurveAndFit(self.synchronizedBuffers["A"],
-                                 self.synchronizedBuffers["B"])
+        self.core.populateSynchronizedBuffers()
+        self.plotCurveAndFit(
+            *self.core.filterSynchronizedBuffers(self.numStdDevs()))
 
     def plotCurveAndFit(self, xData, yData):
         # noinspection PyTypeChecker
@@ -891,191 +1005,371 @@ class RTBSA(QMainWindow):
         self.plot.addItem(self.plotAttributes["curve"])
         self.plot.setTitle(title)
 
+        stats = BufferStats(xData, yData)
+        fit = self.core.fitFor(self.frameSettings(), stats, stats.minX(),
+                               stats.maxX())
+
+        if fit is None:
+            return
+
         # Fit line
         if self.ui.checkBoxLinFit.isChecked():
-            self.getLinearFit(xData, yData, False)
+            # noinspection PyTypeChecker
+            self.plotAttributes["fit"] = PlotCurveItem(fit.x, fit.y, 'g-',
+                                                       linewidth=1)
             self.plot.addItem(self.plotAttributes["fit"])
 
         # Fit polynomial
-        elif self.ui.checkBoxPolyFit.isChecked():
+        else:
             self.ui.fitOrder.setDisabled(False)
-            try:
-                self.getPolynomialFit(xData, yData, False)
-                self.plot.addItem(self.plotAttributes["parab"])
-            except linalg.linalg.LinAlgError:
-                print "Error getting polynomial fit"
+            # noinspection PyTypeChecker
+            self.plotAttributes["parab"] = PlotCurveItem(fit.x, fit.y, pen=3,
+                                                         size=2)
+            self.plot.addItem(self.plotAttributes["parab"])
+
+        if fit.text is not None:
+            self.text["slope"].setText(fit.text)
 
     ############################################################################
     # This is the main plotting function for "Plot B vs A" that gets called
-    # every self.updateTime milliseconds
+    # whenever new data comes in (see scheduleFrame)
     ############################################################################
     def updatePlotAB(self):
         if not self.checkPlotStatus():
             return
 
-        QApplication.processEvents()
+        if self.coherenceMode:
+            self.requestFrame(self.core.coherenceFrame,
+                              self.drawPlotCoherence)
+        else:
+            self.requestFrame(self.core.pairFrame, self.drawPlotAB)
 
-        self.adjustSynchronizedBuffers()
-        self.filterNans()
-        if self.user == "physics":
-            self.filterPeakCurrent()
+    ############################################################################
+    # The coherence of B with A against frequency (on the left axis, 0 to 1),
+    # i.e. how much of B's power at each frequency moves in step with A, so a
+    # phase or RF line driving a BPM stands out where the single correlation
+    # coefficient would wash it out. The dashed line is the coherence noise
+    # alone gets above one time in 20. Where the coherence is above that line,
+    # the phase of B relative to A is drawn as dots against the right axis.
+    # Updated as segments complete (see BSACore.crossSpectrum)
+    ############################################################################
+    def genPlotCoherence(self):
+        plotItem = self.plot.getPlotItem()
 
-        if self.ui.checkBoxStdDev.isChecked():
-            self.filterStdDev()
-            self.updateLabelsAndFit(self.filteredBuffers["A"],
-                                    self.filteredBuffers["B"])
-        else:
-            self.updateLabelsAndFit(self.synchronizedBuffers["A"],
-                                    self.synchronizedBuffers["B"])
+        # noinspection PyTypeChecker
+        self.plotAttributes["curve"] = PlotCurveItem(pen=1, connect="finite")
+        self.plot.addItem(self.plotAttributes["curve"])
 
-        self.timer.singleShot(self.updateTime, self.updatePlotAB)
+        self.plotAttributes["threshold"] = InfiniteLine(
+            angle=0, movable=False, pen=mkPen('g', style=Qt.DashLine))
+        self.plot.addItem(self.plotAttributes["threshold"])
+
+        # The phase gets a view box of its own, laid over the plot's and
+        # sharing its x axis
+        phaseView = ViewBox()
+        plotItem.showAxis("right")
+        plotItem.scene().addItem(phaseView)
+        plotItem.getAxis("right").linkToView(phaseView)
+        plotItem.getAxis("right").setLabel("phase (deg)")
+        phaseView.setXLink(plotItem)
+        phaseView.setYRange(-180, 180)
+        plotItem.vb.sigResized.connect(self.updatePhaseView)
+
+        self.plotAttributes["phase"] = ScatterPlotItem(size=4, pen=None,
+                                                       brush=(255, 200, 0))
+        phaseView.addItem(self.plotAttributes["phase"])
+        self.plotAttributes["phaseView"] = phaseView
+        self.updatePhaseView()
+
+        self.plot.setTitle("Coherence of {B} with {A}"
+                           .format(A=self.devices["A"], B=self.devices["B"]))
+        self.plot.setYRange(0, 1)
+
+        self.drawNow(self.core.coherenceFrame, self.drawPlotCoherence, True)
+
+    def updatePhaseView(self):
+        viewBox = self.plot.getViewBox()
+        phaseView = self.plotAttributes["phaseView"]
+        phaseView.setGeometry(viewBox.sceneBoundingRect())
+        phaseView.linkedViewChanged(viewBox, phaseView.XAxis)
+
+    def drawPlotCoherence(self, frame):
+        frequencies = frame.frequencies
+
+        start = time()
+        self.plotAttributes["curve"].setData(frequencies, frame.coherence)
+        self.plotAttributes["threshold"].setValue(frame.threshold)
+        self.plotAttributes["phase"].setData(frame.phaseFrequencies,
+                                             frame.phases)
+        self.core.metrics.record("draw", time() - start)
+
+        self.plot.setTitle("Coherence of {B} with {A} ({N} segments)"
+                           .format(A=self.devices["A"], B=self.devices["B"],
+                                   N=frame.count))
 
-    def filterNans(self):
-        def filterFunc(x): return ~isnan(x)
+        if self.ui.checkBoxAutoscale.isChecked():
+            self.plot.setXRange(frequencies[0], frequencies[-1])
+            self.plot.setYRange(0, 1)
 
-        self.filterData(self.synchronizedBuffers["A"], filterFunc, True)
-        self.filterData(self.synchronizedBuffers["B"], filterFunc, True)
+    def showCoherence(self, checked):
+        self.coherenceMode = checked
 
-    # Need to filter out errant indices from both buffers to keep them
-    # synchronized
-    def filterData(self, dataBuffer, filterFunc, changeOriginal):
-        bufferA, bufferB = rtbsaUtils.filterBuffers(dataBuffer, filterFunc,
-                                                    self.synchronizedBuffers["A"],
-                                                    self.synchronizedBuffers["B"])
+        if self.ui.checkBoxBvsA.isChecked() and not self.abort:
+            self.reinitialize_plot()
 
-        if changeOriginal:
-            self.synchronizedBuffers["A"] = bufferA
-            self.synchronizedBuffers["B"] = bufferB
-        else:
-            self.filteredBuffers["A"] = bufferA
-            self.filteredBuffers["B"] = bufferB
+    # noinspection PyTypeChecker
+    def drawPlotAB(self, frame):
 
-    # This PV gets insane values, apparently
-    def filterPeakCurrent(self):
-        def filterFunc(x):
-            return x < rtbsaUtils.IPK_LIMIT
+        start = time()
+        self.plotAttributes["curve"].setData(frame.x, frame.y)
+        self.core.metrics.record("draw", time() - start)
 
-        if self.devices["A"] == "BLEN:LI24:886:BIMAX":
-            self.filterData(self.synchronizedBuffers["A"], filterFunc, True)
-        if self.devices["B"] == "BLEN:LI24:886:BIMAX":
-            self.filterData(self.synchronizedBuffers["B"], filterFunc, True)
+        labels = frame.labels
 
-    def filterStdDev(self):
+        if labels is None:
+            return
 
-        bufferA = self.synchronizedBuffers["A"]
-        bufferB = self.synchronizedBuffers["B"]
+        minBufferA = labels.minX
+        minBufferB = labels.minY
+        maxBufferA = labels.maxX
+        maxBufferB = labels.maxY
 
-        self.filterData(bufferA, self.StdDevFilterFunc(mean(bufferA),
-                                                       std(bufferA)), False)
+        if self.ui.checkBoxAutoscale.isChecked():
+            self.setPlotRanges(minBufferA, maxBufferA, minBufferB, maxBufferB)
 
-        self.filterData(bufferB, self.StdDevFilterFunc(mean(bufferB),
-                                                       std(bufferB)), False)
+        if self.ui.checkBoxShowAve.isChecked():
+            rtbsaUtils.setPosAndText(self.text["avg"], labels.mean, minBufferA,
+                                     minBufferB, 'AVG: ')
 
-    def StdDevFilterFunc(self, average, stdDev):
-        return lambda x: abs(x - average) < self.stdDevstoKeep * stdDev
+        if self.ui.checkBoxShowStdDev.isChecked():
+            xPos = (minBufferA + (minBufferA + maxBufferA) / 2) / 2
 
-    # noinspection PyTypeChecker
-    def updateLabelsAndFit(self, bufferA, bufferB):
+            rtbsaUtils.setPosAndText(self.text["std"], labels.std, xPos,
+                                     minBufferB, 'STD: ')
 
-        self.plotAttributes["curve"].setData(bufferA, bufferB)
+        if self.ui.checkBoxCorrCoeff.isChecked():
+            rtbsaUtils.setPosAndText(self.text["corr"], labels.corr,
+                                     minBufferA, maxBufferB,
+                                     "Corr. Coefficient: ")
 
-        try:
-            if self.ui.checkBoxAutoscale.isChecked():
-                self.setPlotRanges(bufferA, bufferB)
+        self.drawFit(frame.fit, (minBufferA + maxBufferA) / 2, minBufferB)
+
+    def setPlotRanges(self, minBufferA, maxBufferA, minBufferB, maxBufferB):
+        if minBufferB != maxBufferB:
+            self.plot.setYRange(minBufferB, maxBufferB)
 
-            minBufferA = nanmin(bufferA)
-            minBufferB = nanmin(bufferB)
-            maxBufferA = nanmax(bufferA)
-            maxBufferB = nanmax(bufferB)
+        if minBufferA != maxBufferA:
+            self.plot.setXRange(minBufferA, maxBufferA)
 
-            if self.ui.checkBoxShowAve.isChecked():
-                rtbsaUtils.setPosAndText(self.text["avg"], nanmean(bufferB),
-                                         minBufferA,
-                                         minBufferB, 'AVG: ')
+    def InitializeFFTPlot(self):
+        data = self.core.startTimeSeries(self.devices["A"])
+
+        if data is None:
+            self.stop()
+            self.printStatus("Device invalid - aborting", True)
+            return
 
-            if self.ui.checkBoxShowStdDev.isChecked():
-                xPos = (minBufferA + (minBufferA + maxBufferA) / 2) / 2
+        self.genSpectrum(data)
 
-                rtbsaUtils.setPosAndText(self.text["std"], nanstd(bufferB),
-                                         xPos, minBufferB, 'STD: ')
+    # Sets up the plot for whichever spectrum is picked in the View menu. data
+    # is device A's last numPoints values, which only the periodogram uses
+    def genSpectrum(self, data):
+        if self.spectrumMode == "welch":
+            self.genPlotWelch()
+        elif self.spectrumMode == "spectrogram":
+            self.genPlotSpectrogram()
+        else:
+            self.genPlotFFT(data)
 
-            if self.ui.checkBoxCorrCoeff.isChecked():
-                correlation = corrcoef(bufferA, bufferB)
-                rtbsaUtils.setPosAndText(self.text["corr"], correlation.item(1),
-                                         minBufferA, maxBufferB,
-                                         "Corr. Coefficient: ")
+    def setSpectrumMode(self, mode):
+        if mode == self.spectrumMode:
+            return
 
-            if self.ui.checkBoxLinFit.isChecked():
-                self.text["slope"].setPos((minBufferA + maxBufferA) / 2,
-                                          minBufferB)
-                self.getLinearFit(bufferA, bufferB, True)
+        self.spectrumMode = mode
 
-            elif self.ui.checkBoxPolyFit.isChecked():
-                self.text["slope"].setPos((minBufferA + maxBufferA) / 2,
-                                          minBufferB)
-                self.getPolynomialFit(bufferA, bufferB, True)
+        if self.ui.checkBoxFFT.isChecked() and not self.abort:
+            self.reinitialize_plot()
 
-        except ValueError:
+    def genPlotFFT(self, data):
+        spectrum = self.core.powerSpectrum(data)
+
+        if spectrum is None:
             return
 
-    def setPlotRanges(self, bufferA, bufferB):
-        mx = nanmax(bufferB)
-        mn = nanmin(bufferB)
+        frequencies, ps = spectrum
 
-        if mn != mx:
-            self.plot.setYRange(mn, mx)
+        # noinspection PyTypeChecker
+        self.plotAttributes["curve"] = PlotCurveItem(x=frequencies, y=ps, pen=1)
+        self.plot.addItem(self.plotAttributes["curve"])
+        self.plot.setTitle(self.devices["A"])
 
-        mx = nanmax(bufferA)
-        mn = nanmin(bufferA)
+    # Only called when there have been new pulses since the last one (see
+    # BSACore.periodogramFrame)
+    def drawPlotFFT(self, frame):
+        start = time()
+        self.plotAttributes["curve"].setData(frame.x, frame.y)
+        self.core.metrics.record("draw", time() - start)
 
-        if mn != mx:
-            self.plot.setXRange(mn, mx)
+        labels = frame.labels
 
-    def InitializeFFTPlot(self):
-        self.genPlotFFT(self.initializeData(), False)
+        if self.ui.checkBoxAutoscale.isChecked():
+            if labels.maxY - labels.minY > .00001:
+                self.plot.setYRange(labels.minY, labels.maxY)
+                self.plot.setXRange(labels.minX, labels.maxX)
 
-    # TODO I have no idea what's happening here
-    def genPlotFFT(self, newdata, updateExistingPlot):
+    ############################################################################
+    # The Welch averaged PSD of device A in dB, which only changes when another
+    # segment completes (see BSACore.welchSpectrum), so it doesn't jump around
+    # from frame to frame the way the periodogram of the whole window does.
+    # The DC bin is left off, since the mean's been taken out of it.
+    ############################################################################
+    def genPlotWelch(self):
+        # noinspection PyTypeChecker
+        self.plotAttributes["curve"] = PlotCurveItem(pen=1, connect="finite")
+        self.plot.addItem(self.plotAttributes["curve"])
+        self.plot.setTitle("{A} (averaged PSD, dB/Hz)"
+                           .format(A=self.devices["A"]))
+
+        # Whatever we have, even if no segments have completed since the last
+        # time
+        self.drawNow(self.core.welchFrame, self.drawPlotWelch, True)
+
+    def drawPlotWelch(self, frame):
+        start = time()
+        self.plotAttributes["curve"].setData(frame.x, frame.y)
+        self.core.metrics.record("draw", time() - start)
+
+        labels = frame.labels
+
+        if self.ui.checkBoxAutoscale.isChecked() and labels is not None:
+            self.plot.setYRange(labels.minY, labels.maxY)
+            self.plot.setXRange(labels.minX, labels.maxX)
+
+    ############################################################################
+    # The Welch segments' PSDs over time, as an image with frequency along the
+    # bottom and how many seconds ago up the side (newest at the top), so lines
+    # that come and go or drift show up. The color scale only follows the data
+    # while autoscale is on.
+    ############################################################################
+    def genPlotSpectrogram(self):
+        # Dark blue for the quietest through purple to yellow for the loudest
+        colorMap = ColorMap([0.0, 0.5, 1.0], [(0, 0, 80, 255),
+                                              (200, 0, 120, 255),
+                                              (255, 255, 0, 255)])
+
+        self.plotAttributes["matrix"] = ImageItem()
+        self.plotAttributes["matrix"].setLookupTable(colorMap.getLookupTable())
+        self.plot.addItem(self.plotAttributes["matrix"])
 
-        if not newdata.size:
-            return None
+        self.plot.setTitle("{A} (spectrogram, dB/Hz vs seconds ago)"
+                           .format(A=self.devices["A"]))
 
-        newdata = newdata[:self.numPoints]
+        self.plotAttributes["levels"] = None
+        self.drawNow(self.core.spectrogramFrame, self.drawSpectrogram, True)
 
-        nans, x = isnan(newdata), lambda z: z.nonzero()[0]
-        # interpolate nans
-        newdata[nans] = interp(x(nans), x(~nans), newdata[~nans])
-        # remove DC component
-        newdata = newdata - mean(newdata)
+    def drawSpectrogram(self, frame):
+        self.plotAttributes["levels"] = frame.levels
 
-        newdata = concatenate([newdata, zeros(self.numPoints * 2)])
+        start = time()
+        matrix = self.plotAttributes["matrix"]
+        # The image's first axis goes along the bottom
+        matrix.setImage(frame.image.T, levels=frame.levels, autoLevels=False)
+        matrix.setRect(QRectF(*frame.rect))
+        self.core.metrics.record("draw", time() - start)
 
-        ps = abs(fft.fft(newdata)) / newdata.size
+        if self.ui.checkBoxAutoscale.isChecked():
+            self.plot.setXRange(0, frame.maxFrequency)
+            self.plot.setYRange(frame.rect[1], 0)
 
-        self.waitForRate()
-        frequencies = fft.fftfreq(newdata.size, 1.0 / self.getRate())
-        keep = (frequencies >= 0)
-        ps = ps[keep]
-        frequencies = frequencies[keep]
-        idx = argsort(frequencies)
+    ############################################################################
+    # Correlation matrix mode. Plots every PV selected in device A's list (or,
+    # if fewer than two are selected, all of the common PVs) against every
+    # other one (see BSACore.startMatrix)
+    ############################################################################
+    def initializeMatrix(self):
+        selected = self.selectedPVs("A")
 
-        if updateExistingPlot:
-            self.plotAttributes["curve"].setData(x=frequencies[idx], y=ps[idx])
+        if len(selected) >= 2:
+            self.core.startMatrix(selected)
+        elif self.replay and len(self.replay.recording.pvs) >= 2:
+            self.core.startMatrix(self.replay.recording.pvs)
+        elif self.user == "spear":
+            self.core.startMatrix(rtbsaUtils.commonListSPEAR)
         else:
-            # noinspection PyTypeChecker
-            self.plotAttributes["curve"] = PlotCurveItem(x=frequencies[idx],
-                                                         y=ps[idx], pen=1)
+            self.core.startMatrix(rtbsaUtils.commonListLCLS)
 
-        self.plot.addItem(self.plotAttributes["curve"])
-        self.plot.setTitle(self.devices["A"])
-        self.plotAttributes["frequencies"] = frequencies
+    def genPlotMatrix(self):
+        matrixDevices = self.core.matrixDevices
+        numDevices = len(matrixDevices)
+
+        # Blue for -1, white for 0 and red for 1
+        colorMap = ColorMap([0.0, 0.5, 1.0], [(0, 0, 255, 255),
+                                              (255, 255, 255, 255),
+                                              (255, 0, 0, 255)])
+
+        self.plotAttributes["matrix"] = ImageItem()
+        self.plotAttributes["matrix"].setLookupTable(colorMap.getLookupTable())
+        self.plot.addItem(self.plotAttributes["matrix"])
 
-        return ps
+        # Names along the side, and just their indices along the bottom where
+        # there's no room for them
+        self.plot.getAxis("left").setTicks(
+            [[(row + 0.5, "{I}: {D}".format(I=row, D=device))
+              for row, device in enumerate(matrixDevices)]])
+        self.plot.getAxis("bottom").setTicks(
+            [[(row + 0.5, str(row)) for row in xrange(numDevices)]])
+
+        self.plot.setTitle("Correlation Matrix ({N} PVs)"
+                           .format(N=numDevices))
+        self.plot.setXRange(0, numDevices)
+        self.plot.setYRange(0, numDevices)
+
+        self.drawNow(self.core.matrixFrame, self.drawMatrixImage)
+
+    ############################################################################
+    # This is the main plotting function for "Plot Correlation Matrix" that gets
+    # called whenever new data comes in (see scheduleFrame)
+    ############################################################################
+    def updatePlotMatrix(self):
+        if not self.checkPlotStatus():
+            return
+
+        self.requestFrame(self.core.matrixFrame, self.drawPlotMatrix)
+
+    def drawPlotMatrix(self, frame):
+        self.drawMatrixImage(frame)
+
+        if frame.strongest:
+            self.statusBar().showMessage(
+                "{D} correlates most with ".format(
+                    D=self.core.matrixDevices[0])
+                + ", ".join("{P} ({R:.2f})".format(P=device, R=coefficient)
+                            for device, coefficient in frame.strongest))
+
+    # Pairs without enough data get drawn as 0 (white)
+    def drawMatrixImage(self, frame):
+        start = time()
+        self.plotAttributes["matrix"].setImage(frame.image, levels=(-1, 1),
+                                               autoLevels=False)
+        self.core.metrics.record("draw", time() - start)
 
     # noinspection PyTypeChecker
     def cleanPlot(self):
         self.plot.clear()
 
+        # The coherence plot's phase axis
+        phaseView = self.plotAttributes["phaseView"]
+        if phaseView:
+            plotItem = self.plot.getPlotItem()
+            plotItem.vb.sigResized.disconnect(self.updatePhaseView)
+            plotItem.scene().removeItem(phaseView)
+            plotItem.hideAxis("right")
+            self.plotAttributes["phaseView"] = None
+
+        # The correlation matrix labels its axes with PV names
+        self.plot.getAxis("left").setTicks(None)
+        self.plot.getAxis("bottom").setTicks(None)
+
         self.text["avg"] = TextItem('', color=(200, 200, 250), anchor=(0, 1))
         self.text["std"] = TextItem('', color=(200, 200, 250), anchor=(0, 1))
         self.text["slope"] = TextItem('', color=(200, 200, 250), anchor=(0, 1))
@@ -1087,54 +1381,21 @@ class RTBSA(QMainWindow):
         for plotLabel in plotLabels:
             self.plot.addItem(plotLabel)
 
-    def initializeData(self):
-        self.printStatus("Initializing {A} buffer..."
-                         .format(A=self.devices["A"]), True)
-
-        if self.user == "physics":
-            # Initializing our data by putting a callback on the history buffer
-            # PV
-            hstbrConnected = self.clearAndUpdateCallback("A", "HSTBR",
-                                                         self.callbackA,
-                                                         self.devices["A"],
-                                                         True)
-
-            if hstbrConnected:
-                while (not self.timeStamps["A"]) and not self.abort:
-                    QApplication.processEvents()
-
-        # Removing that callback and manually appending new values to our local
-        # data buffer using the usual PV
-        if not self.clearAndUpdateCallback("A", "", self.callbackA,
-                                           self.devices["A"]):
-            return None
-
-        if self.user == "spear":
-            sleep(2)
-
-        # This was populated in the callback function
-        return self.rawBuffers["A"]
-
     ############################################################################
     # This is the main plotting function for "Plot A FFT" that gets called
-    # every self.updateTime seconds
+    # whenever new data comes in (see scheduleFrame)
     ############################################################################
     def updatePlotFFT(self):
         if not self.checkPlotStatus():
             return
 
-        ps = self.genPlotFFT(self.rawBuffers["A"], True)
-
-        if self.ui.checkBoxAutoscale.isChecked():
-            mx = max(ps)
-            mn = min(ps)
-            if mx - mn > .00001:
-                frequencies = self.plotAttributes["frequencies"]
-                self.plot.setYRange(mn, mx)
-                # noinspection PyTypeChecker
-                self.plot.setXRange(min(frequencies), max(frequencies))
-
-        self.timer.singleShot(self.updateTime, self.updatePlotFFT)
+        if self.spectrumMode == "welch":
+            self.requestFrame(self.core.welchFrame, self.drawPlotWelch)
+        elif self.spectrumMode == "spectrogram":
+            self.requestFrame(self.core.spectrogramFrame,
+                              self.drawSpectrogram)
+        else:
+            self.requestFrame(self.core.periodogramFrame, self.drawPlotFFT)
 
     def AvsTClick(self):
         if not self.ui.checkBoxAvsT.isChecked():
@@ -1142,6 +1403,7 @@ class RTBSA(QMainWindow):
         else:
             self.ui.checkBoxBvsA.setChecked(False)
             self.ui.checkBoxFFT.setChecked(False)
+            self.ui.checkBoxCorrMatrix.setChecked(False)
             self.AvsBClick()
 
     def AvsBClick(self):
@@ -1156,6 +1418,7 @@ class RTBSA(QMainWindow):
         else:
             self.ui.checkBoxAvsT.setChecked(False)
             self.ui.checkBoxFFT.setChecked(False)
+            self.ui.checkBoxCorrMatrix.setChecked(False)
             self.AvsTClick()
             self.ui.groupBoxB.setDisabled(False)
             self.ui.bsaListB.setDisabled(True)
@@ -1174,6 +1437,16 @@ class RTBSA(QMainWindow):
         else:
             self.ui.checkBoxBvsA.setChecked(False)
             self.ui.checkBoxAvsT.setChecked(False)
+            self.ui.checkBoxCorrMatrix.setChecked(False)
+            self.AvsBClick()
+
+    def corrMatrixClick(self):
+        if not self.ui.checkBoxCorrMatrix.isChecked():
+            pass
+        else:
+            self.ui.checkBoxAvsT.setChecked(False)
+            self.ui.checkBoxBvsA.setChecked(False)
+            self.ui.checkBoxFFT.setChecked(False)
             self.AvsBClick()
 
     def avg_click(self):
@@ -1244,7 +1517,7 @@ class RTBSA(QMainWindow):
             self.statusBar().showMessage('Enter an integer, 1-10', 6000)
             return
 
-        if self.fitOrder > 10 or self.fitOrder < 1:
+        if self.fitOrder > rtbsaUtils.MAX_FIT_ORDER or self.fitOrder < 1:
             self.statusBar().showMessage('Really?  That is going to be useful'
                                          + ' to you?  The (already ridiculous)'
                                          + ' range is 1-10.  Hope you win a '
@@ -1273,6 +1546,11 @@ class RTBSA(QMainWindow):
     # This is a mess, but it works (used if user changes number points,
     # fit type etc.)
     def reinitialize_plot(self):
+        # The plot gets set up on this thread, so nothing can be worked out in
+        # the background until it's done
+        renderMethod, self.renderMethod = self.renderMethod, None
+        self.analysisWorker.cancel()
+
         self.cleanPlot()
 
         # Setup for single PV plotting
@@ -1281,48 +1559,67 @@ class RTBSA(QMainWindow):
 
         elif self.ui.checkBoxBvsA.isChecked():
             self.genPlotAB()
+
+        elif self.ui.checkBoxCorrMatrix.isChecked():
+            self.genPlotMatrix()
         else:
-            self.genPlotFFT(self.synchronizedBuffers["A"], False)
+            self.genSpectrum(
+                self.core.rawBuffers["A"].snapshot(self.core.numPoints))
+
+        # Unless setting it up failed and stopped everything
+        if not self.abort:
+            self.renderMethod = renderMethod
 
     def logbook(self):
         rtbsaUtils.logbook('Python Real-Time BSA', 'BSA Data',
-                           str(self.numPoints) + ' points', self.plot.plotItem)
+                           str(self.core.numPoints) + ' points',
+                           self.plot.plotItem)
         self.statusBar().showMessage('Sent to LCLS Physics Logbook!', 10000)
 
     def MCCLog(self):
         rtbsaUtils.MCCLog('/tmp/RTBSA.png', '/tmp/RTBSA.ps', self.plot.plotItem)
 
-    def clearCallbacks(self, device):
-        if self.pvObjects[device]:
-            self.pvObjects[device].clear_callbacks()
-            self.pvObjects[device].disconnect()
-
     def stop(self):
+        self.analysisWorker.cancel()
+        missedPulses = self.core.stop()
+
+        self.abort = True
+        self.renderMethod = None
 
-        if self.pvObjects["A"]:
-            self.clearCallbacks("A")
+        self.statusBar().showMessage('Stopped ({N} missed pulses)'
+                                     .format(N=missedPulses))
 
-        if self.pvObjects["B"]:
-            self.clearCallbacks("B")
+        # The core stopped the recording along with everything else
+        self.record_action.setChecked(False)
 
-        self.abort = True
-        self.statusBar().showMessage('Stopped')
         self.ui.startButton.setDisabled(False)
-        self.rawBuffers["A"][:] = nan
-        self.rawBuffers["B"][:] = nan
         QApplication.processEvents()
 
-    def create_menu(self):
+    def create_menu(self, showMetrics=False):
 
         load_file_action = self.create_action("&Save plot", shortcut="Ctrl+S",
                                               slot=self.save_plot,
                                               tip="Save the plot")
 
+        self.record_action = self.create_action("&Record...",
+                                                slot=self.toggleRecording,
+                                                shortcut="Ctrl+R",
+                                                tip="Record the data to disk",
+                                                checkable=True,
+                                                signal="toggled(bool)")
+
         quit_action = self.create_action("&Quit", slot=self.close,
                                          shortcut="Ctrl+Q",
                                          tip="Close the application")
 
-        rtbsaUtils.add_actions(self.file_menu, (load_file_action, None,
+        open_action = self.create_action("&Open Recording...",
+                                         slot=self.openRecording,
+                                         shortcut="Ctrl+O",
+                                         tip="Play back a recording")
+
+        rtbsaUtils.add_actions(self.file_menu, (load_file_action,
+                                                self.record_action,
+                                                open_action, None,
                                                 quit_action))
 
         about_action = self.create_action("&About", shortcut='F1',
@@ -1330,6 +1627,45 @@ class RTBSA(QMainWindow):
 
         rtbsaUtils.add_actions(self.help_menu, (about_action,))
 
+        metrics_action = self.create_action("Show &Performance",
+                                            slot=self.showMetrics,
+                                            shortcut="Ctrl+P",
+                                            tip="Show frame rate and timings",
+                                            checkable=True,
+                                            signal="toggled(bool)")
+
+        coherence_action = self.create_action("A/B &Coherence",
+                                              slot=self.showCoherence,
+                                              shortcut="Ctrl+K",
+                                              tip="Plot the coherence and phase"
+                                                  " of B with A vs frequency",
+                                              checkable=True,
+                                              signal="toggled(bool)")
+
+        rtbsaUtils.add_actions(self.view_menu, (metrics_action,
+                                                coherence_action, None))
+
+        # Ticking it shows the overlay
+        metrics_action.setChecked(showMetrics)
+
+        # Which spectrum FFT mode draws, one at a time
+        spectrum_menu = self.view_menu.addMenu("&Spectrum")
+        spectrumGroup = QActionGroup(self)
+
+        for mode, text, tip in (
+                ("periodogram", "&Periodogram",
+                 "The spectrum of the whole window"),
+                ("welch", "&Welch Average",
+                 "The PSD averaged over overlapping segments"),
+                ("spectrogram", "Spectro&gram",
+                 "The PSDs of the segments over time")):
+            action = self.create_action(text, tip=tip, checkable=True,
+                                        slot=partial(self.setSpectrumMode,
+                                                     mode))
+            action.setChecked(mode == self.spectrumMode)
+            spectrumGroup.addAction(action)
+            spectrum_menu.addAction(action)
+
     def create_action(self, text, slot=None, shortcut=None, icon=None, tip=None,
                       checkable=False, signal="triggered()"):
 
@@ -1357,6 +1693,25 @@ class RTBSA(QMainWindow):
             self.ui.widgetPlot.canvas.print_figure(filePath, dpi=100)
             self.statusBar().showMessage('Saved to %s' % filePath, 2000)
 
+    # Records the PVs being plotted, from whatever's in the buffers now until
+    # it's unchecked or the plot is stopped (see rtbsaRecording)
+    def toggleRecording(self, record):
+        if not record:
+            self.core.stopRecording()
+            return
+
+        if self.abort:
+            self.statusBar().showMessage('Start a plot to record it', 10000)
+            self.record_action.setChecked(False)
+            return
+
+        # noinspection PyTypeChecker,PyCallByClass
+        directory = unicode(QFileDialog.getSaveFileName(
+            self, 'Record to', strftime('rtbsa-%Y%m%d-%H%M%S')))
+
+        if not directory or not self.core.startRecording(directory):
+            self.record_action.setChecked(False)
+
     def on_about(self):
         msg = ("Can you read this?  If so, congratulations. You are a magical, "
                + "marvelous troll.")
@@ -1364,11 +1719,161 @@ class RTBSA(QMainWindow):
         QMessageBox.about(self, "About", msg.strip())
 
 
+def formatSeconds(seconds):
+    return "{M}:{S:02d}".format(M=int(seconds) // 60, S=int(seconds) % 60)
+
+
 # TODO I bless the rains down in Africa!
 def main():
-    app = QApplication(argv)
-    window = RTBSA()
+    startupTimes = StartupTimes(STARTED)
+    startupTimes.mark("imports")
+
+    parser = ArgumentParser(description="Real Time BSA")
+    parser.add_argument("--max-fps", type=float,
+                        default=rtbsaUtils.MAX_FRAME_RATE,
+                        help="the most times per second to redraw the plot "
+                             "(default: %(default)s)")
+
+    parser.add_argument("--headless", nargs="+", metavar="PV",
+                        help="run without a display, printing the stats for "
+                             "one PV (vs. time), two (B vs. A) or more (their "
+                             "correlation matrix) every so often")
+    parser.add_argument("--points", type=int, default=2800,
+                        help="with --headless, how many pulses to look at "
+                             "(default: %(default)s)")
+    parser.add_argument("--std-devs", type=float,
+                        help="with --headless, drop points more than this "
+                             "many standard deviations from the mean")
+    parser.add_argument("--fit-order", type=int, default=1,
+                        help="with --headless, the order of the polynomial "
+                             "fit (default: %(default)s)")
+    parser.add_argument("--interval", type=float, default=1.0,
+                        help="with --headless, how many seconds between "
+                             "printouts (default: %(default)s)")
+    parser.add_argument("--user", default=getuser(),
+                        help="the account to act as when picking PVs (i.e. "
+                             "physics or spear; default: %(default)s)")
+    parser.add_argument("--simulate", action="store_true",
+                        help="make up the data instead of using EPICS")
+    parser.add_argument("--sim-rate", type=float, default=120.0,
+                        help="with --simulate, the beam rate in Hz "
+                             "(default: %(default)s)")
+    parser.add_argument("--sim-correlation", type=float, default=0.9,
+                        help="with --simulate, the correlation coefficient "
+                             "between any two PVs (default: %(default)s)")
+    parser.add_argument("--sim-noise", type=float, default=1.0,
+                        help="with --simulate, the standard deviation of "
+                             "every PV (default: %(default)s)")
+    parser.add_argument("--sim-dropout", type=float, default=0.0,
+                        help="with --simulate, the chance of a PV missing any "
+                             "given pulse (default: %(default)s)")
+    parser.add_argument("--sim-jitter", type=float, default=0.0,
+                        help="with --simulate, how many seconds timestamps can "
+                             "be off by (default: %(default)s)")
+    parser.add_argument("--replay", metavar="DIRECTORY",
+                        help="play back a recording instead of using EPICS "
+                             "(see File > Open Recording in the GUI)")
+    parser.add_argument("--replay-speed", type=float, default=1.0,
+                        help="with --replay, how many times real time to play "
+                             "it back at (default: %(default)s)")
+    parser.add_argument("--replay-start", type=float, default=0.0,
+                        help="with --replay, how many seconds into the "
+                             "recording to start (default: %(default)s)")
+    parser.add_argument("--record", metavar="DIRECTORY",
+                        help="with --headless, also record the PVs to this "
+                             "directory (see File > Record in the GUI)")
+    parser.add_argument("--metrics", action="store_true",
+                        help="show the frame rate and how long each stage "
+                             "takes (printed every interval when headless)")
+    parser.add_argument("--metrics-file", metavar="PATH",
+                        help="append the metrics to this file every second "
+                             "(every interval when headless), as JSON lines")
+    parser.add_argument("--metrics-udp", metavar="HOST:PORT",
+                        help="send the same JSON lines to this UDP address")
+    parser.add_argument("--startup-times", action="store_true",
+                        help="print how long each stage of starting up took")
+
+    # Anything we don't recognize is left for Qt
+    args, qtArgs = parser.parse_known_args(argv[1:])
+
+    if args.replay:
+        if args.simulate:
+            parser.error("--replay and --simulate don't go together")
+
+        if args.replay_speed <= 0:
+            parser.error("--replay-speed has to be positive")
+
+        try:
+            source = ReplaySource(args.replay, args.replay_speed,
+                                  args.replay_start)
+        except (IOError, ValueError, KeyError) as error:
+            parser.error("unable to open {D}: {E}".format(D=args.replay,
+                                                          E=error))
+
+    elif not args.simulate:
+        source = None
+
+    elif args.sim_rate < 1:
+        parser.error("--sim-rate has to be at least 1")
+
+    elif not 0 <= args.sim_correlation <= 1:
+        parser.error("--sim-correlation has to be between 0 and 1")
+
+    else:
+        source = SimulatedSource(args.sim_rate, args.sim_correlation,
+                                 args.sim_noise, args.sim_dropout,
+                                 args.sim_jitter)
+
+    metricsExporter = None
+
+    if args.metrics_file or args.metrics_udp:
+        address = None
+
+        if args.metrics_udp:
+            host, _, port = args.metrics_udp.rpartition(":")
+
+            if not host or not port.isdigit() or not 0 < int(port) < 65536:
+                parser.error("--metrics-udp has to look like HOST:PORT, "
+                             "with PORT between 1 and 65535")
+
+            address = host, int(port)
+
+        metricsExporter = MetricsExporter(args.metrics_file, address)
+
+    if args.headless:
+        if qtArgs:
+            parser.error("unrecognized arguments: " + " ".join(qtArgs))
+
+        if not 1 <= args.points <= rtbsaUtils.BUFF_LENGTH_LIMIT:
+            parser.error("--points has to be between 1 and {N}"
+                         .format(N=rtbsaUtils.BUFF_LENGTH_LIMIT))
+
+        if not 1 <= args.fit_order <= rtbsaUtils.MAX_FIT_ORDER:
+            parser.error("--fit-order has to be between 1 and {N}"
+                         .format(N=rtbsaUtils.MAX_FIT_ORDER))
+
+        exit(runHeadless(args.headless, args.user, args.points, args.std_devs,
+                         args.fit_order, args.interval, source, args.metrics,
+                         metricsExporter, args.record))
+
+    if args.record:
+        parser.error("--record only works with --headless")
+
+    if not args.max_fps > 0:
+        parser.error("--max-fps has to be positive")
+
+    startupTimes.mark("arguments")
+
+    app = QApplication(argv[:1] + qtArgs)
+    startupTimes.mark("Qt")
+
+    window = RTBSA(maxFrameRate=args.max_fps, user=args.user, source=source,
+                   showMetrics=args.metrics, metricsExporter=metricsExporter,
+                   startupTimes=startupTimes if args.startup_times else None)
+    startupTimes.mark("window")
+
     window.show()
+    startupTimes.mark("show")
     exit(app.exec_())
 
 
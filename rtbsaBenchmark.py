@@ -0,0 +1,369 @@
+#!/usr/local/lcls/package/python/current/bin/python
+############################################################################
+# Times each stage of the per-frame pipeline (the callbacks, synchronizing,
+# filtering, stats, fits and the FFT) on synthetic data, without a display
+# or EPICS, for a range of numPoints and beam rates. For each stage it prints
+# latency percentiles and, if tracemalloc is available, how much memory a
+# call allocates at its peak.
+#
+#   python rtbsaBenchmark.py --points 100 2800 10000 --rates 1 120 1000
+#   python rtbsaBenchmark.py --json baseline.json
+#   python rtbsaBenchmark.py --compare baseline.json
+#
+# With --compare, it exits with a nonzero status if any stage's median got
+# more than --tolerance slower than in the baseline.
+############################################################################
+
+from argparse import ArgumentParser
+from json import dump, load
+from sys import argv, exit
+from timeit import default_timer
+
+from numpy import percentile, random
+
+from rtbsaCore import BSACore, evaluateFit, getFit
+import rtbsaUtils
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+DEFAULT_POINTS = [100, 1000, 2800, rtbsaUtils.BUFF_LENGTH_LIMIT]
+DEFAULT_RATES = [1, 10, 120, 1000]
+DEFAULT_FRAMES = 200
+
+# How many calls of each stage to trace for allocations (tracing is slow)
+TRACED_CALLS = 5
+
+PERCENTILES = [50, 90, 99]
+
+
+# A source whose PVs never do anything, since the benchmark calls the
+# callbacks itself, and whose rate is whatever it's told
+class BenchmarkSource(object):
+
+    def __init__(self, rate):
+        self.rate = rate
+
+    # noinspection PyUnusedLocal
+    def pv(self, name, callback=None):
+        return InertPV()
+
+    # noinspection PyUnusedLocal
+    def rateMonitor(self, user):
+        return FixedRate(self.rate)
+
+
+class InertPV(object):
+
+    # noinspection PyUnusedLocal,PyMethodMayBeStatic
+    def connect(self, timeout=None):
+        return True
+
+    def add_callback(self, callback):
+        pass
+
+    def clear_callbacks(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+class FixedRate(object):
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.listeners = []
+
+
+############################################################################
+# Feeds a core correlated A and B values, one pulse at a time, the way the
+# callbacks would get them (a few percent of them missing)
+############################################################################
+class SyntheticBeam(object):
+
+    def __init__(self, core, rate, dropout=0.01, seed=0):
+        self.core = core
+        self.rate = float(rate)
+        self.dropout = dropout
+        self.random = random.RandomState(seed)
+        self.pulse = int(1.5e9 * rate)
+
+    def loadHistory(self):
+        timeStamp = self.pulse / self.rate
+        drive = self.random.randn(rtbsaUtils.BUFF_LENGTH_LIMIT)
+
+        for device, slope in (("A", 1.0), ("B", 2.0)):
+            values = slope * drive + self.random.randn(drive.size) * 0.1
+            self.core.updateTimeAndBuffer(device, "BENCH:" + device + "HSTBR",
+                                          timeStamp, values)
+
+    # Sends the next pulse to the callbacks, and returns how long each one
+    # took
+    def sendPulse(self):
+        self.pulse += 1
+        timeStamp = self.pulse / self.rate
+        drive = self.random.randn()
+        times = []
+
+        for device, slope in (("A", 1.0), ("B", 2.0)):
+            if self.random.rand() < self.dropout:
+                continue
+
+            value = slope * drive + self.random.randn() * 0.1
+
+            start = default_timer()
+            self.core.updateTimeAndBuffer(device, "BENCH:" + device + "BR",
+                                          timeStamp, value)
+            times.append(default_timer() - start)
+
+        return times
+
+
+############################################################################
+# The stages of a frame for each mode, as (name, function) pairs, where each
+# function does what the matching part of RTBSA's update method does (minus
+# the drawing)
+############################################################################
+def pairStages(core, numStdDevs):
+    filtered = {}
+
+    def sync():
+        core.populateSynchronizedBuffers()
+
+    def filterBuffers():
+        filtered["A"], filtered["B"] = \
+            core.filterSynchronizedBuffers(numStdDevs)
+
+    def stats():
+        statistics = core.statsFor(filtered["A"], filtered["B"], numStdDevs)
+        (statistics.minX(), statistics.maxX(), statistics.minY(),
+         statistics.maxY(), statistics.meanY(), statistics.stdY(1),
+         statistics.corr())
+        filtered["stats"] = statistics
+
+    def fits():
+        statistics = filtered["stats"]
+        for order in (1, 2):
+            evaluateFit(getFit(statistics, order), statistics.minX(),
+                        statistics.maxX())
+
+    return [("sync", sync), ("filter", filterBuffers), ("stats", stats),
+            ("fit", fits)]
+
+
+def timeSeriesStages(core, numStdDevs):
+    filtered = {}
+
+    def filterBuffer():
+        filtered["x"], filtered["y"] = core.filterTimeSeries(numStdDevs)
+
+    def stats():
+        statistics = core.statsFor(filtered["x"], filtered["y"], numStdDevs)
+        (statistics.minY(), statistics.maxY(), statistics.meanY(),
+         statistics.stdY())
+        filtered["stats"] = statistics
+
+    def fits():
+        statistics = filtered["stats"]
+        xOffset = core.fitOffset(statistics)
+        for order in (1, 2):
+            evaluateFit(getFit(statistics, order, xOffset), 0,
+                        core.numPoints - 1)
+
+    return [("filter", filterBuffer), ("stats", stats), ("fit", fits)]
+
+
+def fftStages(core, numStdDevs):
+    def fft():
+        core.powerSpectrum(core.rawBuffers["A"].snapshot(core.numPoints))
+
+    return [("fft", fft)]
+
+
+MODES = [("pair", pairStages, True), ("time", timeSeriesStages, False),
+         ("fft", fftStages, False)]
+
+
+def peakAllocation(func):
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def summarize(times, allocations=None):
+    micros = [t * 1e6 for t in times]
+    summary = {"calls": len(micros)}
+
+    for level, value in zip(PERCENTILES, percentile(micros, PERCENTILES)):
+        summary["p{L}".format(L=level)] = value
+
+    summary["max"] = max(micros)
+
+    if allocations:
+        summary["peakBytes"] = max(allocations)
+
+    return summary
+
+
+############################################################################
+# Runs frames frames of one mode at one numPoints and rate, pushing as many
+# pulses between frames as would come in at MAX_FRAME_RATE, and returns the
+# summary of every stage (plus the callbacks and the frame as a whole)
+############################################################################
+def runCase(mode, makeStages, paired, numPoints, rate, frames, numStdDevs):
+    core = BSACore("physics", numPoints, source=BenchmarkSource(rate))
+    core.mode = mode
+    core.devices = {"A": "BENCH:A", "B": "BENCH:B"}
+    core.pairedStats = paired
+    core.aborted = False
+
+    beam = SyntheticBeam(core, rate)
+    beam.loadHistory()
+
+    stages = makeStages(core, numStdDevs)
+    pulsesPerFrame = max(1, int(rate / rtbsaUtils.MAX_FRAME_RATE))
+
+    callbackTimes = []
+    stageTimes = dict((name, []) for name, _ in stages)
+    frameTimes = []
+
+    for _ in xrange(frames):
+        for _ in xrange(pulsesPerFrame):
+            callbackTimes.extend(beam.sendPulse())
+
+        frameStart = default_timer()
+
+        for name, stage in stages:
+            start = default_timer()
+            stage()
+            stageTimes[name].append(default_timer() - start)
+
+        frameTimes.append(default_timer() - frameStart)
+
+    results = {"callback": summarize(callbackTimes)}
+
+    for name, stage in stages:
+        allocations = None
+
+        if tracemalloc:
+            allocations = [peakAllocation(stage)
+                           for _ in xrange(TRACED_CALLS)]
+
+        results[name] = summarize(stageTimes[name], allocations)
+
+    results["frame"] = summarize(frameTimes)
+    return results
+
+
+def caseName(mode, numPoints, rate):
+    return "{M} points={N} rate={R:g}".format(M=mode, N=numPoints, R=rate)
+
+
+def printResults(name, results):
+    print name
+
+    for stage in sorted(results):
+        summary = results[stage]
+        line = "  {S:<9}".format(S=stage)
+        line += "".join(" p{L}={V:9.1f}us".format(L=level,
+                                                  V=summary["p%d" % level])
+                        for level in PERCENTILES)
+        line += " max={V:9.1f}us".format(V=summary["max"])
+
+        if "peakBytes" in summary:
+            line += " peak={K:8.1f}KiB".format(K=summary["peakBytes"] / 1024.0)
+
+        print line
+
+
+# Every stage whose median got more than tolerance slower than the baseline's,
+# as (case, stage, baseline, current) tuples
+def findRegressions(baseline, current, tolerance):
+    regressions = []
+
+    for name, results in sorted(current.items()):
+        for stage, summary in sorted(results.items()):
+            try:
+                before = baseline[name][stage]["p50"]
+            except KeyError:
+                continue
+
+            if summary["p50"] > before * (1 + tolerance):
+                regressions.append((name, stage, before, summary["p50"]))
+
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the RTBSA pipeline")
+    parser.add_argument("--points", type=int, nargs="+",
+                        default=DEFAULT_POINTS,
+                        help="the numPoints to try (default: %(default)s)")
+    parser.add_argument("--rates", type=float, nargs="+",
+                        default=DEFAULT_RATES,
+                        help="the beam rates to try, in Hz "
+                             "(default: %(default)s)")
+    parser.add_argument("--modes", nargs="+", default=[m for m, _, _ in MODES],
+                        choices=[m for m, _, _ in MODES],
+                        help="the plot types to try (default: all of them)")
+    parser.add_argument("--frames", type=int, default=DEFAULT_FRAMES,
+                        help="frames per case (default: %(default)s)")
+    parser.add_argument("--std-devs", type=float,
+                        help="turn on the standard deviation filter")
+    parser.add_argument("--json", help="also write the results here")
+    parser.add_argument("--compare",
+                        help="a --json file from an earlier run to check "
+                             "against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="with --compare, how much slower (as a fraction) "
+                             "a median can get before it counts as a "
+                             "regression (default: %(default)s)")
+    args = parser.parse_args(argv[1:])
+
+    for numPoints in args.points:
+        if not 1 <= numPoints <= rtbsaUtils.BUFF_LENGTH_LIMIT:
+            parser.error("--points have to be between 1 and {N}"
+                         .format(N=rtbsaUtils.BUFF_LENGTH_LIMIT))
+
+    if not tracemalloc:
+        print "tracemalloc isn't available, so no allocation numbers\n"
+
+    allResults = {}
+
+    for mode, makeStages, paired in MODES:
+        if mode not in args.modes:
+            continue
+
+        for numPoints in args.points:
+            for rate in args.rates:
+                name = caseName(mode, numPoints, rate)
+                results = runCase(mode, makeStages, paired, numPoints, rate,
+                                  args.frames, args.std_devs)
+                allResults[name] = results
+                printResults(name, results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            dump(allResults, f, indent=1, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = findRegressions(load(f), allResults, args.tolerance)
+
+        for name, stage, before, after in regressions:
+            print "REGRESSION {C} {S}: {B:.1f}us -> {A:.1f}us".format(
+                C=name, S=stage, B=before, A=after)
+
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,199 @@
+from time import sleep
+
+from numpy import arange, asarray, empty, nan
+
+from rtbsaUtils import BUFF_LENGTH_LIMIT, padWithNans
+
+# How many times a reader will retry a snapshot that a callback wrote into
+# while it was being copied before settling for what it has
+MAX_SNAPSHOT_RETRIES = 5
+
+
+############################################################################
+# A fixed capacity ring buffer indexed by pulse number (i.e. the pulse ID in
+# the sample's timestamp, unwrapped and divided down to the beam rate by
+# rtbsaPulse's PulseClock, so that every BSA device sees the same number for
+# the same shot).
+#
+# There's exactly one writer (the pyepics callback thread) and one reader
+# (whichever thread's doing the analysis; see rtbsaWorker). The writer bumps a
+# sequence counter before and after every change, so the counter is odd while
+# a write is in flight. The reader copies the window it wants into its own
+# preallocated array and retries if the counter moved underneath it, so the
+# render loop never sees a torn frame and nothing gets reallocated per tick.
+#
+# The data is stored twice, back to back (every slot i has a mirror at
+# i + capacity), so that any window of up to capacity pulses is one
+# contiguous, already ordered slice. That lets the reader either copy it with
+# a single slice assignment or, if it can live with the newest pulses
+# changing underneath it, use it in place without copying at all (see view).
+############################################################################
+class RingBuffer(object):
+
+    def __init__(self, capacity=BUFF_LENGTH_LIMIT):
+        self.capacity = capacity
+
+        self.data = empty(2 * capacity)
+        self.data[:] = nan
+
+        # The two halves of data, which always hold the same values
+        self.lower = self.data[:capacity]
+        self.upper = self.data[capacity:]
+
+        # Only ever touched by the reader
+        self.snapshotBuffer = empty(capacity)
+
+        # The pulse number and timestamp of the newest sample
+        self.lastPulse = None
+        self.timeStamp = None
+
+        # How many pulses have been padded with nans since the last clear
+        self.missedPulses = 0
+
+        self.seq = 0
+
+    def clear(self):
+        self.seq += 1
+        self.data[:] = nan
+        self.lastPulse = None
+        self.timeStamp = None
+        self.missedPulses = 0
+        self.seq += 1
+
+    # Bulk load a history buffer (i.e. the value of an HSTBR PV), the last
+    # element of which belongs to pulse
+    def load(self, values, pulse, timeStamp):
+        values = asarray(values, dtype=float)[-self.capacity:]
+
+        self.seq += 1
+        self.data[:] = nan
+
+        firstPulse = pulse - values.size + 1
+        slots = arange(firstPulse, pulse + 1) % self.capacity
+        self.lower[slots] = values
+        self.upper[slots] = values
+
+        self.lastPulse = pulse
+        self.timeStamp = timeStamp
+        self.seq += 1
+
+    # Writes value at the slot for pulse, padding any pulses we missed since
+    # the last write with nans. Returns the number of pulses that elapsed
+    # since that write, where 0 means the sample was stale and got dropped
+    def append(self, pulse, timeStamp, value):
+        if self.lastPulse is None:
+            elapsedPulses = 1
+
+        else:
+            elapsedPulses = pulse - self.lastPulse
+
+            if elapsedPulses <= 0:
+                return 0
+
+        self.seq += 1
+
+        if elapsedPulses > 1:
+            self.padMissedPulses(self.lastPulse + 1, pulse)
+
+        slot = pulse % self.capacity
+        self.lower[slot] = value
+        self.upper[slot] = value
+        self.lastPulse = pulse
+        self.timeStamp = timeStamp
+        self.seq += 1
+
+        return elapsedPulses
+
+    # Nan out pulses [firstPulse, endPulse). This runs inside the callback,
+    # so it's at most two slice assignments no matter how long the beam was
+    # gone
+    def padMissedPulses(self, firstPulse, endPulse):
+        self.missedPulses += endPulse - firstPulse
+
+        if endPulse - firstPulse >= self.capacity:
+            self.data[:] = nan
+            return
+
+        start = firstPulse % self.capacity
+        end = endPulse % self.capacity
+        padWithNans(self.lower, start, end)
+        padWithNans(self.upper, start, end)
+
+    # The value for pulse, or nan if we don't have it (yet)
+    def valueAt(self, pulse):
+        lastPulse = self.lastPulse
+
+        if lastPulse is None or not 0 <= lastPulse - pulse < self.capacity:
+            return nan
+
+        return self.lower[pulse % self.capacity]
+
+    ############################################################################
+    # Returns the newest numPoints pulses, oldest first, as a view straight into
+    # the ring buffer, so nothing is copied or allocated. The callbacks keep
+    # writing into it, so it can change while it's being used (the newest
+    # value can replace the oldest one). That's harmless for drawing a
+    # scrolling trace, but anything that needs a consistent window should use
+    # snapshot instead.
+    ############################################################################
+    def view(self, numPoints):
+        lastPulse = self.lastPulse
+
+        if lastPulse is None:
+            # Nothing's been written since the last clear, so it's all nans
+            return self.lower[:numPoints]
+
+        start = (lastPulse - numPoints + 1) % self.capacity
+        return self.data[start:start + numPoints]
+
+    ############################################################################
+    # Returns the numPoints pulses ending at endPulse (defaults to the newest
+    # one), oldest first. Unless out is given, the result is a view into
+    # snapshotBuffer, so it's only good until the next call (and only the
+    # reader should do that).
+    ############################################################################
+    def snapshot(self, numPoints, endPulse=None, out=None):
+        if out is None:
+            out = self.snapshotBuffer[:numPoints]
+
+        for _ in xrange(MAX_SNAPSHOT_RETRIES):
+            seq = self.seq
+
+            # A write is in progress; give the callback thread the GIL
+            if seq % 2:
+                sleep(0)
+                continue
+
+            self.copyWindow(out, numPoints, endPulse)
+
+            if self.seq == seq:
+                break
+
+        # The callback kept beating us to it, so settle for a best effort copy
+        else:
+            self.copyWindow(out, numPoints, endPulse)
+
+        return out
+
+    def copyWindow(self, out, numPoints, endPulse):
+        lastPulse = self.lastPulse
+
+        if lastPulse is None:
+            out[:] = nan
+            return
+
+        if endPulse is None or endPulse > lastPulse:
+            endPulse = lastPulse
+
+        # Anything older than this has already been overwritten
+        oldestPulse = lastPulse - self.capacity + 1
+        firstPulse = endPulse - numPoints + 1
+        numStale = min(numPoints, max(0, oldestPulse - firstPulse))
+
+        out[:numStale] = nan
+
+        if numStale == numPoints:
+            return
+
+        start = (firstPulse + numStale) % self.capacity
+        out[numStale:] = self.data[start:start + numPoints - numStale]
@@ -0,0 +1,93 @@
+from json import dump, load
+from os import makedirs, path, rename
+from subprocess import CalledProcessError, check_output
+from threading import Thread
+from time import time
+
+# Where the last catalog of BSA PVs we got is kept between runs
+CACHE_PATH = path.expanduser(path.join("~", ".rtbsa", "bsaPVs.json"))
+
+# Bumped whenever what's in the cache changes, so that old ones get ignored
+CACHE_FORMAT = 1
+
+# Searchable no matter what the catalog says
+EXTRA_PVS = ['GDET:FEE1:241:ENRC', 'GDET:FEE1:242:ENRC', 'GDET:FEE1:361:ENRC',
+             'GDET:FEE1:362:ENRC']
+
+
+# The current list of BSA root names from the directory service. Raises
+# CalledProcessError if eget fails, or OSError if there's no eget here
+def fetchCatalog():
+    return check_output(['eget', '-ts', 'ds', '-a',
+                         'tag=LCLS.BSA.rootnames']).splitlines()[1:-1]
+
+
+# The cached catalog and when it was fetched, or (None, None) if there isn't
+# a usable one
+def loadCatalog(fileName=CACHE_PATH):
+    try:
+        with open(fileName) as f:
+            cache = load(f)
+
+    except (IOError, ValueError):
+        return None, None
+
+    if cache.get("format") != CACHE_FORMAT or not cache.get("pvs"):
+        return None, None
+
+    return [str(pv) for pv in cache["pvs"]], cache.get("fetched")
+
+
+# The cache is written under a temporary name and renamed once it's complete,
+# so a crash halfway through can't leave a broken one
+def saveCatalog(pvs, fileName=CACHE_PATH):
+    directory = path.dirname(fileName)
+
+    if not path.isdir(directory):
+        makedirs(directory)
+
+    with open(fileName + ".part", "w") as f:
+        dump({"format": CACHE_FORMAT, "fetched": time(), "source": "eget",
+              "pvs": list(pvs)}, f)
+
+    rename(fileName + ".part", fileName)
+
+
+############################################################################
+# Gets the catalog from the directory service in the background, however
+# long that takes, caches it and hands it to listener (on the background
+# thread). If the directory service can't be reached, listener never hears
+# anything and whatever was loaded before stays.
+############################################################################
+def refreshCatalog(listener, fileName=CACHE_PATH):
+    thread = Thread(target=runRefresh, args=(listener, fileName),
+                    name="CatalogRefresh")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def runRefresh(listener, fileName):
+    try:
+        pvs = fetchCatalog()
+
+    except CalledProcessError:
+        print "Unable to pull most recent PV list"
+        return
+
+    # TODO un-hardcode machine and add common SPEAR PV's
+    except OSError:
+        print "Other machines coming soon to an RTBSA near you!"
+        return
+
+    if not pvs:
+        return
+
+    try:
+        saveCatalog(pvs, fileName)
+
+    # Not being able to cache it only costs us next time
+    except (IOError, OSError) as e:
+        print "Unable to cache the PV list: {E}".format(E=e)
+
+    listener(pvs)
@@ -0,0 +1,1242 @@
+from functools import partial
+from time import sleep, time
+
+from numpy import (abs, arange, argsort, asarray, empty, errstate, isfinite,
+                   isnan, linspace, nan, nan_to_num, nanmax, nanmin,
+                   percentile, where)
+from numpy.polynomial import Chebyshev
+
+from rtbsaBuffer import RingBuffer
+from rtbsaDecimate import columnExtrema, minMaxTrace
+from rtbsaFilters import FilterPipeline, below, notNan, withinStdDevs
+from rtbsaFrames import (CoherenceFrame, FitCurve, HistoryFrame, Labels,
+                         MatrixFrame, SpectrogramFrame, TraceFrame,
+                         plotColumns)
+from rtbsaHistory import HistoryWindow, TieredHistory
+from rtbsaMatrix import MultiBuffer, correlationMatrix
+from rtbsaMetrics import Metrics, describe
+from rtbsaPulse import PulseClock
+from rtbsaSpectrum import (CrossSpectrum, SpectrumPlan, WelchSpectrum,
+                           significantCoherence, toDecibels,
+                           welchSegmentLength)
+from rtbsaRecording import Recorder
+from rtbsaSource import EpicsSource
+from rtbsaStats import BufferStats, RunningStats, powerCoefficients
+import rtbsaUtils
+
+# The kill switch for backgrounded, forgotten sessions: how many pulses device
+# A can take in before we give up on it. Somewhere in the ballpark of 20
+# minutes assuming 120Hz
+INACTIVITY_LIMIT = 150000
+
+
+############################################################################
+# Everything RTBSA does short of drawing: subscribing to the PVs, keeping the
+# pulse keyed buffers and running stats up to date, synchronizing, filtering,
+# fitting and taking power spectra. It doesn't know about Qt, so it can run
+# without a display (see runHeadless) or be scripted.
+#
+# There are three modes, each started by its own method: A vs time
+# (startTimeSeries), B vs A (startPair) and the correlation matrix of any
+# number of PVs (startMatrix).
+#
+# The PVs come from source (see rtbsaSource), which is EPICS unless you say
+# otherwise.
+#
+# Anything that wants to hear about new data (i.e. the GUI) adds itself to
+# dataListeners. Like the rate monitor's listeners, those get called from the
+# pyepics thread, so they should do as little as possible. Status messages go
+# to stdout and to every statusListener.
+#
+# The callbacks and the sync, filter and FFT steps time themselves into
+# metrics (see rtbsaMetrics), and so can whoever's using the core.
+#
+# The frame methods (timeSeriesFrame and the rest) work out everything a plot
+# needs ahead of drawing it, for the GUI's analysis worker (see rtbsaWorker).
+############################################################################
+class BSACore(object):
+
+    def __init__(self, user, numPoints=2800, idle=None, source=None):
+        # The account we're running as (i.e. physics or spear), which decides
+        # which PVs exist
+        self.user = user
+
+        # numPoints is the window everything but the long A vs time plot uses,
+        # so it's capped at what the ring buffers hold; historyPoints is what
+        # was asked for (see longHistory)
+        self.historyPoints = numPoints
+        self.numPoints = min(numPoints, rtbsaUtils.BUFF_LENGTH_LIMIT)
+
+        # Called over and over while waiting for the history buffers to come
+        # in. The GUI passes in something that keeps its event loop going
+        self.idle = idle or waitBriefly
+
+        self.source = source or EpicsSource()
+
+        self.mode = None
+        self.aborted = True
+
+        self.dataListeners = []
+        self.statusListeners = []
+
+        self.metrics = Metrics()
+
+        # The PV names
+        self.devices = {"A": "", "B": ""}
+
+        self.pvObjects = {"A": None, "B": None}
+
+        # The raw, unfiltered buffers, indexed by pulse number. These are
+        # written by the PV callbacks and only ever read through snapshots
+        self.rawBuffers = {"A": RingBuffer(), "B": RingBuffer()}
+
+        self.synchronizedBuffers = {"A": empty(rtbsaUtils.BUFF_LENGTH_LIMIT),
+                                    "B": empty(rtbsaUtils.BUFF_LENGTH_LIMIT)}
+        self.synchronizedBuffers["A"][:] = nan
+        self.synchronizedBuffers["B"][:] = nan
+
+        # Filters the synchronized buffers (or, for A vs time, the index and
+        # A) into its own preallocated buffers, so we never filter in place and
+        # can refilter with different settings every time
+        self.filterPipeline = FilterPipeline(2)
+
+        # Device A's decimated history for A vs time windows longer than the
+        # ring buffer (kept up by the callbacks in that mode only)
+        self.history = TieredHistory()
+
+        # The x axis for A vs time, sliced down to numPoints as needed
+        self.timeAxis = arange(rtbsaUtils.BUFF_LENGTH_LIMIT, dtype=float)
+
+        # Used for the kill switch
+        self.counter = {"A": 0, "B": 0}
+
+        # Statistics kept up to date by the callbacks. For B vs A they track
+        # (A, B) pairs; otherwise (pulse, A)
+        self.runningStats = RunningStats(self.numPoints)
+        self.pairedStats = False
+
+        # Set from the reading thread to have the next callback rebuild the
+        # running stats from the raw buffers (they're only ever touched by
+        # callbacks)
+        self.reloadStats = True
+
+        self.bothPVsBSA = True
+
+        # For the correlation matrix: the PV names, their PV objects and the
+        # pulse aligned buffer that their callbacks write into
+        self.matrixDevices = []
+        self.matrixPVs = []
+        self.matrixBuffer = None
+
+        # Set while the streams are being recorded to disk (see
+        # startRecording)
+        self.recorder = None
+
+        # The cached parts of the power spectrum, and the newest pulse, window
+        # size and rate it was last taken with (see newPowerSpectrum)
+        self.spectrumPlan = None
+        self.spectrumKey = None
+
+        # The running Welch average and spectrogram of device A (see
+        # welchSpectrum)
+        self.welch = None
+
+        # The running cross spectrum of devices A and B (see crossSpectrum)
+        self.cross = None
+
+        # Numbers the pulses for every device (see PulseClock). Only LCLS
+        # timestamps have pulse IDs in them
+        self.pulseClock = PulseClock(self.user == "physics")
+
+        self.rateMonitor = self.source.rateMonitor(self.user)
+
+    # Stops whatever's running and gets the PVs from source from now on.
+    # Returns the old rate monitor, since whoever was listening to it probably
+    # wants to stop
+    def setSource(self, source):
+        self.stop()
+
+        rateMonitor = self.rateMonitor
+        self.source = source
+        self.rateMonitor = source.rateMonitor(self.user)
+        self.pulseClock = PulseClock(self.user == "physics")
+
+        # Numbered by the old clock
+        self.history.clear()
+        return rateMonitor
+
+    # Cached by the rate monitor, so this is cheap enough to call from every
+    # callback
+    def getRate(self):
+        if not self.rateMonitor:
+            return 0.0
+        return self.rateMonitor.rate
+
+    def printStatus(self, message):
+        print message
+
+        for listener in self.statusListeners:
+            listener(message)
+
+    def notifyDataListeners(self):
+        for listener in self.dataListeners:
+            listener()
+
+    def setNumPoints(self, numPoints):
+        self.historyPoints = numPoints
+        self.numPoints = min(numPoints, rtbsaUtils.BUFF_LENGTH_LIMIT)
+        self.reloadStats = True
+
+    # Whether the A vs time window is longer than the ring buffer, in which
+    # case it has to be drawn from history (see historyWindow)
+    def longHistory(self):
+        return (self.mode == "time"
+                and self.historyPoints > rtbsaUtils.BUFF_LENGTH_LIMIT)
+
+    # How many pulses the buffers have had to pad with nans since they were
+    # last cleared
+    def missedPulses(self):
+        missedPulses = (self.rawBuffers["A"].missedPulses
+                        + self.rawBuffers["B"].missedPulses)
+
+        if self.matrixBuffer:
+            missedPulses += self.matrixBuffer.missedPulses
+
+        return missedPulses
+
+    # Whether whoever started us seems to have forgotten about it. Recordings
+    # are meant to run for hours, so they don't count
+    def inactive(self):
+        return not self.recorder and self.counter["A"] > INACTIVITY_LIMIT
+
+    ############################################################################
+    # Starts plotting device's values against time. Returns the newest
+    # numPoints values, or None if the PV couldn't be reached
+    ############################################################################
+    def startTimeSeries(self, device):
+        # Restarting for the same device (e.g. to change the fit or the number
+        # of points) keeps the long history and any recording. The history
+        # buffer gets loaded on top of the long history again, but pulses it
+        # already has are skipped
+        restart = self.mode == "time" and self.devices["A"] == device
+
+        self.start("time", restart)
+        self.devices["A"] = device
+        self.pairedStats = False
+
+        self.printStatus("Initializing {A} buffer...".format(A=device))
+
+        if self.user == "physics":
+            # Initializing our data by putting a callback on the history buffer
+            # PV
+            hstbrConnected = self.clearAndUpdateCallback("A", "HSTBR",
+                                                         self.callbackA,
+                                                         device, True)
+
+            if hstbrConnected:
+                while not self.rawBuffers["A"].timeStamp and not self.aborted:
+                    self.idle()
+
+        # Removing that callback and manually appending new values to our local
+        # data buffer using the usual PV
+        if not self.clearAndUpdateCallback("A", "", self.callbackA, device):
+            return None
+
+        if self.user == "spear":
+            sleep(2)
+
+        # This was populated in the callback function
+        return self.rawBuffers["A"].snapshot(self.numPoints)
+
+    # Starts plotting deviceB against deviceA
+    def startPair(self, deviceA, deviceB):
+        self.start("pair")
+        self.devices["A"] = deviceA
+        self.devices["B"] = deviceB
+        self.pairedStats = True
+
+        self.printStatus("Initializing/Synchronizing {A} and {B} buffers..."
+                         .format(A=deviceA, B=deviceB))
+
+        if self.user == "spear":
+            self.bothPVsBSA = False
+            self.clearAndUpdateCallbacks("", resetRawBuffer=True)
+
+        if self.user == "physics":
+            # Initial population of our buffers using the HSTBR PV's in our
+            # callback functions
+            self.bothPVsBSA = self.clearAndUpdateCallbacks("HSTBR",
+                                                           resetRawBuffer=True)
+
+            if self.bothPVsBSA:
+                while ((not self.rawBuffers["A"].timeStamp
+                        or not self.rawBuffers["B"].timeStamp)
+                       and not self.aborted):
+                    self.idle()
+
+            # Try to switch to the beam rate PVs (if available, else, just the
+            # base PV) to avoid pulling an entire history buffer
+            # on every update. The ring buffers are keyed by pulse, so the
+            # history we just pulled stays lined up with the new values.
+            if not self.clearAndUpdateCallbacks("BR"):
+                self.clearAndUpdateCallbacks("")
+
+        if self.user == "spear":
+            sleep(2)
+
+    ############################################################################
+    # Starts the correlation matrix of devices. They all get kept lined up by
+    # pulse in one MultiBuffer, so that working out the matrix is one snapshot
+    # and one correlationMatrix call no matter how many PVs there are. Unlike
+    # A and B, these don't get pre-filled from their history buffers; the
+    # window just fills up as the pulses come in.
+    ############################################################################
+    def startMatrix(self, devices):
+        self.start("matrix")
+        self.matrixDevices = list(devices)
+
+        self.printStatus("Subscribing to {N} PVs..."
+                         .format(N=len(self.matrixDevices)))
+
+        self.matrixBuffer = MultiBuffer(len(self.matrixDevices))
+
+        suffix = "BR" if self.user == "physics" else ""
+
+        # Connecting is left to pyepics in the background, since waiting on
+        # each of a hundred PVs in turn would take forever. One that never
+        # connects just shows up as nans
+        for row, device in enumerate(self.matrixDevices):
+            self.matrixPVs.append(self.source.pv(
+                device + suffix, partial(self.matrixCallback, row)))
+
+    # restart means it's the same mode and devices as before, so the long
+    # history and the recording carry on rather than starting over
+    def start(self, mode, restart=False):
+        self.clearPV("A")
+        self.clearPV("B")
+        self.clearMatrixPVs()
+
+        if not restart:
+            self.stopRecording()
+            self.history.clear()
+
+        self.mode = mode
+        self.aborted = False
+        self.matrixBuffer = None
+
+        self.spectrumKey = None
+        self.welch = None
+        self.cross = None
+        self.reloadStats = True
+        self.counter["A"] = 0
+
+    # Unsubscribes from everything and returns how many pulses we missed
+    def stop(self):
+        self.clearPV("A")
+        self.clearPV("B")
+        self.clearMatrixPVs()
+        self.stopRecording()
+
+        self.aborted = True
+        missedPulses = self.missedPulses()
+
+        # The callbacks are cleared above, so nobody's writing into these
+        self.rawBuffers["A"].clear()
+        self.rawBuffers["B"].clear()
+
+        return missedPulses
+
+    ############################################################################
+    # Starts recording whatever's being acquired to directory (see
+    # rtbsaRecording), beginning with what's already in the ring buffers.
+    # Only the pulses after that go through the callbacks, so nothing gets
+    # recorded twice. Returns the Recorder, or None if nothing's running or
+    # there's no beam.
+    ############################################################################
+    def startRecording(self, directory):
+        if self.aborted:
+            self.printStatus("Nothing to record")
+            return None
+
+        # Pulse numbers and timestamps only line up at a real rate, and a
+        # recording without one couldn't be played back
+        if self.getRate() < 1:
+            self.printStatus("No beam, so nothing to record")
+            return None
+
+        self.stopRecording()
+
+        if self.mode == "matrix":
+            pvs = self.matrixDevices
+        elif self.mode == "pair":
+            pvs = [self.devices["A"], self.devices["B"]]
+        else:
+            pvs = [self.devices["A"]]
+
+        recorder = Recorder(directory, pvs, self.mode, self.getRate(),
+                            self.user)
+
+        if self.mode == "matrix":
+            self.recorder = recorder
+
+        else:
+            # The callbacks put a pulse in the buffer before they look for a
+            # recorder, so with the recorder in place first every pulse is
+            # either in the history or recorded live (or both, which the
+            # recorder sorts out), and none can fall between the two
+            self.recorder = recorder
+
+            for column, device in enumerate(("A", "B")[:len(pvs)]):
+                rawBuffer = self.rawBuffers[device]
+                lastPulse = rawBuffer.lastPulse
+
+                if lastPulse is None:
+                    continue
+
+                history = rawBuffer.snapshot(rawBuffer.capacity, lastPulse,
+                                             empty(rawBuffer.capacity))
+                recorder.recordHistory(column, history, lastPulse,
+                                       rawBuffer.timeStamp, self.getRate())
+
+        self.printStatus("Recording to " + directory)
+        return recorder
+
+    def stopRecording(self):
+        recorder = self.recorder
+
+        if not recorder:
+            return
+
+        self.recorder = None
+        recorder.stop()
+
+        message = "Recorded {N} samples to {D}".format(N=recorder.written,
+                                                       D=recorder.directory)
+        if recorder.dropped:
+            message += " ({N} dropped)".format(N=recorder.dropped)
+
+        self.printStatus(message)
+
+    def clearAndUpdateCallbacks(self, suffix, resetRawBuffer=False):
+        aIsBSA = self.clearAndUpdateCallback("A", suffix, self.callbackA,
+                                             self.devices["A"], resetRawBuffer)
+        bIsBSA = self.clearAndUpdateCallback("B", suffix, self.callbackB,
+                                             self.devices["B"], resetRawBuffer)
+        return aIsBSA and bIsBSA
+
+    # noinspection PyTypeChecker
+    def clearAndUpdateCallback(self, device, suffix, callback, pvName,
+                               resetRawBuffer=False):
+        self.clearPV(device)
+
+        self.pvObjects[device] = self.source.pv(pvName + suffix)
+
+        # For some reason, we need this before checking the connection
+        sleep(0.1)
+
+        if not self.pvObjects[device].connect():
+            self.printStatus('PV ' + pvName + suffix + ' invalid.')
+            return False
+
+        if resetRawBuffer:
+            self.rawBuffers[device].clear()
+
+        self.pvObjects[device].add_callback(callback)
+        return True
+
+    def clearPV(self, device):
+        pv = self.pvObjects[device]
+        if pv:
+            pv.clear_callbacks()
+            pv.disconnect()
+
+        self.pvObjects[device] = None
+
+    def clearMatrixPVs(self):
+        for pv in self.matrixPVs:
+            pv.clear_callbacks()
+            pv.disconnect()
+
+        self.matrixPVs = []
+
+    # Callback function for Device A
+    # noinspection PyUnusedLocal
+    def callbackA(self, pvname=None, value=None, timestamp=None, **kw):
+        self.updateTimeAndBuffer("A", pvname, timestamp, value,
+                                 kw.get("nanoseconds"))
+
+    # Callback function for Device B
+    # noinspection PyUnusedLocal
+    def callbackB(self, pvname=None, value=None, timestamp=None, **kw):
+        self.updateTimeAndBuffer("B", pvname, timestamp, value,
+                                 kw.get("nanoseconds"))
+
+    ############################################################################
+    # This is where the data is actually acquired and saved to the buffers.
+    # Callbacks are effectively listeners that listen for change, so we
+    # basically put a callback on the PVs of interest (devices A and/or B) so
+    # that every time the value of that PV changes, we get that new value and
+    # append it to our raw data buffer for that device.
+    # Initialization of the buffer is slightly different in that the listener is
+    # put on the history buffer of that PV (denoted by the HSTBR suffix), so
+    # that we just immediately write the previous BUFF_LENGTH_LIMIT points to
+    # our raw buffer
+    #
+    # Samples are keyed by pulse number (from the pulse ID in the timestamp's
+    # nanoseconds where there is one; see PulseClock), so the same shot lands
+    # in the same slot of every device's ring buffer
+    ############################################################################
+    def updateTimeAndBuffer(self, device, pvname, timestamp, value,
+                            nanoseconds=None):
+        start = time()
+
+        rate = self.getRate()
+        if rate < 1:
+            return
+
+        pulse = self.pulseClock.pulse(timestamp, rate, nanoseconds)
+
+        if "HSTBR" in pvname:
+            # value is the buffer because we're monitoring the HSTBR PV
+            self.rawBuffers[device].load(value, pulse, timestamp)
+
+            # The history never sees peak currents we'd throw out
+            if self.mode == "time":
+                values = asarray(value, dtype=float)
+                self.history.load(where(self.isValidSample(device, values),
+                                        values, nan), pulse)
+
+            # Reset the counter every time we reinitialize the plot
+            self.counter[device] = 0
+
+            self.loadRunningStats()
+
+        else:
+            # The ring buffer pads any pulses we missed with nans
+            elapsedPulses = self.rawBuffers[device].append(pulse, timestamp,
+                                                           value)
+
+            if not elapsedPulses:
+                return
+
+            self.counter[device] += elapsedPulses
+            self.updateRunningStats(device, pulse, value)
+
+            if self.mode == "time":
+                self.history.append(pulse, value
+                                    if self.isValidSample(device, value)
+                                    else nan)
+
+            recorder = self.recorder
+            if recorder:
+                recorder.record(0 if device == "A" else 1, pulse, timestamp,
+                                value)
+
+        self.metrics.record("callback", time() - start)
+        self.notifyDataListeners()
+
+    # noinspection PyUnusedLocal
+    def matrixCallback(self, row, pvname=None, value=None, timestamp=None,
+                       **kw):
+        start = time()
+
+        rate = self.getRate()
+        if rate < 1:
+            return
+
+        if (self.matrixDevices[row] == "BLEN:LI24:886:BIMAX"
+                and value >= rtbsaUtils.IPK_LIMIT):
+            value = nan
+
+        pulse = self.pulseClock.pulse(timestamp, rate, kw.get("nanoseconds"))
+        elapsedPulses = self.matrixBuffer.append(row, pulse, value)
+
+        if not elapsedPulses:
+            return
+
+        if row == 0:
+            self.counter["A"] += elapsedPulses
+
+        recorder = self.recorder
+        if recorder:
+            recorder.record(row, pulse, timestamp, value)
+
+        self.metrics.record("callback", time() - start)
+        self.notifyDataListeners()
+
+    # Whether a sample (or each sample in an array) belongs in the running
+    # stats (the same criteria as the nan and peak current filters)
+    def isValidSample(self, device, value):
+        valid = ~isnan(value)
+
+        if self.devices[device] == "BLEN:LI24:886:BIMAX":
+            # Comparisons against nans are expected here
+            with errstate(invalid='ignore'):
+                valid &= value < rtbsaUtils.IPK_LIMIT
+
+        return valid
+
+    def updateRunningStats(self, device, pulse, value):
+        if self.reloadStats:
+            self.loadRunningStats()
+            return
+
+        if not self.pairedStats:
+            if device == "A":
+                if self.isValidSample("A", value):
+                    self.runningStats.add(pulse, pulse, value)
+                self.runningStats.advance(pulse)
+            return
+
+        # Pair this sample up with the other device's sample for the same
+        # pulse, if it's already arrived (otherwise its callback will do it)
+        other = "B" if device == "A" else "A"
+        otherValue = self.rawBuffers[other].valueAt(pulse)
+
+        if (self.isValidSample(device, value)
+                and self.isValidSample(other, otherValue)):
+            if device == "A":
+                self.runningStats.add(pulse, value, otherValue)
+            else:
+                self.runningStats.add(pulse, otherValue, value)
+
+        lastPulseA = self.rawBuffers["A"].lastPulse
+        lastPulseB = self.rawBuffers["B"].lastPulse
+
+        if lastPulseA is not None and lastPulseB is not None:
+            self.runningStats.advance(min(lastPulseA, lastPulseB))
+
+    # Rebuild the running stats from the raw buffers. This is the only O(buffer)
+    # step, and it only happens when the buffers get (re)initialized or the
+    # number of points changes
+    def loadRunningStats(self):
+        self.reloadStats = False
+        self.runningStats.window = self.numPoints
+
+        bufferA = self.rawBuffers["A"]
+        bufferB = self.rawBuffers["B"]
+
+        if (bufferA.lastPulse is None
+                or (self.pairedStats and bufferB.lastPulse is None)):
+            self.runningStats.clear()
+            return
+
+        if self.pairedStats:
+            endPulse = min(bufferA.lastPulse, bufferB.lastPulse)
+            xData = bufferA.snapshot(self.numPoints, endPulse,
+                                     empty(self.numPoints))
+            yData = bufferB.snapshot(self.numPoints, endPulse,
+                                     empty(self.numPoints))
+        else:
+            endPulse = bufferA.lastPulse
+            yData = bufferA.snapshot(self.numPoints, endPulse,
+                                     empty(self.numPoints))
+            xData = None
+
+        pulses = arange(endPulse - self.numPoints + 1, endPulse + 1)
+
+        if xData is None:
+            xData = pulses
+            valid = self.isValidSample("A", yData)
+        else:
+            valid = (self.isValidSample("A", xData)
+                     & self.isValidSample("B", yData))
+
+        self.runningStats.load(pulses[valid], xData[valid], yData[valid])
+
+    ############################################################################
+    # Device A and device B aren't guaranteed to have received the same pulses
+    # at any given moment (one callback may have fired and the other not yet,
+    # or one device may have just started acquiring). Since both raw buffers are
+    # keyed by pulse number, synchronizing them just means taking the same
+    # window of pulses out of each: the last numPoints pulses ending at the
+    # newest pulse that both devices have seen. See the diagram below, where
+    # the dotted line represents pulses (one buffer is contained by square
+    # brackets [], the other by curly braces {}).
+    #
+    #
+    #          [           {                            ]           }
+    # <----------------------------------------------------------------------> p
+    #       A_first     B_first                      A_last      B_last
+    #
+    #
+    # Only the pulses up to A_last contain data from both buffers, so that's
+    # where the window ends. Pulses that a device missed within the window are
+    # already nans in its ring buffer.
+    ############################################################################
+    def populateSynchronizedBuffers(self):
+        start = time()
+
+        lastPulseA = self.rawBuffers["A"].lastPulse
+        lastPulseB = self.rawBuffers["B"].lastPulse
+
+        if lastPulseA is None or lastPulseB is None:
+            endPulse = None
+        else:
+            endPulse = min(lastPulseA, lastPulseB)
+
+        self.synchronizedBuffers["A"] = \
+            self.rawBuffers["A"].snapshot(self.numPoints, endPulse)
+        self.synchronizedBuffers["B"] = \
+            self.rawBuffers["B"].snapshot(self.numPoints, endPulse)
+
+        self.metrics.record("sync", time() - start)
+
+    ############################################################################
+    # Drops every pulse that either buffer has a nan for, that has an insane
+    # peak current (this PV gets insane values, apparently) or, if numStdDevs is
+    # given, that's an outlier in either buffer. All of those checks get folded
+    # into one mask that's applied to both buffers at once (see FilterPipeline)
+    ############################################################################
+    def filterSynchronizedBuffers(self, numStdDevs=None):
+        start = time()
+
+        filters = [notNan(0), notNan(1)]
+
+        if self.user == "physics":
+            for channel, device in enumerate(("A", "B")):
+                if self.devices[device] == "BLEN:LI24:886:BIMAX":
+                    filters.append(below(channel, rtbsaUtils.IPK_LIMIT))
+
+        if numStdDevs:
+            filters.append(withinStdDevs(0, numStdDevs))
+            filters.append(withinStdDevs(1, numStdDevs))
+
+        self.filterPipeline.filters = filters
+        bufferA, bufferB = self.filterPipeline.apply(
+            [self.synchronizedBuffers["A"], self.synchronizedBuffers["B"]])
+
+        self.metrics.record("filter", time() - start)
+        return bufferA, bufferB
+
+    # The same, for A vs time. Returns the surviving values of A and their
+    # positions in the window
+    def filterTimeSeries(self, numStdDevs=None):
+        start = time()
+
+        # The view is already ordered oldest to newest, which is what makes it
+        # scroll, and it's read straight out of the ring buffer without copying
+        choppedBuffer = self.rawBuffers["A"].view(self.numPoints)
+
+        filters = [notNan(1)]
+
+        if self.devices["A"] == "BLEN:LI24:886:BIMAX":
+            filters.append(below(1, rtbsaUtils.IPK_LIMIT))
+
+        if numStdDevs:
+            filters.append(withinStdDevs(1, numStdDevs))
+
+        self.filterPipeline.filters = filters
+        xData, yData = self.filterPipeline.apply(
+            [self.timeAxis[:self.numPoints], choppedBuffer])
+
+        self.metrics.record("filter", time() - start)
+        return xData, yData
+
+    # The running stats don't know which points the standard deviation filter
+    # threw out, so with it on the stats have to come from the filtered data
+    def statsFor(self, xData, yData, numStdDevs=None):
+        if numStdDevs:
+            return BufferStats(xData, yData)
+        return self.runningStats
+
+    # For A vs time the running stats fit against pulse number rather than
+    # position in the window, so this is what to shift their fits by (nothing
+    # before the first pulse, when there's nothing to fit anyway)
+    def fitOffset(self, stats):
+        lastPulse = self.rawBuffers["A"].lastPulse
+
+        if (stats is self.runningStats and not self.pairedStats
+                and lastPulse is not None):
+            return lastPulse - self.numPoints + 1
+        return 0
+
+    ############################################################################
+    # The part of the long A vs time window from position start to position
+    # end (0 being the oldest pulse in the window and historyPoints - 1 the
+    # newest) as a HistoryWindow, at the finest resolution that fits on the
+    # plot: straight out of the ring buffer if it's recent and short enough,
+    # otherwise from the coarsest tier it takes (see TieredHistory). Its pulses
+    # are converted to positions in the window. The peak current filter is
+    # applied; the standard deviation one isn't.
+    ############################################################################
+    def historyWindow(self, start=0, end=None):
+        lastPulse = self.history.lastPulse
+
+        if lastPulse is None:
+            return None
+
+        if end is None:
+            end = self.historyPoints - 1
+
+        offset = lastPulse - self.historyPoints + 1
+        firstPulse = offset + max(0, int(start))
+        endPulse = offset + min(self.historyPoints - 1, int(end))
+
+        if endPulse < firstPulse:
+            return None
+
+        tier = self.history.chooseTier(firstPulse, endPulse)
+
+        if tier is None:
+            numPoints = endPulse - firstPulse + 1
+            values = self.rawBuffers["A"].snapshot(numPoints, endPulse,
+                                                   empty(numPoints))
+
+            values[~self.isValidSample("A", values)] = nan
+
+            valid = ~isnan(values)
+            window = HistoryWindow(1, arange(firstPulse, endPulse + 1), values,
+                                   values, values, valid,
+                                   nan_to_num(values), nan_to_num(values ** 2))
+        else:
+            window = self.history.window(tier, firstPulse, endPulse)
+
+        window.pulses = window.pulses - offset
+        return window
+
+    ############################################################################
+    # The power spectrum of data (device A's last numPoints values), as a pair
+    # of frequencies and magnitudes, or None if there's nothing to work with
+    ############################################################################
+    def powerSpectrum(self, data):
+        start = time()
+
+        rate = self.getRate()
+
+        if not data.size or rate < 1:
+            return None
+
+        # The frequency axis and work buffer only change with the window size
+        # and the rate (see SpectrumPlan)
+        if not self.spectrumPlan or not self.spectrumPlan.matches(data.size,
+                                                                  rate):
+            self.spectrumPlan = SpectrumPlan(data.size, rate)
+
+        ps = self.spectrumPlan.powerSpectrum(data)
+
+        self.metrics.record("fft", time() - start)
+
+        if ps is None:
+            return None
+
+        return self.spectrumPlan.frequencies, ps
+
+    # The power spectrum of device A's last numPoints pulses, or None if no
+    # pulses have come in since the last time (in which case it'd be the same)
+    # or there's nothing to work with
+    def newPowerSpectrum(self):
+        key = (self.rawBuffers["A"].lastPulse, self.numPoints, self.getRate())
+
+        if key == self.spectrumKey:
+            return None
+
+        self.spectrumKey = key
+        return self.powerSpectrum(
+            self.rawBuffers["A"].snapshot(self.numPoints))
+
+    # Brings the Welch average of device A up to date and returns it, or None
+    # if no segments have completed since the last time (so there's nothing
+    # new to draw). It starts over whenever the window size or rate changes.
+    # Peak currents we'd throw out count as missing
+    def welchSpectrum(self):
+        rate = self.getRate()
+
+        if rate < 1:
+            return None
+
+        segmentLength = welchSegmentLength(self.numPoints)
+
+        if not self.welch or not self.welch.matches(segmentLength, rate):
+            self.welch = WelchSpectrum(
+                segmentLength, rate,
+                screens=(partial(self.isValidSample, "A"),))
+
+        start = time()
+        added = self.welch.update(self.rawBuffers["A"])
+
+        if not added:
+            return None
+
+        self.metrics.record("fft", time() - start)
+        return self.welch
+
+    # The same for the cross spectrum of devices A and B, for their coherence
+    # (see CrossSpectrum). Peak currents we'd throw out count as missing
+    def crossSpectrum(self):
+        rate = self.getRate()
+
+        if rate < 1:
+            return None
+
+        segmentLength = welchSegmentLength(self.numPoints)
+
+        if not self.cross or not self.cross.matches(segmentLength, rate):
+            self.cross = CrossSpectrum(
+                segmentLength, rate,
+                screens=(partial(self.isValidSample, "A"),
+                         partial(self.isValidSample, "B")))
+
+        start = time()
+        added = self.cross.update(self.rawBuffers["A"], self.rawBuffers["B"])
+
+        if not added:
+            return None
+
+        self.metrics.record("fft", time() - start)
+        return self.cross
+
+    # The correlation coefficient of every pair of matrix devices over the
+    # last numPoints pulses
+    def correlation(self):
+        start = time()
+        correlation = correlationMatrix(
+            self.matrixBuffer.snapshot(self.numPoints))
+        self.metrics.record("correlation", time() - start)
+        return correlation
+
+    # The count devices that correlate best with the first one (which is the
+    # one everything else is presumably being compared against, i.e. the gas
+    # detector), as (name, correlation coefficient) pairs
+    def strongestCorrelations(self, correlation, count=3):
+        rows = [row for row in argsort(-abs(nan_to_num(correlation[0])))
+                if row != 0][:count]
+        return [(self.matrixDevices[row], correlation[0, row]) for row in rows]
+
+    ############################################################################
+    # The frames the GUI draws (see rtbsaFrames). Each takes the FrameSettings
+    # the GUI had when it asked for it and returns everything the frame needs,
+    # already worked out, or None if there's nothing new to draw. They're run
+    # by the analysis worker (see rtbsaWorker), one at a time, except while
+    # the plot's being set up, when the worker's been cancelled and the Qt
+    # thread runs them itself. Either way they mustn't touch Qt.
+    ############################################################################
+    def timeSeriesFrame(self, settings):
+        if self.longHistory():
+            return self.historyFrame(settings)
+
+        xData, yData = self.filterTimeSeries(settings.numStdDevs)
+
+        if not yData.size:
+            return None
+
+        stats = self.statsFor(xData, yData, settings.numStdDevs)
+
+        # Each point goes at its position in the window (so missed pulses
+        # show up as gaps)
+        x, y = minMaxTrace(xData, yData, plotColumns(settings, xData))
+
+        labels = Labels(0, self.numPoints, stats.minY(), stats.maxY(),
+                        stats.meanY(), stats.stdY(), None)
+        fit = self.fitFor(settings, stats, 0, self.numPoints - 1,
+                          self.fitOffset(stats))
+
+        return TraceFrame(x.copy(), y.copy(), labels, fit)
+
+    # The long A vs time plot, over whatever part of the window is showing
+    # (or all of it with autoscale on). Its labels' x range is that part
+    def historyFrame(self, settings):
+        if settings.autoscale:
+            start, end = 0, self.historyPoints - 1
+        else:
+            start, end = settings.viewRange
+
+        window = self.historyWindow(start, end)
+
+        if window is None or not window.count:
+            return None
+
+        numColumns = plotColumns(settings, window.pulses)
+        x, y = minMaxTrace(window.pulses, window.means, numColumns)
+        xs, mins, _ = columnExtrema(window.pulses, window.mins, numColumns)
+        lower = xs, mins
+        xs, _, maxs = columnExtrema(window.pulses, window.maxs, numColumns)
+        upper = xs, maxs
+
+        labels = Labels(start, end, nanmin(window.mins), nanmax(window.maxs),
+                        window.mean, window.std, None)
+
+        valid = ~isnan(window.means)
+        fit = self.fitFor(settings,
+                          BufferStats(window.pulses[valid],
+                                      window.means[valid]), start, end)
+
+        return HistoryFrame(x.copy(), y.copy(), labels, fit, lower, upper,
+                            window.factor)
+
+    def pairFrame(self, settings):
+        self.populateSynchronizedBuffers()
+        bufferA, bufferB = self.filterSynchronizedBuffers(settings.numStdDevs)
+        stats = self.statsFor(bufferA, bufferB, settings.numStdDevs)
+
+        try:
+            labels = Labels(stats.minX(), stats.maxX(), stats.minY(),
+                            stats.maxY(), stats.meanY(), stats.stdY(1),
+                            stats.corr())
+            fit = self.fitFor(settings, stats, labels.minX, labels.maxX)
+
+        # Nothing survived the filters
+        except ValueError:
+            labels = None
+            fit = None
+
+        return TraceFrame(bufferA.copy(), bufferB.copy(), labels, fit)
+
+    # The power spectrum of the whole window, if there have been new pulses
+    # since the last one (see newPowerSpectrum)
+    def periodogramFrame(self, settings):
+        spectrum = self.newPowerSpectrum()
+
+        if spectrum is None:
+            return None
+
+        frequencies, ps = spectrum
+        x, y = minMaxTrace(frequencies, ps, plotColumns(settings, frequencies))
+
+        # The frequencies are in increasing order
+        labels = Labels(frequencies[0], frequencies[-1], ps.min(), ps.max(),
+                        None, None, None)
+
+        return TraceFrame(x.copy(), y.copy(), labels, None)
+
+    # The Welch averaged PSD in dB, without the DC bin (the mean's been taken
+    # out of it). redraw gets one even if no segments have completed since
+    # the last one
+    def welchFrame(self, settings, redraw=False):
+        welch = self.welchSpectrum() or (redraw and self.welch)
+
+        if not welch:
+            return None
+
+        psd = welch.psd()
+
+        if psd is None:
+            return None
+
+        frequencies = welch.frequencies[1:]
+        psd = toDecibels(psd[1:])
+        x, y = minMaxTrace(frequencies, psd, plotColumns(settings, frequencies))
+
+        if isnan(psd).all():
+            labels = None
+        else:
+            labels = Labels(frequencies[0], frequencies[-1], nanmin(psd),
+                            nanmax(psd), None, None, None)
+
+        return TraceFrame(x.copy(), y.copy(), labels, None)
+
+    # The Welch segments' PSDs over time, oldest at the bottom. The color
+    # levels only follow the data while autoscale is on
+    def spectrogramFrame(self, settings, redraw=False):
+        welch = self.welchSpectrum() or (redraw and self.welch)
+
+        if not welch:
+            return None
+
+        image = toDecibels(welch.waterfall()[:, 1:])
+        finite = isfinite(image)
+
+        if not finite.any():
+            return None
+
+        levels = settings.levels
+
+        if levels is None or settings.autoscale:
+            levels = tuple(percentile(image[finite], (5, 99.5)))
+
+        # Segments we didn't have enough pulses for come out as the background
+        image[~finite] = levels[0]
+
+        frequencies = welch.frequencies
+        width = frequencies[1]
+        duration = image.shape[0] * welch.interval()
+
+        return SpectrogramFrame(image, levels,
+                                (frequencies[1] - width / 2, -duration,
+                                 frequencies[-1] - frequencies[1] + width,
+                                 duration), frequencies[-1])
+
+    def coherenceFrame(self, settings, redraw=False):
+        cross = self.crossSpectrum() or (redraw and self.cross)
+
+        if not cross:
+            return None
+
+        result = cross.coherence()
+
+        if result is None:
+            return None
+
+        coherence, phase, count = result
+        threshold = significantCoherence(count)
+        frequencies = cross.frequencies
+
+        # Phases where there's no real coherence are just noise
+        with errstate(invalid="ignore"):
+            coherent = coherence > threshold
+
+        return CoherenceFrame(frequencies, coherence, threshold,
+                              frequencies[coherent], phase[coherent], count)
+
+    # noinspection PyUnusedLocal
+    def matrixFrame(self, settings):
+        correlation = self.correlation()
+        return MatrixFrame(nan_to_num(correlation),
+                           self.strongestCorrelations(correlation))
+
+    # The fit settings ask for (see getFit) from xMin to xMax, or None if the
+    # fits are off
+    def fitFor(self, settings, stats, xMin, xMax, xOffset=0):
+        if settings.fitOrder is None:
+            return None
+
+        start = time()
+        fit = getFit(stats, settings.fitOrder, xOffset)
+        xGrid, fitData = evaluateFit(fit, xMin, xMax)
+        self.metrics.record("fit", time() - start)
+
+        return FitCurve(xGrid, fitData,
+                        fitLabel(fit, settings.fitOrder, settings.linearFit))
+
+    # A one line rundown of the current window, for the headless mode
+    def summary(self, numStdDevs=None, fitOrder=1):
+        if self.mode == "matrix":
+            return "{D} correlates most with ".format(
+                D=self.matrixDevices[0]) + ", ".join(
+                "{P} ({R:.2f})".format(P=device, R=coefficient)
+                for device, coefficient
+                in self.strongestCorrelations(self.correlation()))
+
+        if self.mode == "pair":
+            self.populateSynchronizedBuffers()
+            xData, yData = self.filterSynchronizedBuffers(numStdDevs)
+        else:
+            xData, yData = self.filterTimeSeries(numStdDevs)
+
+        stats = self.statsFor(xData, yData, numStdDevs)
+        parts = ["{N} points".format(N=yData.size),
+                 "AVG: {:.4g}".format(stats.meanY()),
+                 "STD: {:.4g}".format(stats.stdY(1))]
+
+        if self.mode == "pair":
+            parts.append("Corr. Coefficient: {:.3f}".format(stats.corr()))
+
+        fit = getFit(stats, fitOrder, self.fitOffset(stats))
+
+        if fit is not None:
+            parts.append("Fit: " + " ".join(
+                "{:.3e}".format(c) for c in powerCoefficients(fit, fitOrder)))
+
+        return ", ".join(parts)
+
+
+############################################################################
+# The fits come from stats (the running stats, as long as they match what's
+# being shown), which solve a tiny least squares system from sums they keep
+# up to date as pulses come in, so nothing here scales with the number of
+# points. xOffset gets subtracted from the fit's x values.
+############################################################################
+def getFit(stats, order, xOffset=0):
+    fit = stats.fitPolynomial(order)
+
+    if fit is not None and xOffset:
+        fit = Chebyshev(fit.coef, domain=fit.domain - xOffset)
+
+    return fit
+
+
+# The fit evaluated on a fixed grid between xMin and xMax
+def evaluateFit(fit, xMin, xMax):
+    if fit is None or isnan(xMin) or isnan(xMax):
+        return [], []
+
+    xGrid = linspace(xMin, xMax, rtbsaUtils.FIT_GRID_POINTS)
+    return xGrid, fit(xGrid)
+
+
+# What the slope label says about fit: the slope of a straight line, the peak
+# of a parabola or a cubic's coefficients. None leaves it as it was
+def fitLabel(fit, order, linear=False):
+    if fit is None:
+        return None
+
+    co = powerCoefficients(fit, order)
+
+    if linear:
+        return 'Slope: ' + str("{:.3e}".format(co[0]))
+
+    if order == 2:
+        return 'Peak: ' + str(-co[1] / (2 * co[0]))
+
+    if order == 3:
+        return (str("{:.2e}".format(co[0])) + 'x^3'
+                + str("+{:.2e}".format(co[1])) + 'x^2'
+                + str("+{:.2e}".format(co[2])) + 'x'
+                + str("+{:.2e}".format(co[3])))
+
+    return None
+
+
+def waitBriefly():
+    sleep(0.01)
+
+
+############################################################################
+# Runs without a GUI, printing a summary of the window every interval seconds
+# until interrupted: A vs time for one device, B vs A for two, and the
+# correlation matrix for more than that. The timing metrics for each interval
+# get printed too if showMetrics is set, and go to metricsExporter if there is
+# one. If record is given, everything is recorded to that directory as well.
+# Returns the exit status.
+############################################################################
+def runHeadless(devices, user, numPoints=2800, numStdDevs=None, fitOrder=1,
+                interval=1.0, source=None, showMetrics=False,
+                metricsExporter=None, record=None):
+    core = BSACore(user, numPoints, source=source)
+
+    if len(devices) == 1:
+        started = core.startTimeSeries(devices[0]) is not None
+    elif len(devices) == 2:
+        core.startPair(*devices)
+        started = True
+    else:
+        core.startMatrix(devices)
+        started = True
+
+    if not started:
+        core.stop()
+        return 1
+
+    try:
+        while True:
+            sleep(interval)
+
+            if core.getRate() < 1:
+                print "Waiting for beam rate to be at least 1Hz..."
+                continue
+
+            # Not until there's beam, which it needs. It starts with what's
+            # in the buffers, so nothing from before then is lost
+            if record:
+                core.startRecording(record)
+                record = None
+
+            print core.summary(numStdDevs, fitOrder)
+
+            report = core.metrics.rollover(core.missedPulses())
+
+            if showMetrics:
+                print describe(report)
+
+            if metricsExporter:
+                metricsExporter.export(report)
+
+            if core.inactive():
+                print "Stopping due to inactivity"
+                break
+
+    except KeyboardInterrupt:
+        pass
+
+    print "Stopped ({N} missed pulses)".format(N=core.stop())
+    return 0
@@ -0,0 +1,69 @@
+from numpy import concatenate, empty, flatnonzero, isnan, maximum, minimum
+
+# The fewest columns we'll decimate to, for when the plot hasn't been laid
+# out yet and says it's 0 pixels wide
+MIN_COLUMNS = 100
+
+
+############################################################################
+# Cuts a trace down to what can actually be seen at the plot's resolution
+# before it goes to pyqtgraph, so drawing costs the same whether the window
+# is a thousand pulses or a million: x (which has to be in increasing order,
+# like every time trace and spectrum here) is split into numColumns equal
+# columns, and each column is reduced to its min and max. That keeps every
+# spike (which an average or every nth point would lose) while drawing at
+# most two points per pixel.
+#
+# Everything's done with numpy reductions over the runs of each column, with
+# no Python loops over points. nans are dropped first.
+############################################################################
+def columnExtrema(xData, yData, numColumns):
+    valid = ~isnan(yData)
+
+    if not valid.all():
+        xData = xData[valid]
+        yData = yData[valid]
+
+    if not xData.size:
+        return xData, yData, yData
+
+    xMin = xData[0]
+    span = float(xData[-1] - xMin) or 1.0
+
+    columns = ((xData - xMin) * (numColumns / span)).astype(int)
+
+    # Where each column's run of points starts
+    starts = concatenate(([0], flatnonzero(columns[1:] != columns[:-1]) + 1))
+
+    return (xData[starts], minimum.reduceat(yData, starts),
+            maximum.reduceat(yData, starts))
+
+
+############################################################################
+# The same as one trace: for each column, a point at its min and one at its
+# max, in the column's x position. Traces short enough to draw as they are
+# come back untouched.
+############################################################################
+def minMaxTrace(xData, yData, numColumns):
+    if xData.size <= 2 * numColumns:
+        return xData, yData
+
+    xs, mins, maxs = columnExtrema(xData, yData, numColumns)
+
+    xOut = empty(2 * xs.size)
+    yOut = empty(2 * xs.size)
+    xOut[0::2] = xs
+    xOut[1::2] = xs
+    yOut[0::2] = mins
+    yOut[1::2] = maxs
+
+    return xOut, yOut
+
+
+# How many columns to decimate a trace to for a plot that's pixelWidth wide
+# and showing visibleSpan of the trace's x range of dataSpan
+def columnsFor(pixelWidth, dataSpan, visibleSpan):
+    if visibleSpan <= 0:
+        return MIN_COLUMNS
+
+    return max(MIN_COLUMNS, int(pixelWidth * float(dataSpan) / visibleSpan))
@@ -0,0 +1,95 @@
+from numpy import (absolute, compress, copyto, count_nonzero, empty, errstate,
+                   isnan, less, logical_and, logical_not, sqrt, subtract)
+
+from rtbsaUtils import BUFF_LENGTH_LIMIT
+
+
+############################################################################
+# Runs a set of filters over some equally long channels (i.e. the synchronized
+# A and B buffers) by ANDing every filter into a single boolean mask, and then
+# applies that mask to every channel once.
+#
+# A filter is just a function that takes the pipeline, the list of channels
+# and the mask, and clears the mask wherever it wants a pulse thrown out (see
+# notNan, below and withinStdDevs). Filters run in order, so a filter that
+# looks at the data (like withinStdDevs) only sees the pulses that survived
+# the ones before it.
+#
+# Everything happens in preallocated buffers: the results are views into the
+# pipeline's output buffers, so they're only good until the next apply.
+############################################################################
+class FilterPipeline(object):
+
+    def __init__(self, numChannels, capacity=BUFF_LENGTH_LIMIT):
+        self.filters = []
+
+        self.mask = empty(capacity, dtype=bool)
+
+        # Scratch space for filters
+        self.scratchMask = empty(capacity, dtype=bool)
+        self.scratch = empty(capacity)
+
+        self.outputs = [empty(capacity) for _ in xrange(numChannels)]
+
+    def apply(self, channels):
+        size = channels[0].size
+        mask = self.mask[:size]
+        mask[:] = True
+
+        # Comparisons against nans are expected here
+        with errstate(invalid='ignore'):
+            for filterFunc in self.filters:
+                filterFunc(self, channels, mask)
+
+        count = count_nonzero(mask)
+
+        return [compress(mask, channel, out=output[:count])
+                for channel, output in zip(channels, self.outputs)]
+
+
+def notNan(channel):
+    def filterFunc(pipeline, channels, mask):
+        isNan = pipeline.scratchMask[:mask.size]
+        isnan(channels[channel], out=isNan)
+        logical_not(isNan, out=isNan)
+        logical_and(mask, isNan, out=mask)
+
+    return filterFunc
+
+
+def below(channel, limit):
+    def filterFunc(pipeline, channels, mask):
+        isBelow = pipeline.scratchMask[:mask.size]
+        less(channels[channel], limit, out=isBelow)
+        logical_and(mask, isBelow, out=mask)
+
+    return filterFunc
+
+
+# Keeps the pulses within numStdDevs standard deviations of the mean, where
+# the mean and standard deviation are over the pulses still in the mask
+def withinStdDevs(channel, numStdDevs):
+    def filterFunc(pipeline, channels, mask):
+        count = count_nonzero(mask)
+        if not count:
+            return
+
+        data = channels[channel]
+        deviation = pipeline.scratch[:mask.size]
+        excluded = pipeline.scratchMask[:mask.size]
+        logical_not(mask, out=excluded)
+
+        copyto(deviation, data)
+        copyto(deviation, 0.0, where=excluded)
+        average = deviation.sum() / count
+
+        subtract(data, average, out=deviation)
+        copyto(deviation, 0.0, where=excluded)
+        stdDev = sqrt(deviation.dot(deviation) / count)
+
+        absolute(deviation, out=deviation)
+        isWithin = excluded
+        less(deviation, numStdDevs * stdDev, out=isWithin)
+        logical_and(mask, isWithin, out=mask)
+
+    return filterFunc
@@ -0,0 +1,63 @@
+from collections import namedtuple
+
+from rtbsaDecimate import columnsFor
+
+############################################################################
+# What goes back and forth between the GUI and the analysis worker (see
+# rtbsaWorker). Everything's a namedtuple, so nothing can change a frame
+# once it's been worked out, and every array in one is its own copy rather
+# than one of the buffers the core reuses, so the Qt thread can draw it while
+# the worker's busy with the next one.
+############################################################################
+
+# What the analysis needs from the controls and the plot, read on the Qt
+# thread when the frame's asked for: the standard deviation cut (None if the
+# filter's off), the fit order (None if there's no fit) and whether it's the
+# straight line fit, the x range showing and how many pixels wide the plot
+# is, whether autoscale is on, and the spectrogram's current color levels
+FrameSettings = namedtuple("FrameSettings",
+                           "numStdDevs fitOrder linearFit viewRange "
+                           "pixelWidth autoscale levels")
+
+# The range of the data and the numbers for the overlay labels (None where a
+# plot doesn't have them)
+Labels = namedtuple("Labels", "minX maxX minY maxY mean std corr")
+
+# A fit evaluated over the plot, and what the slope label should say (None
+# to leave it as it is)
+FitCurve = namedtuple("FitCurve", "x y text")
+
+# A trace (already decimated for the plot's width), its labels (None if the
+# stats couldn't be worked out) and its fit (None if there isn't one).
+# Covers A vs time, B vs A and the periodogram and Welch spectra
+TraceFrame = namedtuple("TraceFrame", "x y labels fit")
+
+# The long A vs time plot, which also has the bands of the bins' mins and
+# maxs as (x, y) pairs and how many pulses each bin stands for
+HistoryFrame = namedtuple("HistoryFrame",
+                          TraceFrame._fields + ("lower", "upper", "factor"))
+
+# The spectrogram image (segments x frequencies, in dB), the color levels it
+# was scaled with, where it goes on the plot as (x, y, width, height) and the
+# highest frequency
+SpectrogramFrame = namedtuple("SpectrogramFrame",
+                              "image levels rect maxFrequency")
+
+# The coherence of B with A, the line it has to be above to count, the
+# frequencies and phases where it is and how many segments went into it
+CoherenceFrame = namedtuple("CoherenceFrame",
+                            "frequencies coherence threshold phaseFrequencies "
+                            "phases count")
+
+# The correlation matrix image (with 0 for the pairs without enough data) and
+# the devices that correlate best with the first one
+MatrixFrame = namedtuple("MatrixFrame", "image strongest")
+
+
+# How many columns to decimate a trace with the given (sorted) x values to so
+# that there are two points per pixel at the zoom in settings (see
+# rtbsaDecimate)
+def plotColumns(settings, xData):
+    xMin, xMax = settings.viewRange
+    dataSpan = xData[-1] - xData[0] if xData.size else 0
+    return columnsFor(settings.pixelWidth, dataSpan, xMax - xMin)
@@ -0,0 +1,261 @@
+from time import sleep
+
+from numpy import arange, empty, errstate, isnan, nan, sqrt, zeros
+
+from rtbsaBuffer import MAX_SNAPSHOT_RETRIES
+from rtbsaUtils import BUFF_LENGTH_LIMIT, padWithNans
+
+# How many pulses a bin of each tier covers, and how many bins every tier
+# keeps. At 120Hz that's about 14 minutes, 2.3 hours and 23 hours of history
+TIER_FACTORS = (10, 100, 1000)
+TIER_CAPACITY = 10000
+
+# The longest window the A vs time plot can show
+MAX_HISTORY_POINTS = TIER_FACTORS[-1] * TIER_CAPACITY
+
+# The most bins (or raw points) we'll hand the plot at once
+MAX_PLOT_BINS = 5000
+
+
+############################################################################
+# One level of decimation: a ring of TIER_CAPACITY bins of factor pulses each,
+# indexed by bin number (pulse // factor) the same way RingBuffer is indexed
+# by pulse. Every bin keeps the min, max, sum, sum of squares and count of
+# the samples in it, so means and standard deviations over any run of bins
+# come out exact rather than being averages of averages.
+############################################################################
+class Tier(object):
+
+    def __init__(self, factor, capacity=TIER_CAPACITY):
+        self.factor = factor
+        self.capacity = capacity
+
+        self.mins = empty(capacity)
+        self.maxs = empty(capacity)
+        self.sums = zeros(capacity)
+        self.squares = zeros(capacity)
+        self.counts = zeros(capacity, dtype=int)
+
+        # The newest bin number
+        self.bin = None
+
+        self.clear()
+
+    def clear(self):
+        self.mins[:] = nan
+        self.maxs[:] = nan
+        self.sums[:] = 0
+        self.squares[:] = 0
+        self.counts[:] = 0
+        self.bin = None
+
+    # Moves the newest bin up to bin, emptying every bin in between
+    def advance(self, bin):
+        if self.bin is None or bin - self.bin >= self.capacity:
+            self.clear()
+
+        elif bin > self.bin:
+            start = (self.bin + 1) % self.capacity
+            end = (bin + 1) % self.capacity
+
+            padWithNans(self.mins, start, end)
+            padWithNans(self.maxs, start, end)
+
+            for array in (self.sums, self.squares, self.counts):
+                if end < start:
+                    array[start:] = 0
+                    array[:end] = 0
+                else:
+                    array[start:end] = 0
+
+        else:
+            return
+
+        self.bin = bin
+
+    def add(self, bin, low, high, total, square, count):
+        if self.bin - bin >= self.capacity:
+            return
+
+        slot = bin % self.capacity
+
+        if self.counts[slot]:
+            if low < self.mins[slot]:
+                self.mins[slot] = low
+            if high > self.maxs[slot]:
+                self.maxs[slot] = high
+        else:
+            self.mins[slot] = low
+            self.maxs[slot] = high
+
+        self.sums[slot] += total
+        self.squares[slot] += square
+        self.counts[slot] += count
+
+
+############################################################################
+# What the plot gets for a stretch of history: for each bin (or raw pulse),
+# the pulse it starts at and its min, max and mean (nan where there's
+# nothing), plus the exact count, mean and standard deviation of every
+# sample in the stretch. factor is how many pulses a bin covers (1 for raw).
+############################################################################
+class HistoryWindow(object):
+
+    def __init__(self, factor, pulses, mins, maxs, means, counts, sums,
+                 squares):
+        self.factor = factor
+        self.pulses = pulses
+        self.mins = mins
+        self.maxs = maxs
+        self.means = means
+
+        self.count = counts.sum()
+
+        if self.count:
+            self.mean = sums.sum() / self.count
+            variance = squares.sum() / self.count - self.mean ** 2
+            self.std = sqrt(max(variance, 0.0))
+        else:
+            self.mean = nan
+            self.std = nan
+
+
+############################################################################
+# Device A's history for the A vs time plot, far past what the ring buffers
+# hold: the same samples, decimated into tiers of ever coarser bins (see
+# TIER_FACTORS) so that a window of hours costs no more to keep or to draw
+# than one of seconds. The full rate recent history stays in the ring buffer.
+#
+# Like RingBuffer, it has one writer (the callbacks) and one reader, which
+# reads through a sequence counter instead of a lock. Only the finest tier is
+# touched per sample; the coarser ones get each of its bins as it finishes.
+############################################################################
+class TieredHistory(object):
+
+    def __init__(self, factors=TIER_FACTORS, capacity=TIER_CAPACITY):
+        self.tiers = [Tier(factor, capacity) for factor in factors]
+        self.lastPulse = None
+        self.seq = 0
+
+    def clear(self):
+        self.seq += 1
+
+        for tier in self.tiers:
+            tier.clear()
+
+        self.lastPulse = None
+        self.seq += 1
+
+    # Bulk load a history buffer the same way RingBuffer.load does
+    def load(self, values, pulse):
+        firstPulse = pulse - len(values) + 1
+
+        for offset, value in enumerate(values):
+            self.append(firstPulse + offset, value)
+
+    # nans (missed or rejected pulses) move the bins along but aren't counted
+    def append(self, pulse, value):
+        if self.lastPulse is not None and pulse <= self.lastPulse:
+            return
+
+        self.seq += 1
+
+        finest = self.tiers[0]
+        bin = pulse // finest.factor
+
+        if bin != finest.bin:
+            self.finishBin(pulse)
+            finest.advance(bin)
+
+        if not isnan(value):
+            finest.add(bin, value, value, value, value * value, 1)
+
+        self.lastPulse = pulse
+        self.seq += 1
+
+    # Passes the finest tier's newest bin up to every coarser tier, which all
+    # get moved up to pulse's bins first
+    def finishBin(self, pulse):
+        finest = self.tiers[0]
+        finished = finest.bin
+
+        for tier in self.tiers[1:]:
+            tier.advance(pulse // tier.factor)
+
+        if finished is None:
+            return
+
+        slot = finished % finest.capacity
+        count = finest.counts[slot]
+
+        if not count:
+            return
+
+        low, high = finest.mins[slot], finest.maxs[slot]
+        total, square = finest.sums[slot], finest.squares[slot]
+        firstPulse = finished * finest.factor
+
+        for tier in self.tiers[1:]:
+            tier.add(firstPulse // tier.factor, low, high, total, square, count)
+
+    ############################################################################
+    # Which tier to draw pulses [firstPulse, endPulse] from: the finest one
+    # that can show them in MAX_PLOT_BINS bins or fewer and still goes back far
+    # enough, or the coarsest if none of them can. None means the ring buffer
+    # can do it at full rate.
+    ############################################################################
+    def chooseTier(self, firstPulse, endPulse):
+        if self.lastPulse is None:
+            return None
+
+        span = endPulse - firstPulse + 1
+        age = self.lastPulse - firstPulse + 1
+
+        if span <= MAX_PLOT_BINS and age <= BUFF_LENGTH_LIMIT:
+            return None
+
+        for index, tier in enumerate(self.tiers):
+            if (span <= MAX_PLOT_BINS * tier.factor
+                    and age <= tier.capacity * tier.factor):
+                return index
+
+        return len(self.tiers) - 1
+
+    # The bins of tier index covering pulses [firstPulse, endPulse], oldest
+    # first, as a HistoryWindow
+    def window(self, index, firstPulse, endPulse):
+        for _ in xrange(MAX_SNAPSHOT_RETRIES):
+            seq = self.seq
+
+            if seq % 2:
+                sleep(0)
+                continue
+
+            window = self.copyWindow(index, firstPulse, endPulse)
+
+            if self.seq == seq:
+                return window
+
+        return self.copyWindow(index, firstPulse, endPulse)
+
+    def copyWindow(self, index, firstPulse, endPulse):
+        tier = self.tiers[index]
+        newestBin = tier.bin
+
+        if newestBin is None:
+            bins = arange(0)
+        else:
+            firstBin = max(firstPulse // tier.factor,
+                           newestBin - tier.capacity + 1)
+            bins = arange(firstBin, min(endPulse // tier.factor, newestBin) + 1)
+
+        slots = bins % tier.capacity
+        counts = tier.counts[slots]
+        sums = tier.sums[slots]
+
+        with errstate(invalid='ignore', divide='ignore'):
+            means = sums / counts
+
+        return HistoryWindow(tier.factor, bins * tier.factor, tier.mins[slots],
+                             tier.maxs[slots], means, counts, sums,
+                             tier.squares[slots])
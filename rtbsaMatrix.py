@@ -0,0 +1,174 @@
+from time import sleep
+
+from numpy import clip, dot, empty, errstate, isnan, nan, sqrt, where
+
+from rtbsaBuffer import MAX_SNAPSHOT_RETRIES
+from rtbsaUtils import BUFF_LENGTH_LIMIT, padWithNans
+
+
+############################################################################
+# The many-signal version of RingBuffer: one (signals x pulses) array where
+# every row is a signal and every column is a pulse slot, so that all of the
+# signals stay lined up by pulse number and a window of all of them can be
+# handed to numpy in one go.
+#
+# Each row keeps track of its own newest pulse. A row that's fallen behind
+# (or stopped updating altogether) reads as nans for the pulses it hasn't
+# gotten yet rather than holding on to whatever was in those slots a lap ago.
+############################################################################
+class MultiBuffer(object):
+
+    def __init__(self, numSignals, capacity=BUFF_LENGTH_LIMIT):
+        self.numSignals = numSignals
+        self.capacity = capacity
+
+        self.data = empty((numSignals, capacity))
+        self.data[:] = nan
+
+        # Only ever touched by the reader
+        self.snapshotBuffer = empty((numSignals, capacity))
+
+        self.lastPulses = [None] * numSignals
+        self.missedPulses = 0
+
+        self.seq = 0
+
+    def clear(self):
+        self.seq += 1
+        self.data[:] = nan
+        self.lastPulses = [None] * self.numSignals
+        self.missedPulses = 0
+        self.seq += 1
+
+    # Same as RingBuffer.append, for one row
+    def append(self, row, pulse, value):
+        lastPulse = self.lastPulses[row]
+
+        if lastPulse is None:
+            elapsedPulses = 1
+
+        else:
+            elapsedPulses = pulse - lastPulse
+
+            if elapsedPulses <= 0:
+                return 0
+
+        self.seq += 1
+
+        if elapsedPulses > 1:
+            self.missedPulses += elapsedPulses - 1
+
+            if elapsedPulses > self.capacity:
+                self.data[row] = nan
+            else:
+                padWithNans(self.data[row], (lastPulse + 1) % self.capacity,
+                            pulse % self.capacity)
+
+        self.data[row, pulse % self.capacity] = value
+        self.lastPulses[row] = pulse
+        self.seq += 1
+
+        return elapsedPulses
+
+    def newestPulse(self):
+        pulses = [pulse for pulse in self.lastPulses if pulse is not None]
+        return max(pulses) if pulses else None
+
+    ############################################################################
+    # Returns the (numSignals x numPoints) window of the numPoints pulses ending
+    # at the newest pulse any signal has seen, oldest first. Like
+    # RingBuffer.snapshot, it's a view into snapshotBuffer that's only good
+    # until the next call.
+    ############################################################################
+    def snapshot(self, numPoints):
+        out = self.snapshotBuffer[:, :numPoints]
+
+        for _ in xrange(MAX_SNAPSHOT_RETRIES):
+            seq = self.seq
+
+            if seq % 2:
+                sleep(0)
+                continue
+
+            self.copyWindow(out, numPoints)
+
+            if self.seq == seq:
+                break
+
+        else:
+            self.copyWindow(out, numPoints)
+
+        return out
+
+    def copyWindow(self, out, numPoints):
+        endPulse = self.newestPulse()
+
+        if endPulse is None:
+            out[:] = nan
+            return
+
+        firstPulse = endPulse - numPoints + 1
+        start = firstPulse % self.capacity
+
+        if start + numPoints <= self.capacity:
+            out[:] = self.data[:, start:start + numPoints]
+        else:
+            split = self.capacity - start
+            out[:, :split] = self.data[:, start:]
+            out[:, split:] = self.data[:, :numPoints - split]
+
+        # Blank out whatever each row doesn't actually have
+        for row, lastPulse in enumerate(self.lastPulses):
+            if lastPulse is None:
+                out[row] = nan
+                continue
+
+            numValid = lastPulse - firstPulse + 1
+            out[row, max(0, numValid):] = nan
+
+            numOverwritten = lastPulse - self.capacity + 1 - firstPulse
+            if numOverwritten > 0:
+                out[row, :numOverwritten] = nan
+
+
+############################################################################
+# The correlation coefficient between every pair of rows of data, using, for
+# each pair, only the pulses where both signals have a value (so a nan in one
+# signal doesn't throw out that pulse for everyone else). Everything is done
+# as a handful of (signals x pulses) . (pulses x signals) products, with no
+# Python loops over signals.
+#
+# Each row has its mean taken out first. BSA signals often sit far from zero
+# next to how much they move (say 1e4 give or take 1e-4), and the sums below
+# would lose all of that in rounding otherwise.
+#
+# Pairs with fewer than two shared pulses or no variance come out as nan.
+############################################################################
+def correlationMatrix(data):
+    valid = ~isnan(data)
+    weights = valid.astype(float)
+
+    # Over the pulses each row has (rows with none get a nan mean, which
+    # doesn't matter since none of their values get used)
+    with errstate(invalid='ignore', divide='ignore'):
+        means = where(valid, data, 0.0).sum(axis=1) / weights.sum(axis=1)
+
+    values = where(valid, data - means[:, None], 0.0)
+
+    # For rows i and j, over the pulses both of them have:
+    # counts[i, j] is how many there are, sums[i, j] is the sum of row i,
+    # and squares[i, j] is the sum of the squares of row i
+    counts = dot(weights, weights.T)
+    sums = dot(values, weights.T)
+    squares = dot(values * values, weights.T)
+    products = dot(values, values.T)
+
+    with errstate(invalid='ignore', divide='ignore'):
+        covariance = products - sums * sums.T / counts
+        variance = squares - sums * sums / counts
+        correlation = covariance / sqrt(variance * variance.T)
+
+    correlation[counts < 2] = nan
+
+    # Rounding can still nudge a perfect correlation just past 1
+    return clip(correlation, -1.0, 1.0)
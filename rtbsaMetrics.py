@@ -0,0 +1,147 @@
+from json import dumps
+from socket import AF_INET, SOCK_DGRAM, socket
+from time import time
+
+
+############################################################################
+# Timing probes for the hot path. Whoever's timing something (the callbacks,
+# syncing, filtering, fitting, drawing) calls record with how long it took,
+# and once in a while the reader calls rollover to get a report of everything
+# since the last one (and start a new window).
+#
+# record runs on the pyepics and analysis threads as well as the Qt thread, so
+# it doesn't lock anything. A sample that lands right as a window rolls over
+# can end up in the wrong window or get lost, which is fine for this.
+############################################################################
+class Metrics(object):
+
+    def __init__(self):
+        self.timings = {}
+        self.windowStart = time()
+
+    def record(self, name, seconds):
+        timing = self.timings.get(name)
+
+        # A new timing goes in with its first sample already in it, so the
+        # reader never sees one with nothing in it
+        if timing is None:
+            self.timings[name] = Timing(seconds)
+        else:
+            timing.add(seconds)
+
+    ############################################################################
+    # Returns a dict with the report for the window that just ended: for every
+    # stage, how many times it ran, how many times a second that is and its
+    # mean and max time in milliseconds. missedPulses is passed through.
+    ############################################################################
+    def rollover(self, missedPulses=0):
+        now = time()
+        elapsed = max(now - self.windowStart, 1e-9)
+        timings, self.timings = self.timings, {}
+        self.windowStart = now
+
+        stages = {}
+        for name, timing in timings.items():
+            stages[name] = {"count": timing.count,
+                            "rate": timing.count / elapsed,
+                            "meanMs": 1e3 * timing.total / timing.count,
+                            "maxMs": 1e3 * timing.maximum}
+
+        return {"time": now, "seconds": elapsed, "missedPulses": missedPulses,
+                "stages": stages}
+
+
+class Timing(object):
+
+    def __init__(self, seconds):
+        self.count = 1
+        self.total = seconds
+        self.maximum = seconds
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+
+
+# A one line rundown of a report, for the overlay and the headless mode
+def describe(report):
+    stages = report["stages"]
+    parts = []
+
+    if "frame" in stages:
+        parts.append("{F:.1f} fps".format(F=stages["frame"]["rate"]))
+
+    if "callback" in stages:
+        parts.append("{C:.0f} callbacks/s".format(C=stages["callback"]["rate"]))
+
+    parts.append("{N} missed pulses".format(N=report["missedPulses"]))
+
+    for name in ("frame", "analysis", "callback", "sync", "filter", "fit",
+                 "fft", "correlation", "draw"):
+        if name in stages:
+            parts.append("{S} {M:.2f}ms (max {X:.2f})".format(
+                S=name, M=stages[name]["meanMs"], X=stages[name]["maxMs"]))
+
+    return " | ".join(parts)
+
+
+############################################################################
+# How long each stage of starting up took, for --startup-times. started is when
+# the clock started (i.e. before the imports); each mark ends a stage.
+############################################################################
+class StartupTimes(object):
+
+    def __init__(self, started):
+        self.started = started
+        self.last = started
+        self.stages = []
+
+    def mark(self, stage):
+        now = time()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    def describe(self):
+        return "Started up in {T:.0f}ms: ".format(
+            T=1e3 * (self.last - self.started)) + ", ".join(
+            "{S} {M:.0f}ms".format(S=stage, M=1e3 * seconds)
+            for stage, seconds in self.stages)
+
+
+############################################################################
+# Sends every report, as a line of JSON, to a file (appended to) and/or a UDP
+# address given as (host, port), for whatever's doing the monitoring. Either
+# one can be left out.
+############################################################################
+class MetricsExporter(object):
+
+    def __init__(self, path=None, address=None):
+        self.file = open(path, "a") if path else None
+        self.address = address
+        self.socket = socket(AF_INET, SOCK_DGRAM) if address else None
+
+    def export(self, report):
+        line = dumps(report, sort_keys=True)
+
+        if self.file:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+        if self.socket:
+            try:
+                self.socket.sendto(line, self.address)
+
+            # Nobody listening is their problem, not ours
+            except IOError:
+                pass
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+        if self.socket:
+            self.socket.close()
+            self.socket = None
@@ -0,0 +1,114 @@
+# The timing system's fiducial rate, which all of the LCLS beam rates divide
+FIDUCIAL_RATE = 360.0
+
+# LCLS BSA timestamps carry the pulse ID (the 360Hz fiducial counter, which
+# wraps around every PULSE_ID_WRAP fiducials) in the low 17 bits of their
+# nanoseconds. IDs of PULSE_ID_WRAP and up mean there isn't one
+PULSE_ID_MASK = 0x1ffff
+PULSE_ID_WRAP = 131040
+
+# How many fiducials a pulse ID can be off from where the timestamp says it
+# should be before we decide it's garbage and go by the timestamp instead
+MAX_FIDUCIAL_ERROR = 36
+
+
+# The pulse ID in a timestamp's nanoseconds, or None if it doesn't have one
+def pulseIdFrom(nanoseconds):
+    if nanoseconds is None:
+        return None
+
+    pulseId = int(nanoseconds) & PULSE_ID_MASK
+
+    if pulseId >= PULSE_ID_WRAP:
+        return None
+
+    return pulseId
+
+
+# The nanoseconds of a timestamp, with pulseId where the real timing system
+# puts it (for the simulator)
+def withPulseId(timeStamp, pulseId):
+    nanoseconds = int((timeStamp % 1) * 1e9)
+    return (nanoseconds & ~PULSE_ID_MASK) | pulseId
+
+
+############################################################################
+# Turns samples' timestamps into the pulse numbers the ring buffers are keyed
+# by, so that the same shot gets the same number on every device.
+#
+# Where the pulse ID is there (and usePulseIds is set, i.e. on LCLS), a sample
+# is placed by it exactly: the ID is unwrapped into a fiducial count that
+# keeps going up forever, using the timestamp only to work out how many
+# times it's wrapped since the last one. Everything else (other machines, the
+# replays, PVs without one) goes by timestamp times the rate, as close as
+# that gets, counted from the last pulse ID so the two line up.
+#
+# The fiducial count is then divided down to the beam rate. When the rate
+# changes, the pulse numbers carry on from where they were rather than jumping
+# (so nothing needs to be started over), and every device gets the same
+# numbers since there's one PulseClock for all of them.
+#
+# Only the callbacks call pulse, all from the one pyepics thread.
+############################################################################
+class PulseClock(object):
+
+    def __init__(self, usePulseIds=True):
+        self.usePulseIds = usePulseIds
+
+        # The newest real pulse ID's fiducial and the timestamp it came with,
+        # which everything else gets counted from
+        self.referenceFiducial = None
+        self.referenceTime = None
+
+        self.rate = None
+        self.offset = 0
+
+        self.lastFiducial = None
+        self.lastPulse = None
+
+    def fiducial(self, timeStamp, nanoseconds=None):
+        if self.referenceFiducial is None:
+            expected = timeStamp * FIDUCIAL_RATE
+        else:
+            expected = (self.referenceFiducial
+                        + (timeStamp - self.referenceTime) * FIDUCIAL_RATE)
+
+        pulseId = pulseIdFrom(nanoseconds) if self.usePulseIds else None
+
+        if pulseId is None:
+            return expected
+
+        # The fiducial with this pulse ID closest to where it should be
+        fiducial = pulseId + PULSE_ID_WRAP * int(
+            round((expected - pulseId) / PULSE_ID_WRAP))
+
+        if (self.referenceFiducial is not None
+                and abs(fiducial - expected) > MAX_FIDUCIAL_ERROR):
+            return expected
+
+        self.referenceFiducial = fiducial
+        self.referenceTime = timeStamp
+        return fiducial
+
+    def pulse(self, timeStamp, rate, nanoseconds=None):
+        fiducial = self.fiducial(timeStamp, nanoseconds)
+
+        if rate != self.rate:
+            self.setRate(rate)
+
+        pulse = int(round(fiducial * rate / FIDUCIAL_RATE)) + self.offset
+
+        if self.lastPulse is None or pulse > self.lastPulse:
+            self.lastFiducial = fiducial
+            self.lastPulse = pulse
+
+        return pulse
+
+    # Whatever was the newest pulse keeps its number at the new rate, so the
+    # ones after it carry on from there
+    def setRate(self, rate):
+        self.rate = rate
+
+        if self.lastPulse is not None:
+            self.offset = self.lastPulse - int(
+                round(self.lastFiducial * rate / FIDUCIAL_RATE))
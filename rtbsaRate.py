@@ -0,0 +1,33 @@
+############################################################################
+# Keeps track of the beam rate by putting a callback on the rate PV (i.e.
+# IOC:IN20:EV01:RG01_ACTRATE or LINAC:RateSetpt), so reading the rate is just
+# an attribute lookup rather than a channel access round trip plus a dict
+# lookup. rateDict translates the PV's enum value into Hz.
+#
+# Every listener gets called with the new rate in Hz whenever it changes.
+# Note that they get called from the pyepics thread. pvFactory makes the PV
+# (see rtbsaSource).
+############################################################################
+class RateMonitor(object):
+
+    def __init__(self, pvName, rateDict, pvFactory):
+        self.rateDict = rateDict
+        self.rate = 0.0
+        self.listeners = []
+        self.pv = pvFactory(pvName, callback=self.rateCallback)
+
+    # noinspection PyUnusedLocal
+    def rateCallback(self, pvname=None, value=None, **kw):
+        rate = self.rateDict.get(value, 0.0)
+
+        if rate == self.rate:
+            return
+
+        self.rate = rate
+
+        for listener in self.listeners:
+            listener(rate)
+
+    # Whether there's enough beam to bother acquiring/plotting
+    def hasBeam(self):
+        return self.rate >= 1
@@ -0,0 +1,297 @@
+from bisect import bisect_left
+from collections import deque
+from glob import glob
+from json import dump, load
+from os import makedirs, path, rename
+from threading import Event, Thread
+from time import time
+
+from numpy import (arange, argsort, dtype, empty, isnan, ndarray, nan, save)
+from numpy import load as loadArray
+
+# Every sample on disk is one of these: which PV it's from (its index in the
+# header's pvs), its pulse number, its timestamp and its value
+SAMPLE_DTYPE = dtype([("pv", "<u2"), ("pulse", "<i8"), ("timestamp", "<f8"),
+                      ("value", "<f8")])
+
+HEADER_NAME = "header.json"
+SEGMENT_NAME = "segment-{N:05d}.npy"
+
+# The defaults for how many samples go in a segment file (24 bytes each, so
+# this is 6MB) and how old the oldest sample in one can get before it's
+# written out anyway, so a crash loses at most that much
+SEGMENT_LENGTH = 1 << 18
+SEGMENT_SECONDS = 60.0
+
+# How often the writer wakes up to move samples from the queue into the
+# current segment
+FLUSH_INTERVAL = 0.5
+
+# How many samples can pile up waiting for the writer before we start throwing
+# them away (and counting them in dropped) instead of eating all of our memory
+MAX_PENDING = 4 * SEGMENT_LENGTH
+
+# How far into the first segment to look for its oldest pulse. The histories
+# a recording starts with are at most BUFF_LENGTH_LIMIT pulses for each of a
+# couple of PVs, so they're well within this
+START_SCAN_LENGTH = 1 << 16
+
+
+############################################################################
+# Records BSA streams to disk while they're being plotted. A recording is a
+# directory holding header.json (the PV names, mode, beam rate and so on) and
+# a numbered series of segment files, each a plain .npy array of SAMPLE_DTYPE
+# sorted by arrival. Segments are only ever added, never rewritten, so a
+# recording that's still going (or that crashed) can be read up to its newest
+# segment, and the reader can memory map every segment instead of loading it.
+#
+# record is called from the PV callbacks, so all it does is put the sample on
+# a queue; the writer thread moves the queue into a preallocated segment and
+# writes the segment out when it's full or old enough. Memory use is bounded
+# by SEGMENT_LENGTH plus MAX_PENDING no matter how long we record for.
+############################################################################
+class Recorder(object):
+
+    def __init__(self, directory, pvs, mode=None, rate=None, user=None,
+                 segmentLength=SEGMENT_LENGTH, segmentSeconds=SEGMENT_SECONDS):
+        self.directory = directory
+        self.pvs = list(pvs)
+        self.segmentLength = segmentLength
+        self.segmentSeconds = segmentSeconds
+
+        if not path.isdir(directory):
+            makedirs(directory)
+
+        with open(path.join(directory, HEADER_NAME), "w") as f:
+            dump({"pvs": self.pvs, "mode": mode, "rate": rate, "user": user,
+                  "started": time(), "format": 1}, f, indent=1)
+
+        # deque's append and popleft are atomic, so the callbacks and the
+        # writer don't need a lock
+        self.pending = deque()
+        self.dropped = 0
+
+        self.segment = empty(segmentLength, dtype=SAMPLE_DTYPE)
+        self.segmentSize = 0
+        self.segmentStart = None
+        self.segmentNumber = 0
+
+        # How many samples have made it to disk
+        self.written = 0
+
+        # For each PV, the first pulse recorded live and the last one from
+        # its history, so that the pulses the two overlap by are only written
+        # once. Only the writer touches these
+        self.firstLivePulses = {}
+        self.historyEnds = {}
+
+        self.stopping = Event()
+        self.thread = Thread(target=self.run, name="Recorder")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, pv, pulse, timeStamp, value):
+        if len(self.pending) >= MAX_PENDING:
+            self.dropped += 1
+            return
+
+        self.pending.append((pv, pulse, timeStamp, value))
+
+    # A whole window of values for the pulses ending at pulse, oldest first
+    # (i.e. what was already in a ring buffer when the recording started).
+    # The nans are the pulses we didn't get, so they're left out. Pulses that
+    # also get recorded live are only written once (see drain)
+    def recordHistory(self, pv, values, pulse, timeStamp, rate):
+        pulses = arange(pulse - len(values) + 1, pulse + 1)
+        valid = ~isnan(values)
+        pulses = pulses[valid]
+        timeStamps = timeStamp - (pulse - pulses) / float(rate)
+        self.pending.append((pv, pulses, timeStamps, values[valid]))
+
+    # Writes out everything still queued and waits for the writer to finish
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            stopping = self.stopping.wait(FLUSH_INTERVAL)
+            self.drain()
+
+            if stopping:
+                self.writeSegment()
+                return
+
+            if (self.segmentStart is not None
+                    and time() - self.segmentStart > self.segmentSeconds):
+                self.writeSegment()
+
+    def drain(self):
+        pending = self.pending
+
+        while pending:
+            pv, pulse, timeStamp, value = pending.popleft()
+
+            if isinstance(value, ndarray):
+                if pv in self.firstLivePulses:
+                    keep = pulse < self.firstLivePulses[pv]
+                    pulse, timeStamp = pulse[keep], timeStamp[keep]
+                    value = value[keep]
+
+                if len(pulse):
+                    self.historyEnds[pv] = pulse[-1]
+
+                self.storeArray(pv, pulse, timeStamp, value)
+                continue
+
+            # Already written as part of the history
+            if pv in self.historyEnds and pulse <= self.historyEnds[pv]:
+                continue
+
+            self.firstLivePulses.setdefault(pv, pulse)
+
+            if self.segmentSize == self.segmentLength:
+                self.writeSegment()
+
+            if self.segmentStart is None:
+                self.segmentStart = time()
+
+            self.segment[self.segmentSize] = (pv, pulse, timeStamp, value)
+            self.segmentSize += 1
+
+    def storeArray(self, pv, pulses, timeStamps, values):
+        start = 0
+
+        while start < len(values):
+            if self.segmentSize == self.segmentLength:
+                self.writeSegment()
+
+            if self.segmentStart is None:
+                self.segmentStart = time()
+
+            count = min(len(values) - start,
+                        self.segmentLength - self.segmentSize)
+            out = self.segment[self.segmentSize:self.segmentSize + count]
+
+            out["pv"] = pv
+            out["pulse"] = pulses[start:start + count]
+            out["timestamp"] = timeStamps[start:start + count]
+            out["value"] = values[start:start + count]
+
+            self.segmentSize += count
+            start += count
+
+    # The segment is written under a temporary name and renamed once it's
+    # complete, so readers never see half of one
+    def writeSegment(self):
+        if not self.segmentSize:
+            return
+
+        fileName = path.join(self.directory,
+                             SEGMENT_NAME.format(N=self.segmentNumber))
+
+        with open(fileName + ".part", "wb") as f:
+            save(f, self.segment[:self.segmentSize])
+
+        rename(fileName + ".part", fileName)
+
+        self.written += self.segmentSize
+        self.segmentNumber += 1
+        self.segmentSize = 0
+        self.segmentStart = None
+
+
+############################################################################
+# Reads a recording made by Recorder. Every segment is memory mapped rather
+# than loaded, so opening one costs the same no matter how big it is, and
+# only the parts that get played back (see ReplaySource) are ever read off
+# of the disk.
+#
+# Segments are in arrival order, which is pulse order give or take the
+# couple of pulses by which the PVs' callbacks can be out of step with each
+# other. Rather than sorting the whole thing up front, each segment gets sorted
+# by pulse when it's needed (see sortedSegment), and segments are found by
+# their last pulse.
+############################################################################
+class Recording(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+
+        with open(path.join(directory, HEADER_NAME)) as f:
+            header = load(f)
+
+        self.pvs = [str(pv) for pv in header["pvs"]]
+        self.mode = header.get("mode")
+        self.rate = float(header["rate"] or 0)
+        self.started = header.get("started")
+
+        if self.rate < 1:
+            raise ValueError("{D} was recorded without beam".format(
+                D=directory))
+
+        # glob skips the .part files, which aren't finished
+        fileNames = sorted(glob(path.join(directory, "segment-*.npy")))
+        self.segments = [loadArray(fileName, mmap_mode="r")
+                         for fileName in fileNames]
+        self.segments = [segment for segment in self.segments if len(segment)]
+
+        if not self.segments:
+            raise IOError("{D} has no data in it".format(D=directory))
+
+        self.lastPulses = [int(segment["pulse"][-1])
+                           for segment in self.segments]
+
+        self.startPulse = int(
+            self.segments[0]["pulse"][:START_SCAN_LENGTH].min())
+        self.endPulse = max(self.lastPulses)
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments)
+
+    def duration(self):
+        return (self.endPulse - self.startPulse) / self.rate
+
+    # The index of the first segment that can have anything after pulse
+    def segmentFor(self, pulse):
+        return min(bisect_left(self.lastPulses, pulse),
+                   len(self.segments) - 1)
+
+    # The pv, pulse, timestamp and value columns of segment number index,
+    # sorted by pulse (and read into memory)
+    def sortedSegment(self, index):
+        segment = self.segments[index]
+        order = argsort(segment["pulse"], kind="mergesort")
+        return (segment["pv"][order], segment["pulse"][order],
+                segment["timestamp"][order], segment["value"][order])
+
+    ############################################################################
+    # The length values of pv (its index in pvs) for the pulses ending at
+    # endPulse, oldest first, with nans for the pulses it doesn't have. That's
+    # what its HSTBR PV would have said at the time.
+    ############################################################################
+    def history(self, pv, endPulse, length):
+        out = empty(length)
+        out[:] = nan
+
+        firstPulse = endPulse - length + 1
+        index = self.segmentFor(endPulse)
+
+        # A couple of pulses for endPulse can land at the start of the next
+        # segment, so that one gets a look too
+        index = min(index + 1, len(self.segments) - 1)
+
+        while index >= 0:
+            segment = self.segments[index]
+            pulses = segment["pulse"]
+
+            mask = ((segment["pv"] == pv) & (pulses >= firstPulse)
+                    & (pulses <= endPulse))
+            out[pulses[mask] - firstPulse] = segment["value"][mask]
+
+            if index and self.lastPulses[index - 1] < firstPulse:
+                break
+
+            index -= 1
+
+        return out
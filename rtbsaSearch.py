@@ -0,0 +1,198 @@
+from bisect import bisect_left
+from heapq import nsmallest
+
+# The most search results the lists show (an empty search shows everything)
+MAX_RESULTS = 2000
+
+# How long the search boxes wait after a keystroke for another one before
+# searching
+SEARCH_DELAY_MS = 150
+
+# Terms at least this long are looked up by their n-grams; shorter ones are
+# too short for that, so they get checked against the names one by one
+NGRAM_LENGTH = 3
+
+# Sorts after any character a PV name can have
+LAST_CHARACTER = u"\uffff"
+
+
+############################################################################
+# The index behind the PV search boxes. PV names are split into their fields
+# (area:unit:attribute and so on), which go in a sorted list that works like a
+# prefix trie (every field starting with a prefix is one bisect away), and
+# every three letter run of every name goes in an n-gram index, so a term
+# anywhere in a name is found by intersecting a few lists of names instead of
+# testing every one of them. Only terms shorter than that still get tested
+# name by name, and then only against the names the longer terms left.
+#
+# A search is one or more whitespace separated terms, all of which have to
+# match (case doesn't matter). Results come back best first: the name itself,
+# then names starting with the search, then names where every term starts a
+# field, then everything else, shorter names first within each of those.
+#
+# The indexes are built the first time they're needed, so adding names is
+# cheap and nothing's spent on them if nobody searches.
+############################################################################
+class PVIndex(object):
+
+    def __init__(self, names=()):
+        self.names = []
+        self.lowered = []
+        self.ids = {}
+
+        self.fields = None
+        self.fieldIds = None
+        self.ngrams = None
+
+        self.add(names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    # Adds whichever of names aren't in already, keeping their order
+    def add(self, names):
+        count = len(self.names)
+
+        for name in names:
+            if name in self.ids:
+                continue
+
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+            self.lowered.append(name.lower())
+
+        # They get rebuilt with the new names when they're next needed
+        if len(self.names) != count:
+            self.fields = None
+            self.fieldIds = None
+            self.ngrams = None
+
+    # Builds the indexes now instead of on the first search (e.g. on a
+    # background thread, before the index is put to use)
+    def build(self):
+        self.buildFields()
+        self.buildNgrams()
+
+    # The fields and the ids of the names they're from, in parallel lists
+    # sorted by field
+    def buildFields(self):
+        pairs = sorted((field, id) for id, name in enumerate(self.lowered)
+                       for field in set(name.split(":")))
+        self.fields = [field for field, _ in pairs]
+        self.fieldIds = [id for _, id in pairs]
+
+    def buildNgrams(self):
+        ngrams = {}
+
+        for id, name in enumerate(self.lowered):
+            for start in xrange(len(name) - NGRAM_LENGTH + 1):
+                ids = ngrams.setdefault(name[start:start + NGRAM_LENGTH], [])
+
+                # Each name's ids are added in order, so this keeps them
+                # unique
+                if not ids or ids[-1] != id:
+                    ids.append(id)
+
+        self.ngrams = ngrams
+
+    # The ids of the names with a field starting with prefix
+    def fieldMatches(self, prefix):
+        if self.fields is None:
+            self.buildFields()
+
+        # Every field starting with prefix sorts between it and it followed by
+        # the highest character there is
+        start = bisect_left(self.fields, prefix)
+        end = bisect_left(self.fields, prefix + LAST_CHARACTER, start)
+
+        return set(self.fieldIds[start:end])
+
+    # The ids of the names with term in them anywhere
+    def substringMatches(self, term):
+        if self.ngrams is None:
+            self.buildNgrams()
+
+        postings = []
+        for start in xrange(len(term) - NGRAM_LENGTH + 1):
+            ids = self.ngrams.get(term[start:start + NGRAM_LENGTH])
+
+            if ids is None:
+                return set()
+
+            postings.append(ids)
+
+        postings.sort(key=len)
+        ids = set(postings[0])
+
+        for posting in postings[1:]:
+            ids.intersection_update(posting)
+
+            if not ids:
+                break
+
+        # Having all of a term's n-grams doesn't mean having them in a row
+        if len(term) > NGRAM_LENGTH:
+            lowered = self.lowered
+            ids = set(id for id in ids if term in lowered[id])
+
+        return ids
+
+    # The ids of the names with term in them anywhere, out of candidates
+    # (the ids to check, or None for all of them)
+    def scanMatches(self, term, candidates=None):
+        lowered = self.lowered
+
+        if candidates is None:
+            candidates = xrange(len(lowered))
+
+        return set(id for id in candidates if term in lowered[id])
+
+    # How good a match name number id is for query: smaller is better.
+    # startsFields is the ids of the names where every term starts a field
+    def rank(self, id, query, startsFields):
+        name = self.lowered[id]
+
+        if name == query:
+            score = 0
+        elif name.startswith(query):
+            score = 1
+        elif id in startsFields:
+            score = 2
+        else:
+            score = 3
+
+        return score, len(name), id
+
+    # The names matching query, best first, at most limit of them
+    def search(self, query, limit=MAX_RESULTS):
+        query = " ".join(query.lower().split())
+        terms = query.split()
+
+        if not terms:
+            return list(self.names)
+
+        ids = None
+        startsFields = None
+
+        # The longest terms narrow it down the most, so they go first
+        for term in sorted(terms, key=len, reverse=True):
+            fieldIds = self.fieldMatches(term)
+
+            if len(term) >= NGRAM_LENGTH:
+                matches = self.substringMatches(term)
+            else:
+                matches = self.scanMatches(term, ids)
+
+            ids = matches if ids is None else ids & matches
+            startsFields = (fieldIds if startsFields is None
+                            else startsFields & fieldIds)
+
+            if not ids:
+                return []
+
+        ranked = nsmallest(limit, (self.rank(id, query, startsFields)
+                                   for id in ids))
+        return [self.names[id] for _, _, id in ranked]
@@ -0,0 +1,482 @@
+from math import sqrt
+from threading import Lock, Thread
+from time import sleep, time
+from zlib import crc32
+
+from numpy import arange, nan, random, searchsorted
+
+from rtbsaPulse import FIDUCIAL_RATE, PULSE_ID_WRAP, withPulseId
+from rtbsaRate import RateMonitor
+from rtbsaRecording import Recording
+import rtbsaUtils
+
+# The name of the simulator's beam rate PV
+SIMULATED_RATE_PV = "SIM:RATE"
+
+# And the replay's
+REPLAY_RATE_PV = "REPLAY:RATE"
+
+# How often the replay sends out whatever pulses have come due
+REPLAY_TICK = 0.01
+
+
+############################################################################
+# Where BSACore gets its PVs from. A source has two methods:
+#
+#   pv(name, callback=None) returns a PV, which is anything with connect,
+#   add_callback, clear_callbacks and disconnect methods that calls its
+#   callbacks with pvname, value and timestamp keyword arguments (like a
+#   pyepics PV with form='time')
+#
+#   rateMonitor(user) returns the RateMonitor for the beam rate, or None if
+#   there's no way to tell what it is
+#
+# EpicsSource is the real thing; SimulatedSource makes the data up and
+# ReplaySource plays back a recording (see rtbsaRecording).
+############################################################################
+class EpicsSource(object):
+
+    # noinspection PyMethodMayBeStatic
+    def pv(self, name, callback=None):
+        # pyepics takes a while to load and start up channel access, so that
+        # waits until we actually need a PV from it (which the simulator and
+        # replays never do)
+        from epics import PV
+
+        # Without the time form, we wouldn't get the timestamp
+        return PV(name, form='time', callback=callback)
+
+    def rateMonitor(self, user):
+        if user == "physics":
+            return RateMonitor('IOC:IN20:EV01:RG01_ACTRATE',
+                               rtbsaUtils.rateDictLCLS, self.pv)
+
+        if user == "spear":
+            return RateMonitor("LINAC:RateSetpt", rtbsaUtils.rateDictSPEAR,
+                               self.pv)
+
+        return None
+
+
+############################################################################
+# Makes up BSA data for any PV name you ask for, so that everything from the
+# callbacks on can run (and be timed) off of the accelerator network, at
+# whatever rate you like.
+#
+# Every pulse gets one random drive value that all of the signals share, and
+# each signal is an offset (picked from a hash of its name, so it's the same
+# every run) plus noise times a mix of the drive and its own random value.
+# The mix is such that any two signals have a correlation coefficient of
+# correlation. Each signal independently skips a pulse with probability
+# dropout, and every timestamp is off by up to jitter seconds either way.
+#
+# Names ending in BR and HSTBR are the same signal as the base name. An HSTBR
+# PV sends its history (historyLength pulses of it) once, on the first pulse
+# after it gets a callback, like the real ones do when you connect.
+#
+# Pulses come from a background thread that starts with the first PV. If the
+# callbacks can't keep up, pulses go out back to back until it's caught up.
+############################################################################
+class SimulatedSource(object):
+
+    def __init__(self, rate=120.0, correlation=0.9, noise=1.0, dropout=0.0,
+                 jitter=0.0, historyLength=rtbsaUtils.BUFF_LENGTH_LIMIT,
+                 seed=None):
+        self.rate = float(rate)
+        self.correlation = correlation
+        self.noise = noise
+        self.dropout = dropout
+        self.jitter = jitter
+        self.historyLength = historyLength
+
+        self.random = random.RandomState(seed)
+
+        # The shared drive values for the last historyLength pulses, indexed
+        # by pulse % historyLength
+        self.drive = self.random.randn(historyLength)
+
+        self.pulse = int(time() * rate)
+
+        self.pvs = []
+        self.lock = Lock()
+        self.thread = None
+        self.running = False
+
+        # How many pulses have been sent out since the start
+        self.pulsesSent = 0
+
+    def pv(self, name, callback=None):
+        pv = SimulatedPV(self, name, callback)
+
+        with self.lock:
+            self.pvs.append(pv)
+
+        self.start()
+        return pv
+
+    def rateMonitor(self, user):
+        return RateMonitor(SIMULATED_RATE_PV, {self.rate: self.rate}, self.pv)
+
+    def remove(self, pv):
+        with self.lock:
+            if pv in self.pvs:
+                self.pvs.remove(pv)
+
+    def start(self):
+        if self.running:
+            return
+
+        self.running = True
+        self.thread = Thread(target=self.run, name="SimulatedSource")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        startTime = time()
+        startPulse = self.pulse
+
+        while self.running:
+            nextTime = startTime + (self.pulse - startPulse + 1) / self.rate
+            wait = nextTime - time()
+
+            if wait > 0:
+                sleep(wait)
+
+            self.sendPulse()
+
+    def sendPulse(self):
+        self.pulse += 1
+        self.pulsesSent += 1
+
+        drive = self.random.randn()
+        self.drive[self.pulse % self.historyLength] = drive
+
+        with self.lock:
+            pvs = list(self.pvs)
+
+        for pv in pvs:
+            pv.update(self.pulse, drive)
+
+    # A value of the signal with the given offset for a pulse with the given
+    # shared drive value
+    def signal(self, offset, drive):
+        return offset + self.noise * (sqrt(self.correlation) * drive
+                                      + sqrt(1 - self.correlation)
+                                      * self.random.randn())
+
+    def timeStamp(self, pulse):
+        timeStamp = pulse / self.rate
+
+        if self.jitter:
+            timeStamp += self.random.uniform(-self.jitter, self.jitter)
+
+        return timeStamp
+
+    # The nanoseconds of a pulse's timestamp, with the pulse ID in them like
+    # the real thing (so the jitter doesn't throw the pulse numbers off), or
+    # None when the rate isn't one the 360Hz fiducials divide into
+    def nanoseconds(self, pulse, timeStamp):
+        fiducials = FIDUCIAL_RATE / self.rate
+
+        if fiducials != int(fiducials):
+            return None
+
+        return withPulseId(timeStamp,
+                           int(pulse * fiducials) % PULSE_ID_WRAP)
+
+    # The last historyLength values of a signal, ending at pulse, like an
+    # HSTBR PV would have
+    def history(self, offset, pulse):
+        pulses = arange(pulse - self.historyLength + 1, pulse + 1)
+        drive = self.drive[pulses % self.historyLength]
+
+        values = offset + self.noise * (
+            sqrt(self.correlation) * drive
+            + sqrt(1 - self.correlation) * self.random.randn(drive.size))
+
+        if self.dropout:
+            values[self.random.rand(values.size) < self.dropout] = nan
+
+        return values
+
+
+class SimulatedPV(object):
+
+    def __init__(self, source, name, callback=None):
+        self.source = source
+        self.pvname = name
+        self.callbacks = [callback] if callback else []
+
+        self.isRate = name == SIMULATED_RATE_PV
+        self.isHistory = name.endswith("HSTBR")
+
+        # The rate and history PVs only send anything once (the rate doesn't
+        # change, and RTBSA only ever wants the first history)
+        self.sent = False
+
+        self.offset = (crc32(baseName(name)) & 0xffff) / 100.0
+
+    # noinspection PyUnusedLocal,PyMethodMayBeStatic
+    def connect(self, timeout=None):
+        return True
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def clear_callbacks(self):
+        self.callbacks = []
+
+    def disconnect(self):
+        self.source.remove(self)
+
+    def update(self, pulse, drive):
+        callbacks = self.callbacks
+
+        if not callbacks:
+            return
+
+        source = self.source
+
+        if self.isRate or self.isHistory:
+            if self.sent:
+                return
+
+            self.sent = True
+
+            if self.isRate:
+                value = source.rate
+            else:
+                value = source.history(self.offset, pulse)
+
+        elif source.dropout and source.random.rand() < source.dropout:
+            return
+
+        else:
+            value = source.signal(self.offset, drive)
+
+        timeStamp = source.timeStamp(pulse)
+        nanoseconds = source.nanoseconds(pulse, timeStamp)
+
+        for callback in callbacks:
+            callback(pvname=self.pvname, value=value, timestamp=timeStamp,
+                     nanoseconds=nanoseconds)
+
+
+############################################################################
+# Plays a recording back as if it were coming in live, so every plot type
+# works on it the same as on the real thing: PVs named in the recording
+# (with or without the BR and HSTBR suffixes) send what was recorded for them
+# and anything else never connects. Like the simulator's, an HSTBR PV sends
+# its history (what was recorded in the historyLength pulses up to wherever
+# playback is) once, and the rate PV sends the recording's rate.
+#
+# Playback goes at speed times real time from a background thread, and can
+# be paused or sent somewhere else in the recording with seek. The ring
+# buffers only take pulses going forward, so to go back, restart the plot
+# after seeking (which gets it a fresh history).
+############################################################################
+class ReplaySource(object):
+
+    def __init__(self, directory, speed=1.0, start=0.0,
+                 historyLength=rtbsaUtils.BUFF_LENGTH_LIMIT):
+        self.recording = Recording(directory)
+        self.rate = self.recording.rate
+        self.speed = speed
+        self.historyLength = historyLength
+        self.paused = False
+
+        # Where playback is, as a (fractional) pulse number. Everything up to
+        # it has been sent
+        self.position = self.recording.startPulse + start * self.rate
+        self.seekTo = None
+
+        # The sorted segment we're sending out of and how far into it we are
+        self.segmentIndex = None
+        self.columns = None
+        self.cursor = 0
+
+        self.pvs = []
+        self.lock = Lock()
+        self.thread = None
+        self.running = False
+
+    def pv(self, name, callback=None):
+        if name == REPLAY_RATE_PV:
+            row = None
+        else:
+            try:
+                row = self.recording.pvs.index(baseName(name))
+            except ValueError:
+                row = -1
+
+        pv = ReplayPV(self, name, row, callback)
+
+        with self.lock:
+            self.pvs.append(pv)
+
+        self.start()
+        return pv
+
+    # noinspection PyUnusedLocal
+    def rateMonitor(self, user):
+        return RateMonitor(REPLAY_RATE_PV, {self.rate: self.rate}, self.pv)
+
+    def remove(self, pv):
+        with self.lock:
+            if pv in self.pvs:
+                self.pvs.remove(pv)
+
+    # How far into the recording playback is, in seconds
+    def elapsed(self):
+        return (self.position - self.recording.startPulse) / self.rate
+
+    def finished(self):
+        return self.position >= self.recording.endPulse
+
+    # Picked up by the playback thread on its next tick
+    def seek(self, seconds):
+        self.seekTo = self.recording.startPulse + seconds * self.rate
+
+    def start(self):
+        if self.running:
+            return
+
+        self.running = True
+        self.thread = Thread(target=self.run, name="ReplaySource")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        lastTick = time()
+
+        while self.running:
+            sleep(REPLAY_TICK)
+
+            now = time()
+            elapsed, lastTick = now - lastTick, now
+
+            seekTo, self.seekTo = self.seekTo, None
+            if seekTo is not None:
+                self.position = min(max(seekTo, self.recording.startPulse),
+                                    self.recording.endPulse)
+                self.segmentIndex = None
+
+            with self.lock:
+                pvs = list(self.pvs)
+
+            for pv in pvs:
+                if not pv.sent and pv.callbacks:
+                    pv.sendOnce(int(self.position))
+
+            if self.paused or self.finished():
+                continue
+
+            self.position = min(self.position + elapsed * self.rate
+                                * self.speed, self.recording.endPulse)
+            self.sendUpTo(int(self.position), pvs)
+
+    ############################################################################
+    # Sends every sample up to and including endPulse that hasn't been sent
+    # yet to the PVs listening for it, a segment at a time. The current segment
+    # is sorted by pulse once when playback gets to it.
+    ############################################################################
+    def sendUpTo(self, endPulse, pvs):
+        listeners = {}
+        for pv in pvs:
+            if pv.row >= 0 and not pv.isHistory and pv.callbacks:
+                listeners.setdefault(pv.row, []).append(pv)
+
+        recording = self.recording
+
+        if self.segmentIndex is None:
+            self.loadSegment(recording.segmentFor(endPulse))
+            self.cursor = searchsorted(self.columns[1], endPulse,
+                                       side="right")
+            return
+
+        while True:
+            rows, pulses, timeStamps, values = self.columns
+            stop = searchsorted(pulses, endPulse, side="right")
+
+            for i in xrange(self.cursor, stop):
+                for pv in listeners.get(rows[i], ()):
+                    pv.send(values[i], timeStamps[i])
+
+            self.cursor = stop
+
+            if (stop < len(pulses)
+                    or self.segmentIndex + 1 == len(recording.segments)):
+                return
+
+            self.loadSegment(self.segmentIndex + 1)
+
+    def loadSegment(self, index):
+        self.segmentIndex = index
+        self.columns = self.recording.sortedSegment(index)
+        self.cursor = 0
+
+
+class ReplayPV(object):
+
+    def __init__(self, source, name, row, callback=None):
+        self.source = source
+        self.pvname = name
+        self.row = row
+        self.callbacks = [callback] if callback else []
+
+        self.isHistory = name.endswith("HSTBR")
+
+        # The rate and history PVs send once (when they get a callback), and
+        # the rest never do
+        self.sent = row is not None and (row < 0 or not self.isHistory)
+
+    # noinspection PyUnusedLocal
+    def connect(self, timeout=None):
+        return self.row != -1
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def clear_callbacks(self):
+        self.callbacks = []
+
+    def disconnect(self):
+        self.source.remove(self)
+
+    def sendOnce(self, pulse):
+        self.sent = True
+        source = self.source
+
+        if self.row is None:
+            self.send(source.rate, time())
+        else:
+            self.send(source.recording.history(self.row, pulse,
+                                               source.historyLength),
+                      pulse / source.rate)
+
+    def send(self, value, timeStamp):
+        for callback in self.callbacks:
+            callback(pvname=self.pvname, value=value, timestamp=timeStamp)
+
+
+# The name of the signal behind a BR or HSTBR PV
+def baseName(name):
+    for suffix in ("HSTBR", "BR"):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+
+    return name
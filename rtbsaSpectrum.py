@@ -0,0 +1,322 @@
+from numpy import (abs, angle, arange, empty, errstate, fft, hanning, interp,
+                   isfinite, isnan, log10, nan, zeros)
+
+# The power spectrum is taken of the data zero padded to this many times its
+# length, which smooths out the spectrum
+PAD_FACTOR = 3
+
+# The range of segment lengths for Welch averaging (see welchSegmentLength)
+WELCH_MIN_SEGMENT = 64
+WELCH_MAX_SEGMENT = 2048
+
+# How many of the newest segments the Welch PSD averages, and how many the
+# spectrogram shows
+AVERAGED_SEGMENTS = 16
+WATERFALL_LENGTH = 200
+
+# How many of the newest segments the coherence of A and B averages
+COHERENCE_SEGMENTS = 32
+
+
+############################################################################
+# Everything about a power spectrum that only depends on how many points go
+# into it and the beam rate, worked out once instead of every frame: the
+# frequency axis (already in increasing order, since a real FFT only has the
+# non-negative frequencies) and the zero padded work buffer the data gets
+# copied into.
+############################################################################
+class SpectrumPlan(object):
+
+    def __init__(self, numPoints, rate, padFactor=PAD_FACTOR):
+        self.numPoints = numPoints
+        self.rate = rate
+        self.size = numPoints * padFactor
+
+        # Only the first numPoints are ever written, so the rest stays zero
+        self.padded = zeros(self.size)
+
+        # The same non-negative frequencies fftfreq would give (so no Nyquist
+        # frequency when the size is even)
+        self.numFrequencies = (self.size + 1) // 2
+        self.frequencies = fft.rfftfreq(self.size,
+                                        1.0 / rate)[:self.numFrequencies]
+
+        self.positions = arange(numPoints, dtype=float)
+
+    def matches(self, numPoints, rate):
+        return self.numPoints == numPoints and self.rate == rate
+
+    ############################################################################
+    # The magnitude of the spectrum of data (numPoints values) at every one of
+    # frequencies, after interpolating over the nans and removing the DC
+    # component, or None if it's all nans. data isn't touched.
+    ############################################################################
+    def powerSpectrum(self, data):
+        work = self.padded[:self.numPoints]
+        work[:] = data
+
+        nans = isnan(work)
+
+        if nans.any():
+            if nans.all():
+                return None
+
+            valid = ~nans
+            work[nans] = interp(self.positions[nans], self.positions[valid],
+                                work[valid])
+
+        work -= work.mean()
+
+        ps = abs(fft.rfft(self.padded)[:self.numFrequencies])
+        ps /= self.size
+        return ps
+
+
+############################################################################
+# The segment length for Welch averaging of a numPoints window: the biggest
+# power of two that fits in it a few times over (so that there's something
+# to average), within reason. It sets the frequency resolution (rate over the
+# segment length), so a bigger window gets finer lines.
+############################################################################
+def welchSegmentLength(numPoints):
+    length = WELCH_MIN_SEGMENT
+
+    while length * 2 <= min(numPoints // 4, WELCH_MAX_SEGMENT):
+        length *= 2
+
+    return length
+
+
+############################################################################
+# Welch's method, run as the data comes in: every time another half segment
+# of pulses has arrived in the ring buffers, the newest segment of each (Hann
+# windowed, 50% overlap with the last one) gets transformed and handed to
+# the subclass's addSegment(row, transforms), which fills in row number row of
+# whatever it keeps a ring of numRows of. Averaging over those rows is a lot
+# less noisy than one periodogram of the whole window, and it only changes
+# when a segment completes.
+#
+# With more than one ring buffer, segments end at the newest pulse all of them
+# have, so they stay lined up by pulse, and transforms has one per ring
+# buffer. Starting up backfills from whatever history the ring buffers have.
+# screens (one per ring buffer, or None) say which values are usable, and if
+# any ring buffer's segment is mostly missing or unusable pulses, transforms
+# is None.
+############################################################################
+class SegmentedSpectrum(object):
+
+    def __init__(self, segmentLength, rate, numRows, numChannels=1,
+                 screens=None):
+        self.segmentLength = segmentLength
+        self.rate = rate
+        self.numRows = numRows
+        self.screens = screens
+        self.step = segmentLength // 2
+
+        self.window = hanning(segmentLength)
+
+        # Scales the squared magnitudes to a one sided density (per Hz)
+        self.scale = 2.0 / (rate * (self.window ** 2).sum())
+
+        self.frequencies = fft.rfftfreq(segmentLength, 1.0 / rate)
+
+        # How many segments have been done, and the pulse the next one ends at
+        self.segments = 0
+        self.nextEnd = None
+
+        self.buffers = [empty(segmentLength) for _ in xrange(numChannels)]
+        self.positions = arange(segmentLength, dtype=float)
+
+    def matches(self, segmentLength, rate):
+        return self.segmentLength == segmentLength and self.rate == rate
+
+    # Takes every segment that's completed in ringBuffers since the last call,
+    # and returns how many that was
+    def update(self, *ringBuffers):
+        lastPulses = [ringBuffer.lastPulse for ringBuffer in ringBuffers]
+
+        if None in lastPulses:
+            return 0
+
+        lastPulse = min(lastPulses)
+
+        # The oldest segment end that's still entirely in the ring buffers
+        oldestEnd = max(ringBuffer.lastPulse - ringBuffer.capacity
+                        for ringBuffer in ringBuffers) + self.segmentLength
+
+        if self.nextEnd is None:
+            backfill = max(min(lastPulse - oldestEnd,
+                               (self.numRows - 1) * self.step), 0)
+            self.nextEnd = lastPulse - backfill // self.step * self.step
+
+        # We fell so far behind that those pulses are gone
+        elif self.nextEnd < oldestEnd:
+            self.nextEnd = oldestEnd
+
+        added = 0
+
+        while self.nextEnd <= lastPulse:
+            transforms = [self.transform(channel,
+                                         ringBuffer.snapshot(
+                                             self.segmentLength, self.nextEnd,
+                                             self.buffers[channel]))
+                          for channel, ringBuffer in enumerate(ringBuffers)]
+
+            if any(transform is None for transform in transforms):
+                transforms = None
+
+            self.addSegment(self.segments % self.numRows, transforms)
+
+            self.segments += 1
+            self.nextEnd += self.step
+            added += 1
+
+        return added
+
+    # The windowed FFT of a segment of channel (which gets written over), or
+    # None if there isn't enough of it
+    def transform(self, channel, data):
+        if self.screens and self.screens[channel]:
+            # screens say nans aren't usable either
+            data[~self.screens[channel](data)] = nan
+
+        nans = isnan(data)
+        numNans = nans.sum()
+
+        if numNans * 2 > data.size:
+            return None
+
+        if numNans:
+            valid = ~nans
+            data[nans] = interp(self.positions[nans], self.positions[valid],
+                                data[valid])
+
+        data -= data.mean()
+        data *= self.window
+
+        return fft.rfft(data)
+
+    # Scales the product of two transforms (or one and itself) to a density.
+    # Only the frequencies with a negative twin get doubled
+    def density(self, product):
+        product *= self.scale
+        product[0] /= 2
+        if not self.segmentLength % 2:
+            product[-1] /= 2
+        return product
+
+    # The row numbers of the newest count segments, oldest first
+    def newestRows(self, count):
+        count = min(self.segments, count, self.numRows)
+        return arange(self.segments - count, self.segments) % self.numRows
+
+    # How many seconds apart the segments are
+    def interval(self):
+        return self.step / self.rate
+
+
+############################################################################
+# The power spectral density of one device, by Welch's method. A ring of the
+# newest waterfallLength segments' PSDs is kept; the average of the newest
+# averaged of those is the PSD, and the ring as a whole, oldest first, is the
+# spectrogram (see waterfall). Segments without enough data are rows of nans.
+############################################################################
+class WelchSpectrum(SegmentedSpectrum):
+
+    def __init__(self, segmentLength, rate, averaged=AVERAGED_SEGMENTS,
+                 waterfallLength=WATERFALL_LENGTH, screens=None):
+        SegmentedSpectrum.__init__(self, segmentLength, rate, waterfallLength,
+                                   screens=screens)
+        self.averaged = averaged
+
+        self.spectra = empty((waterfallLength, self.frequencies.size))
+        self.spectra[:] = nan
+
+    def addSegment(self, row, transforms):
+        if transforms is None:
+            self.spectra[row] = nan
+        else:
+            self.spectra[row] = self.density(abs(transforms[0]) ** 2)
+
+    # The average PSD of the newest averaged segments, or None if none of
+    # them had enough data
+    def psd(self):
+        spectra = self.spectra[self.newestRows(self.averaged)]
+        spectra = spectra[~isnan(spectra[:, 0])]
+
+        if not spectra.size:
+            return None
+
+        return spectra.mean(axis=0)
+
+    # The PSDs of the newest segments, oldest first, as a (segments x
+    # frequencies) array
+    def waterfall(self):
+        return self.spectra[self.newestRows(self.numRows)]
+
+
+############################################################################
+# The cross spectral density of two devices (A and B) by Welch's method, for
+# their coherence and relative phase: how much of B's power at each frequency
+# moves in step with A, and how far behind or ahead of it. Both come from the
+# averaged segments; a single segment would have a coherence of 1 everywhere.
+############################################################################
+class CrossSpectrum(SegmentedSpectrum):
+
+    def __init__(self, segmentLength, rate, averaged=COHERENCE_SEGMENTS,
+                 screens=None):
+        SegmentedSpectrum.__init__(self, segmentLength, rate, averaged, 2,
+                                   screens)
+
+        numFrequencies = self.frequencies.size
+        self.powersA = empty((averaged, numFrequencies))
+        self.powersB = empty((averaged, numFrequencies))
+        self.cross = empty((averaged, numFrequencies), dtype=complex)
+        self.powersA[:] = nan
+
+    def addSegment(self, row, transforms):
+        if transforms is None:
+            self.powersA[row] = nan
+            return
+
+        transformA, transformB = transforms
+
+        self.powersA[row] = self.density(abs(transformA) ** 2)
+        self.powersB[row] = self.density(abs(transformB) ** 2)
+        self.cross[row] = self.density(transformA.conj() * transformB)
+
+    ############################################################################
+    # The coherence (0 to 1) and the phase of B relative to A (in degrees) at
+    # every one of frequencies, and how many segments went into them, or None
+    # if there aren't at least two segments with enough data.
+    ############################################################################
+    def coherence(self):
+        rows = self.newestRows(self.numRows)
+        rows = rows[~isnan(self.powersA[rows, 0])]
+
+        if rows.size < 2:
+            return None
+
+        cross = self.cross[rows].mean(axis=0)
+
+        with errstate(invalid="ignore", divide="ignore"):
+            coherence = abs(cross) ** 2 / (self.powersA[rows].mean(axis=0)
+                                           * self.powersB[rows].mean(axis=0))
+
+        return coherence, angle(cross, deg=True), rows.size
+
+
+# The coherence that count averaged segments of two unrelated signals only
+# get above by chance one time in 20. The segments overlap, so they're not
+# quite independent and this is a little low
+def significantCoherence(count):
+    return 1 - 0.05 ** (1.0 / (count - 1))
+
+
+# PSDs in dB, with nans where there's no power at all (i.e. a flat line)
+def toDecibels(psd):
+    with errstate(divide="ignore", invalid="ignore"):
+        decibels = 10 * log10(psd)
+
+    decibels[~isfinite(decibels)] = nan
+    return decibels
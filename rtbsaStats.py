@@ -0,0 +1,355 @@
+from collections import deque
+from math import sqrt
+from operator import ge, le
+
+from numpy import (arange, array, corrcoef, isnan, linalg, nan, nanmax,
+                   nanmean, nanmin, nanstd, zeros)
+from numpy.polynomial import Chebyshev, Polynomial
+from numpy.polynomial.chebyshev import chebvander
+
+from rtbsaUtils import MAX_FIT_ORDER
+
+# Welford removals slowly accumulate rounding error, so once this many windows'
+# worth of pulses have been evicted we recompute the sums from scratch (which
+# keeps the amortized cost per pulse constant)
+REBASE_INTERVAL = 1
+
+# How far past the x range of the data the fit domain reaches, as a fraction
+# of that range. New x values outside of the domain force a rebase
+DOMAIN_MARGIN = 0.25
+
+# The moments of an empty window (see RunningStats)
+NO_MOMENTS = (0, 0.0, 0.0, 0.0, 0.0, 0.0)
+
+
+############################################################################
+# Windowed statistics of (x, y) pairs keyed by pulse number, updated one pulse
+# at a time as the callbacks come in rather than recomputed over the whole
+# buffer every frame.
+#
+# Means, variances and the x/y co-moment are kept with Welford's algorithm
+# (which can be run backwards to evict a pair once it falls out of the
+# window), and the windowed min/max come from monotonic deques, so both adding
+# and evicting a pulse are amortized O(1). It also keeps the moment sums for a
+# least squares polynomial fit (see FitSums).
+#
+# Samples have to be added in increasing pulse order.
+#
+# Only the callbacks change these, but they get read by the analysis at the
+# same time, so the sums are kept as one tuple (moments) and anything that's
+# rebuilt is built on the side and then swapped in with a single assignment.
+# That way a reader sees either the old stats or the new ones, never a window
+# that's been half reset.
+############################################################################
+class RunningStats(object):
+
+    def __init__(self, window):
+        self.window = window
+
+        # (pulse, x, y) for every pair currently in the window
+        self.samples = deque()
+
+        # Monotonic deques of (pulse, value). The front of each is the min/max
+        # over the window
+        self.minXs = deque()
+        self.maxXs = deque()
+        self.minYs = deque()
+        self.maxYs = deque()
+
+        # (count, mean of x, mean of y, m2 of x, m2 of y, co-moment)
+        self.moments = NO_MOMENTS
+
+        self.fitSums = FitSums()
+
+        self.removals = 0
+
+    def clear(self):
+        self.load((), (), ())
+
+    def resetSums(self):
+        self.moments = NO_MOMENTS
+        self.fitSums = FitSums()
+        self.removals = 0
+
+    # Seed the window from (already synchronized) buffers, e.g. after pulling
+    # a history buffer. The new window replaces the old one all at once
+    def load(self, pulses, xData, yData):
+        samples = deque()
+        extrema = [deque() for _ in xrange(4)]
+
+        for pulse, x, y in zip(pulses, xData, yData):
+            samples.append((pulse, x, y))
+            pushAllExtrema(extrema, pulse, x, y)
+
+        self.samples = samples
+        self.minXs, self.maxXs, self.minYs, self.maxYs = extrema
+        self.rebase()
+
+    def add(self, pulse, x, y):
+        self.samples.append((pulse, x, y))
+        self.addToSums(x, y)
+        self.pushExtrema(pulse, x, y)
+
+        if self.fitSums.covers(x):
+            self.fitSums.add(x, y)
+        else:
+            self.rebase()
+
+    def pushExtrema(self, pulse, x, y):
+        pushAllExtrema((self.minXs, self.maxXs, self.minYs, self.maxYs), pulse,
+                       x, y)
+
+    # Evict everything that's fallen out of the window ending at lastPulse
+    def advance(self, lastPulse):
+        oldestPulse = lastPulse - self.window + 1
+
+        while self.samples and self.samples[0][0] < oldestPulse:
+            _, x, y = self.samples.popleft()
+            self.removeFromSums(x, y)
+
+        for extrema in (self.minXs, self.maxXs, self.minYs, self.maxYs):
+            while extrema and extrema[0][0] < oldestPulse:
+                extrema.popleft()
+
+        if self.removals > REBASE_INTERVAL * self.window:
+            self.rebase()
+
+    def addToSums(self, x, y):
+        count, avgX, avgY, m2X, m2Y, coMoment = self.moments
+
+        count += 1
+        deltaX = x - avgX
+        deltaY = y - avgY
+        avgX += deltaX / count
+        avgY += deltaY / count
+
+        self.moments = (count, avgX, avgY, m2X + deltaX * (x - avgX),
+                        m2Y + deltaY * (y - avgY),
+                        coMoment + deltaX * (y - avgY))
+
+    # Welford's update in reverse
+    def removeFromSums(self, x, y):
+        count, avgX, avgY, m2X, m2Y, coMoment = self.moments
+
+        if count <= 1:
+            self.resetSums()
+            return
+
+        count -= 1
+        deltaX = x - avgX
+        deltaY = y - avgY
+        avgX -= deltaX / count
+        avgY -= deltaY / count
+
+        self.moments = (count, avgX, avgY, m2X - deltaX * (x - avgX),
+                        m2Y - deltaY * (y - avgY),
+                        coMoment - deltaX * (y - avgY))
+        self.fitSums.add(x, y, -1.0)
+        self.removals += 1
+
+    # Recompute all of the sums from the samples in the window, and swap them
+    # in once they're done
+    def rebase(self):
+        if not self.samples:
+            self.resetSums()
+            return
+
+        _, xData, yData = (array(column, dtype=float)
+                           for column in zip(*self.samples))
+
+        avgX = xData.mean()
+        avgY = yData.mean()
+
+        fitSums = FitSums()
+        fitSums.rebase(xData, yData)
+
+        self.moments = (xData.size, avgX, avgY, ((xData - avgX) ** 2).sum(),
+                        ((yData - avgY) ** 2).sum(),
+                        ((xData - avgX) * (yData - avgY)).sum())
+        self.fitSums = fitSums
+        self.removals = 0
+
+    # The rest of these get called by the analysis while the callbacks keep
+    # adding, so they're written to tolerate the window changing underneath
+    def minX(self):
+        return front(self.minXs)
+
+    def maxX(self):
+        return front(self.maxXs)
+
+    def minY(self):
+        return front(self.minYs)
+
+    def maxY(self):
+        return front(self.maxYs)
+
+    def meanY(self):
+        count, _, avgY, _, _, _ = self.moments
+        return avgY if count else nan
+
+    def stdY(self, ddof=0):
+        count, _, _, _, m2Y, _ = self.moments
+        if count <= ddof:
+            return nan
+        return sqrt(max(0.0, m2Y) / (count - ddof))
+
+    def corr(self):
+        _, _, _, m2X, m2Y, coMoment = self.moments
+        denominator = sqrt(max(0.0, m2X * m2Y))
+        if not denominator:
+            return nan
+        return coMoment / denominator
+
+    def fitPolynomial(self, order):
+        if self.moments[0] <= order:
+            return None
+        return self.fitSums.solve(order)
+
+
+############################################################################
+# The same interface as RunningStats, but computed once from a pair of
+# buffers. Used when the data on screen isn't what the running stats track
+# (i.e. when the standard deviation filter is on)
+############################################################################
+class BufferStats(object):
+
+    def __init__(self, xData, yData):
+        self.xData = xData
+        self.yData = yData
+
+    def minX(self):
+        return nanmin(self.xData)
+
+    def maxX(self):
+        return nanmax(self.xData)
+
+    def minY(self):
+        return nanmin(self.yData)
+
+    def maxY(self):
+        return nanmax(self.yData)
+
+    def meanY(self):
+        return nanmean(self.yData)
+
+    def stdY(self, ddof=0):
+        return nanstd(self.yData, ddof=ddof)
+
+    def corr(self):
+        return corrcoef(self.xData, self.yData).item(1)
+
+    def fitPolynomial(self, order):
+        valid = ~(isnan(self.xData) | isnan(self.yData))
+
+        if valid.sum() <= order:
+            return None
+
+        try:
+            return Chebyshev.fit(self.xData[valid], self.yData[valid], order)
+        except linalg.LinAlgError:
+            return None
+
+
+############################################################################
+# Running sums for a least squares polynomial fit of y against x, up to
+# MAX_FIT_ORDER. Each pulse can be added or removed in O(order), and solving
+# for the coefficients only involves an (order + 1) x (order + 1) system, so
+# the cost per frame doesn't depend on how many points are in the window.
+#
+# Sums of raw powers of x up to x^20 make for hopelessly ill-conditioned
+# normal equations, so instead x gets mapped onto [-1, 1] over a fixed
+# domain and the sums are of Chebyshev polynomials T_k. Since
+# T_i * T_j = (T_(i + j) + T_|i - j|) / 2, the normal matrix only needs the
+# sums of T_k for k up to 2 * order, plus the sums of y * T_k for k up to
+# order.
+############################################################################
+class FitSums(object):
+
+    def __init__(self, maxOrder=MAX_FIT_ORDER):
+        self.maxOrder = maxOrder
+        self.domain = None
+        self.basisSums = [0.0] * (2 * maxOrder + 1)
+        self.ySums = [0.0] * (maxOrder + 1)
+
+    def covers(self, x):
+        return self.domain is not None and (self.domain[0] <= x
+                                            <= self.domain[1])
+
+    def scale(self, x):
+        low, high = self.domain
+        return (2.0 * x - low - high) / (high - low)
+
+    # Use sign=-1 to remove a sample
+    def add(self, x, y, sign=1.0):
+        u = self.scale(x)
+        basisSums = self.basisSums
+        ySums = self.ySums
+
+        previous, current = 1.0, u
+        basisSums[0] += sign
+        basisSums[1] += sign * u
+        ySums[0] += sign * y
+        ySums[1] += sign * y * u
+
+        for k in xrange(2, len(basisSums)):
+            previous, current = current, 2.0 * u * current - previous
+            basisSums[k] += sign * current
+            if k <= self.maxOrder:
+                ySums[k] += sign * y * current
+
+    # Pick a new domain around xData and recompute the sums from scratch
+    def rebase(self, xData, yData):
+        low, high = xData.min(), xData.max()
+        margin = DOMAIN_MARGIN * (high - low) or max(1.0, abs(low))
+        self.domain = (low - margin, high + margin)
+
+        basis = chebvander(self.scale(xData), 2 * self.maxOrder)
+        self.basisSums = list(basis.sum(axis=0))
+        self.ySums = list(basis[:, :self.maxOrder + 1].T.dot(yData))
+
+    def solve(self, order):
+        if self.domain is None:
+            return None
+
+        basisSums = array(self.basisSums)
+        idx = arange(order + 1)
+        normalMatrix = (basisSums[idx[:, None] + idx]
+                        + basisSums[abs(idx[:, None] - idx)]) / 2.0
+
+        try:
+            coefficients = linalg.solve(normalMatrix,
+                                        array(self.ySums[:order + 1]))
+        except linalg.LinAlgError:
+            return None
+
+        return Chebyshev(coefficients, domain=self.domain)
+
+
+# Coefficients of fit in the power basis, highest power first (like polyfit)
+def powerCoefficients(fit, order):
+    coefficients = zeros(order + 1)
+    power = fit.convert(kind=Polynomial).coef
+    coefficients[:power.size] = power
+    return coefficients[::-1]
+
+
+# extrema is the min x, max x, min y and max y deques
+def pushAllExtrema(extrema, pulse, x, y):
+    minXs, maxXs, minYs, maxYs = extrema
+    pushMonotonic(minXs, pulse, x, ge)
+    pushMonotonic(maxXs, pulse, x, le)
+    pushMonotonic(minYs, pulse, y, ge)
+    pushMonotonic(maxYs, pulse, y, le)
+
+
+def pushMonotonic(extrema, pulse, value, dominated):
+    while extrema and dominated(extrema[-1][1], value):
+        extrema.pop()
+    extrema.append((pulse, value))
+
+
+def front(extrema):
+    try:
+        return extrema[0][1]
+    except IndexError:
+        return nan
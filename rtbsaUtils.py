@@ -1,10 +1,8 @@
 from numpy import nan
-from pyqtgraph import exporters
 from subprocess import Popen
 from time import sleep
 import os
 from datetime import datetime
-from xml.etree import ElementTree
 from re import sub
 from shutil import copy
 
@@ -12,6 +10,15 @@ IPK_LIMIT = 12000
 
 BUFF_LENGTH_LIMIT = 10000
 
+# The highest polynomial fit order the GUI allows
+MAX_FIT_ORDER = 10
+
+# The number of points along the x axis that fit curves get evaluated at
+FIT_GRID_POINTS = 200
+
+# The default cap on how many times a second the plot gets redrawn
+MAX_FRAME_RATE = 20
+
 # IOC:IN20:EV01:RG01_ACTRATE returns one of 7 states, 0 through 6, where
 # 0 is NULL (unclear what that means, but doesn't sound good), 1 is 0Hz,
 # 2 is 1Hz, 3 is 10Hz, 4 is 30Hz, 5 is 60Hz, and 6 is 120Hz
@@ -26,11 +33,6 @@ def setPosAndText(attribute, value, posValX, posValY, textVal):
     attribute.setText(textVal + str(value))
 
 
-def filterBuffers(bufferToFilter, filterFunc, xData, yData):
-    mask = filterFunc(bufferToFilter)
-    return xData[mask], yData[mask]
-
-
 def add_actions(target, actions):
     for action in actions:
         if action is None:
@@ -39,54 +41,24 @@ def add_actions(target, actions):
             target.addAction(action)
 
 
+# Nan out [start, end) with slice assignments so that the cost doesn't depend
+# on how long the gap is. If end < start, the range wraps around the end of
+# the buffer
 def padWithNans(dataBuffer, start, end):
-    for idx in xrange(start, end):
-        dataBuffer[idx] = nan
-
-
-############################################################################
-# A function that decides which indices to keep for each buffer. Using k to
-# denote the absolute value of the difference between the buffers, we get:
-#
-# Case 1: numBadShots is negative (buffer A is ahead and has had more
-#         points appended)
-#
-#       Case A: The multiplier for A's indices is 1, so:
-#
-#               max(0, mult * numBadShots) -> max(0, -k) -> 0
-#
-#               min(BUFF_LENGTH_LIMIT, BUFF_LENGTH_LIMIT + (mult * numBadShots))
-#               -> min(BUFF_LENGTH_LIMIT, BUFF_LENGTH_LIMIT - k)
-#               -> BUFF_LENGTH_LIMIT-k
-#
-#               And we get [0, BUFF_LENGTH_LIMIT-k] for buffer A
-#
-#       Case B: The multiplier for B's indices is -1, so:
-#
-#               max(0, mult * numBadShots) -> max(0, k) -> k
-#
-#               min(BUFF_LENGTH_LIMIT, BUFF_LENGTH_LIMIT + (mult * numBadShots))
-#               -> min(BUFF_LENGTH_LIMIT, BUFF_LENGTH_LIMIT + k)
-#               -> BUFF_LENGTH_LIMIT
-#
-#               And we get [k, BUFF_LENGTH_LIMIT] for buffer B
-#
-# Case 2: Using similar logic, the inverse is true when numBadShots is
-#         positive
-#
-# Side note, the @ is an annotation symbol that tells the interpreter
-# something about the thing it's annotating. In this case, it's telling us
-# that getIndices is a static method, meaning that it doesn't do anything
-# with class variables (i.e. there's no need for a "self" parameter)
-############################################################################
-def getIndices(numBadShots, mult):
-    return (max(0, mult * numBadShots),
-            min(BUFF_LENGTH_LIMIT, BUFF_LENGTH_LIMIT + (mult * numBadShots)))
+    if end < start:
+        dataBuffer[start:] = nan
+        dataBuffer[:end] = nan
+    else:
+        dataBuffer[start:end] = nan
 
 
 # Shamelessly stolen from Shawn (thanks buddy). A lot of this is probably
 # unnecessary for my purposes but I'm too lazy to clean it up
 def logbook(userText, titleText, textText, plotItem):
+    # Only loaded when someone actually posts to the logbook, so that it
+    # doesn't slow down starting up (see exportImage too)
+    from xml.etree import ElementTree
+
     curr_time = datetime.now()
     timeString = curr_time.strftime("%Y-%m-%dT%H:%M:%S")
     log_entry = ElementTree.Element(None)
@@ -136,9 +108,7 @@ def logbook(userText, titleText, textText, plotItem):
     xmlFile.write("\n")
 
     xmlFile.close()
-    exporter = exporters.ImageExporter(plotItem)
-    # exporter.parameters()['width'] = 550
-    exporter.export(fileName + '.png')
+    exportImage(plotItem, fileName + '.png')
     # PyQtGraph doesn't export PS files, so convert with linux
     Popen('convert ' + fileName + '.png ' + fileName + '.ps', shell=True)
 
@@ -153,14 +123,23 @@ def logbook(userText, titleText, textText, plotItem):
 
 
 def MCCLog(tmpPNG, tmpPS, plotItem):
-    exporter = exporters.ImageExporter(plotItem)
-    exporter.export(tmpPNG)
+    exportImage(plotItem, tmpPNG)
     Popen("convert " + tmpPNG + " " + tmpPS, shell=True)
     sleep(0.1)
     printFile = "lpr -P" + 'elog_mcc' + " " + tmpPS
     os.system(printFile)
 
 
+# pyqtgraph's exporters pull in a lot that nothing else needs, so they're only
+# imported the first time a plot gets saved
+def exportImage(plotItem, fileName):
+    from pyqtgraph import exporters
+
+    exporter = exporters.ImageExporter(plotItem)
+    # exporter.parameters()['width'] = 550
+    exporter.export(fileName)
+
+
 commonListLCLS = ['GDET:FEE1:241:ENRC', 'GDET:FEE1:242:ENRC',
                   'GDET:FEE1:361:ENRC', 'GDET:FEE1:362:ENRC',
                   'KLYS:LI20:K6:VOLT', 'ACCL:IN20:300:L0A_P',
@@ -0,0 +1,100 @@
+from threading import Condition, Thread
+from time import time
+from traceback import print_exc
+
+
+############################################################################
+# Works out the plot's frames on a thread of its own (the filtering, stats,
+# fits and spectra; see BSACore's frame methods), so all the Qt thread has
+# left to do is draw them and it stays responsive however long those take.
+#
+# There's only ever one job waiting: submitting another one replaces it, since
+# it'd be stale by the time the worker got to it anyway. Likewise only the
+# newest finished result is kept for the reader to take, along with the
+# handler it was submitted with (i.e. what to draw it with), and listener
+# hears about each one. So under load frames get dropped rather than queued
+# up, and what's on screen is never more than the frame being worked on
+# behind.
+#
+# Jobs run one at a time, so whatever they use only has the one reader.
+# Anything else that wants to use it has to cancel first. listener gets called
+# on the worker's thread, so it should do as little as possible, and each
+# job's time goes into metrics (if given) as "analysis".
+############################################################################
+class AnalysisWorker(object):
+
+    def __init__(self, listener=None, metrics=None):
+        self.listener = listener
+        self.metrics = metrics
+
+        self.condition = Condition()
+
+        # The (job, handler) waiting to run, the newest (handler, result)
+        # nobody's taken yet and whether a job's running
+        self.job = None
+        self.result = None
+        self.busy = False
+
+        self.thread = Thread(target=self.run, name="Analysis")
+        self.thread.daemon = True
+        self.thread.start()
+
+    # job gets called with no arguments. A result of None means there was
+    # nothing new, so there's nothing to take
+    def submit(self, job, handler=None):
+        with self.condition:
+            self.job = job, handler
+            self.condition.notify_all()
+
+    # The newest result as (handler, result), or None if there isn't one that
+    # hasn't been taken
+    def take(self):
+        with self.condition:
+            result, self.result = self.result, None
+
+        return result
+
+    # Throws away the waiting job and any result that hasn't been taken, and
+    # waits for the running job (if there is one) to finish. Once this
+    # returns, nothing's running until the next submit
+    def cancel(self):
+        with self.condition:
+            self.job = None
+
+            while self.busy:
+                self.condition.wait()
+
+            self.result = None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.job is None:
+                    self.condition.wait()
+
+                (job, handler), self.job = self.job, None
+                self.busy = True
+
+            start = time()
+
+            # A frame that can't be worked out shouldn't take the worker down
+            # with it
+            try:
+                result = job()
+            except Exception:
+                print_exc()
+                result = None
+
+            if self.metrics:
+                self.metrics.record("analysis", time() - start)
+
+            with self.condition:
+                self.busy = False
+
+                if result is not None:
+                    self.result = handler, result
+
+                self.condition.notify_all()
+
+            if result is not None and self.listener:
+                self.listener()